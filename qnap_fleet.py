@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+"""
+    SPDX-License-Identifier: GPL-2.0
+
+    Run qnap_mtd_resize.py on a fleet of QNAP devices over SSH.
+
+    The inventory is a text file with one '[user@]host' per line ('#' comments).
+    The hosts are processed by batches of --batch-size, at most --concurrency at
+    the same time, waiting --stagger seconds between batches. The rollout stops
+    when the failure rate of a batch is above --max-failure-rate: the remaining
+    hosts are skipped.
+
+        ./qnap_fleet.py inventory.txt status
+        ./qnap_fleet.py inventory.txt backup /media/usb/mtd_backup
+        ./qnap_fleet.py inventory.txt dry-run
+        ./qnap_fleet.py inventory.txt resize /media/usb/mtd_backup --batch-size 5
+
+    The remote commands are non-interactive (--yes) and SSH runs in batch mode
+    (key authentication). The resize runs detached on the device (its output goes
+    to REMOTE_LOG) and is polled every --poll seconds, so neither a --timeout nor
+    a lost SSH connection stops it while flashing. A resize not over after
+    --timeout is reported as "interrupted": check it with 'status', and finish it
+    with 'qnap_mtd_resize.py resume' once it stopped.
+
+    --fake SPEC replaces SSH with a simulated fleet (see FakeTransport) to test
+    the orchestration itself.
+"""
+
+import argparse
+import asyncio
+import json
+import shlex
+import sys
+import time
+
+
+# installed with the qnap_mtd_status.py it imports in the same directory
+REMOTE_PATH = "/usr/local/sbin/qnap_mtd_resize.py"
+# output of the detached resize, and its exit status in REMOTE_LOG.rc
+REMOTE_LOG = "/var/log/qnap_mtd_resize.fleet.log"
+
+
+class SshTransport:
+    """
+        Run the commands with ssh (BatchMode, so no password prompt)
+    """
+    def __init__(self, ssh_options=(), sudo=False):
+        self.ssh_options = list(ssh_options)
+        self.sudo = sudo
+
+    async def run(self, host, argv):
+        """
+            Run 'argv' on 'host' and return (exit status, stdout, stderr)
+        """
+        command = shlex.join((["sudo", "-n"] if self.sudo else []) + argv)
+        proc = await asyncio.create_subprocess_exec(
+                "ssh", "-o", "BatchMode=yes", *self.ssh_options, host, command,
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await proc.communicate()
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+        return proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+
+class FakeTransport:
+    """
+        Simulated fleet for tests: 'spec' maps host names to a dict with the
+        'returncode' (default 0), 'stdout', 'stderr' (default "") and 'delay'
+        (seconds, default 0.1) of every command. Unknown hosts succeed, and
+        'status' answers a resized state. A detached command (see detached_argv)
+        runs for 'delay' seconds from its start.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.commands = []
+        self.started = {}
+
+    async def run(self, host, argv):
+        self.commands.append((host, argv))
+        behavior = self.spec.get(host, {})
+        returncode = behavior.get("returncode", 0)
+        stdout = behavior.get("stdout")
+        if stdout is None:
+            stdout = json.dumps({"state": "resized", "problems": []}) if "status" in argv else "SUCCESS.\n"
+        if argv == poll_argv():
+            await asyncio.sleep(0.01)
+            if time.monotonic() - self.started[host] < behavior.get("delay", 0.1):
+                return 0, "running\n", ""
+            return 0, f"{returncode}\n{stdout}", ""
+        if argv[:2] == ["sh", "-c"] and "setsid" in argv[2]:
+            self.started[host] = time.monotonic()
+            return 0, "", ""
+        await asyncio.sleep(behavior.get("delay", 0.1))
+        return returncode, stdout, behavior.get("stderr", "")
+
+
+def remote_argv(args):
+    """
+        Return the qnap_mtd_resize.py command line of the 'args.action'
+    """
+    argv = [args.remote_path]
+    if args.action == "status":
+        return argv + ["status"]
+    if args.action == "backup":
+        return argv + ["backup", args.target]
+    if args.action == "dry-run":
+        return argv + ["--dry-run", "--yes"]
+    # resize
+    if args.target:
+        argv += ["--backup", args.target]
+    elif args.no_backup:
+        argv += ["--no-backup"]
+    return argv + ["--yes"] + args.resize_options
+
+
+def detached_argv(argv):
+    """
+        Return the command starting 'argv' in the background on the device, out of
+        the SSH session, with its output in REMOTE_LOG and its exit status in REMOTE_LOG.rc
+    """
+    script = f"{shlex.join(argv)} > {REMOTE_LOG} 2>&1; echo $? > {REMOTE_LOG}.rc"
+    return ["sh", "-c", f"rm -f {REMOTE_LOG}.rc; setsid nohup sh -c {shlex.quote(script)} < /dev/null > /dev/null 2>&1 &"]
+
+
+def poll_argv():
+    """
+        Return the command printing "running", or the exit status and the output
+        of the detached command (see detached_argv)
+    """
+    return ["sh", "-c", f"cat {REMOTE_LOG}.rc 2>/dev/null && cat {REMOTE_LOG} || echo running"]
+
+
+async def run_detached(transport, host, argv, poll):
+    """
+        Run 'argv' on 'host' detached (see detached_argv) and poll it every 'poll'
+        seconds until it ends. Return (exit status, output, "").
+        A failing poll (ie. SSH connection lost) is retried.
+    """
+    returncode, stdout, stderr = await transport.run(host, detached_argv(argv))
+    if returncode != 0:
+        return returncode, stdout, stderr
+    while True:
+        await asyncio.sleep(poll)
+        returncode, stdout, stderr = await transport.run(host, poll_argv())
+        first, _, output = stdout.partition("\n")
+        if returncode != 0 or first.strip() == "running":
+            continue
+        try:
+            return int(first), output, ""
+        except ValueError:
+            continue
+
+
+def host_detail(action, returncode, stdout, stderr):
+    """
+        Return a one line summary of a remote command result
+    """
+    if action == "status" and returncode in (0, 2):
+        try:
+            status = json.loads(stdout)
+            return " ".join([status["state"]] + (["reboot required"] if status.get("reboot_required") else [])
+                            + status.get("problems", []))
+        except (ValueError, KeyError):
+            pass
+    lines = [line.strip() for line in (stdout + stderr).splitlines() if line.strip()]
+    return lines[-1] if lines else ""
+
+
+async def run_host(transport, host, argv, action, timeout, semaphore, poll=10):
+    """
+        Run 'argv' on 'host' once the 'semaphore' allows it (detached for a resize,
+        see run_detached). Return the result dict.
+    """
+    async with semaphore:
+        start = time.monotonic()
+        result = {"host": host}
+        try:
+            if action == "resize":
+                command = run_detached(transport, host, argv, poll)
+            else:
+                command = transport.run(host, argv)
+            returncode, stdout, stderr = await asyncio.wait_for(command, timeout)
+            # 'status' exits with 2 for a partial resize: reported, not a failure of the command
+            ok = returncode == 0 or (action == "status" and returncode == 2)
+            result.update(result="ok" if ok else "failed", returncode=returncode,
+                          detail=host_detail(action, returncode, stdout, stderr), output=stdout + stderr)
+        except asyncio.TimeoutError:
+            if action == "resize":
+                # the resize may still be flashing: never treat it as a plain failure
+                result.update(result="interrupted", returncode=None, output="",
+                              detail=f"interrupted: run resume (not over after {timeout}s, see {REMOTE_LOG})")
+            else:
+                result.update(result="timeout", returncode=None, detail=f"no answer after {timeout}s", output="")
+        except OSError as e:
+            result.update(result="failed", returncode=None, detail=str(e), output="")
+        result["time"] = round(time.monotonic() - start, 3)
+        return result
+
+
+async def rollout(transport, hosts, argv, args):
+    """
+        Run 'argv' on the 'hosts' batch by batch (see the module documentation).
+        Return the list of result dicts, in the 'hosts' order.
+    """
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = []
+    batches = [hosts[i:i + args.batch_size] for i in range(0, len(hosts), args.batch_size)]
+    for i, batch in enumerate(batches):
+        if i and args.stagger:
+            await asyncio.sleep(args.stagger)
+        print(f"batch {i + 1}/{len(batches)}: {' '.join(batch)}", file=sys.stderr)
+        batch_results = await asyncio.gather(*(run_host(transport, host, argv, args.action, args.timeout, semaphore, args.poll)
+                                               for host in batch))
+        results += batch_results
+        failures = sum(result["result"] != "ok" for result in batch_results)
+        if failures / len(batch) > args.max_failure_rate:
+            print(f"batch {i + 1}: {failures}/{len(batch)} failures, above --max-failure-rate {args.max_failure_rate}: "
+                  "stopping the rollout", file=sys.stderr)
+            for host in hosts[len(results):]:
+                results.append({"host": host, "result": "skipped", "returncode": None, "time": 0,
+                                "detail": "rollout stopped", "output": ""})
+            break
+    return results
+
+
+def load_inventory(path):
+    """
+        Return the hosts of the 'path' inventory file
+    """
+    hosts = []
+    with open(path) as F:
+        for line in F:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                hosts.append(line)
+    return hosts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run qnap_mtd_resize.py on a fleet of QNAP devices over SSH")
+    parser.add_argument("inventory", help="Hosts file ('[user@]host' per line)")
+    parser.add_argument("action", choices=["status", "backup", "dry-run", "resize"])
+    parser.add_argument("target", nargs="?", help="Backup directory on the devices (backup, and resize unless --no-backup)")
+    parser.add_argument("--no-backup", action="store_true", help="[WARNING] resize without a MTD backup")
+    parser.add_argument("--concurrency", type=int, default=10, help="Hosts processed at the same time (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=20, help="Hosts per batch (default: %(default)s)")
+    parser.add_argument("--stagger", type=float, default=0, help="Seconds between batches (default: %(default)s)")
+    parser.add_argument("--max-failure-rate", type=float, default=0.1,
+                        help="Stop the rollout when the failures of a batch are above this ratio (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds per host (default: %(default)s)")
+    parser.add_argument("--poll", type=float, default=10, help="Seconds between the checks of a resize (default: %(default)s)")
+    parser.add_argument("--remote-path", default=REMOTE_PATH, help="qnap_mtd_resize.py on the devices (default: %(default)s)")
+    parser.add_argument("--sudo", action="store_true", help="Run the remote command with 'sudo -n'")
+    parser.add_argument("--ssh-option", action="append", default=[], metavar="OPTION",
+                        help="Additional ssh option (ie. --ssh-option=-oConnectTimeout=10), can be repeated")
+    parser.add_argument("--resize-option", dest="resize_options", action="append", default=[], metavar="OPTION",
+                        help="Additional qnap_mtd_resize.py option for resize (ie. --resize-option=--auto-layout)")
+    parser.add_argument("--fake", metavar="SPEC", help="Simulate the fleet from a JSON spec instead of ssh (see FakeTransport)")
+    parser.add_argument("--json", metavar="FILE", help="Also save the results (with the command outputs) as JSON")
+    args = parser.parse_args()
+
+    if args.action == "backup" and not args.target:
+        parser.error("backup needs a TARGET directory")
+    if args.action == "resize":
+        if bool(args.target) == args.no_backup:
+            parser.error("resize needs a TARGET backup directory, or --no-backup")
+    if args.batch_size < 1 or args.concurrency < 1:
+        parser.error("--batch-size and --concurrency must be at least 1")
+
+    hosts = load_inventory(args.inventory)
+    if args.fake:
+        with open(args.fake) as F:
+            transport = FakeTransport(json.load(F))
+    else:
+        transport = SshTransport(args.ssh_option, args.sudo)
+
+    results = asyncio.run(rollout(transport, hosts, remote_argv(args), args))
+
+    width = max([len(result["host"]) for result in results] + [4])
+    print(f"{'host':{width}} {'result':8} {'exit':>4} {'time(s)':>8}  detail")
+    for result in results:
+        returncode = "" if result["returncode"] is None else result["returncode"]
+        print(f"{result['host']:{width}} {result['result']:8} {returncode:>4} {result['time']:8.1f}  {result['detail']}")
+    counts = {}
+    for result in results:
+        counts[result["result"]] = counts.get(result["result"], 0) + 1
+    print(", ".join(f"{count} {name}" for name, count in sorted(counts.items())))
+
+    if args.json:
+        with open(args.json, "w") as F:
+            json.dump(results, F, indent=2)
+    if any(result["result"] != "ok" for result in results):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
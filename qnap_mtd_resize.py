@@ -64,13 +64,31 @@
 """
 
 
-import subprocess
 import os
-import argparse
-import logging
 import re
 import sys
-import shutil
+import struct
+import zlib
+import resource
+import contextlib
+import itertools
+import time
+import json
+import datetime
+# the other modules (subprocess, argparse, hashlib, the compressors, threads...) are
+# imported by the functions using them
+
+# flash layout, MTD access, U-Boot environment, bootargs / bootcmd patching and journal,
+# shared with the standalone 'status' (see qnap_mtd_status.py)
+from qnap_mtd_status import (
+    LEGACY_LAYOUT, LEGACY_ERASESIZE, FLASH_SIZE, LEGACY_NAS_CONFIG_SIZE, LEGACY_KERNEL_SIZE,
+    LEGACY_ROOTFS1_SIZE, UBOOT_CONFIG_OFFSET, NAS_CONFIG_OFFSET, LEGACY_KERNEL_OFFSET, ROOTFS1_OFFSET,
+    UIMAGE_HEADER_SIZE, UBOOT_ENV_SIZE, JOURNAL_PATH,
+    MtdTopology, mtd_lookup, ResizeError, ImageMtd, LiveDevice, FileDevice,
+    uboot_env_parse, Layout, DEFAULT_LAYOUT, uimage_size, chip_size,
+    resized_partitions, patch_bootcmd, layout_from_bootargs, patch_bootargs, Journal, flash_locate, flash_read,
+    status_command, main as status_main,
+    )
 
 
 # list here the model of tested QNAP device by listing the
@@ -83,413 +101,2185 @@ TESTED_QNAP_DTB = [
     ]
 
 
-def mtd_lookup(*names):
+# new size of 'NAS Config'
+NEW_NAS_CONFIG_SIZE = 0x40000
+# size of the 'NAS config' ext2 filesystem once shrunk (128 blocks of 1KB)
+NAS_CONFIG_FS_SIZE = 0x20000
+# free space kept at least in the planned 'Kernel' above the planned kernel, whatever
+# --headroom: the next kernel updates must fit without resizing again
+KERNEL_MARGIN = 0x80000
+
+# default location of the block manifest written after a resize (see 'verify')
+MANIFEST_PATH = "/etc/qnap_mtd_resize.manifest"
+# initramfs hook keeping the exact copy lengths of bootcmd up to date (see bootcmd_hook_update),
+# run after the one of flash-kernel
+BOOTCMD_HOOK_PATH = "/etc/initramfs/post-update.d/zz-qnap-update-bootcmd"
+# default location of the flash chip timings measured by 'bench-flash'
+FLASH_PROFILE_PATH = "/var/lib/qnap_mtd_resize/flash-profile.json"
+# read sizes and bytes read per size and partition by 'bench-flash'
+BENCH_READ_SIZES = (0x1000, 0x10000, 0x40000)
+BENCH_READ_BYTES = 0x80000
+
+
+class Report:
+    """
+        Timing and I/O accounting of a run, phase by phase.
+
+        For each phase: wall time, CPU time of the subprocesses, and for each
+        MTD partition of 'mtds' the bytes read, erased and programmed and the
+        erase counts (see the 'stats' of MtdDevice / ImageMtd).
+    """
+    def __init__(self, command):
+        self.command = command
+        self.mtds = []
+        self.phases = []
+        self.info = {}
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        def snapshot():
+            return {str(mtd): dict(mtd.stats) for mtd in self.mtds}
+
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        stats = snapshot()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start
+            children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+            io = {}
+            for mtd, counters in snapshot().items():
+                before = stats.get(mtd, {})
+                delta = {key: value - before.get(key, 0) for key, value in counters.items()}
+                if any(delta.values()):
+                    io[mtd] = delta
+            self.phases.append({
+                "name": name,
+                "wall_time": round(wall_time, 6),
+                "subprocess_time": round(children_end.ru_utime + children_end.ru_stime
+                                         - children.ru_utime - children.ru_stime, 6),
+                "io": io,
+                })
+
+    def to_json(self, result):
+        return json.dumps({
+            "command": self.command,
+            "start": datetime.datetime.fromtimestamp(self.start).isoformat(timespec="seconds"),
+            "total_time": round(time.time() - self.start, 6),
+            "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "result": result,
+            **self.info,
+            "phases": self.phases,
+            }, indent=2)
+
+
+def flash_image(mtd, image, dry_run=False, start=0, done=None, completed=()):
     """
-        For a list of MTD partition names, return a tuple
-        ("mtdX", size, erasesize) of the first match
-        Raise a KeyError exception if not found.
+        Write 'image' at the beginning of the 'mtd' partition (or at the erase block
+        aligned 'start' offset), one erase block at a time.
+
+        Every erase block is read first and compared with its target content.
+        Only the blocks that differ are erased and programmed, then read back
+        to verify them. A partial last block is padded with 0xff (like flashcp does).
+
+        'done' is called with the offset in 'image' of every erase block once up to
+        date, and the blocks at the 'completed' image offsets are skipped without
+        even reading them (see Journal).
+
+        Return a tuple (written, skipped) with the number of erase blocks
+        programmed and the number of erase blocks already up to date.
     """
-    for line in open("/proc/mtd").readlines():
-        m = re.match(r'(mtd[0-9]+): ([0-9a-f]+) ([0-9a-f]+) "(.+)"', line.strip())
-        if not m:
+    image = memoryview(image)
+    erasesize = mtd.erasesize
+    written = 0
+    skipped = 0
+    blocks = -(-len(image) // erasesize)
+    for offset in range(start, start + len(image), erasesize):
+        block = (offset - start) // erasesize + 1
+        if offset - start in completed:
+            skipped += 1
             continue
-        if m.group(4) in names:
-            return (m.group(1), int(m.group(2), 16), int(m.group(3), 16))
-    raise KeyError(f"No mtd {names} device found.")
-    
 
-def str_replace(search, replace, text):
+        target = image[offset-start:offset-start+erasesize]
+        if len(target) < erasesize:
+            target = bytes(target) + b"\xff" * (erasesize - len(target))
+
+        if not flash_block(mtd, offset, target, dry_run, f"{block}/{blocks}"):
+            skipped += 1
+            if done and not dry_run:
+                done(offset - start)
+            continue
+
+        written += 1
+        if done and not dry_run:
+            done(offset - start)
+
+    print(f"   {written} erase block(s) {'to write' if dry_run else 'written'}, {skipped} skipped (already up to date)")
+    return written, skipped
+
+
+def flash_block(mtd, offset, target, dry_run=False, progress=""):
+    """
+        Write the erase block 'target' at the erase block aligned 'offset' of 'mtd'
+        if it differs, and verify it (see flash_image). 'progress' is printed
+        with the timings.
+
+        Return True if the block was written (or would be, with 'dry_run').
+    """
+    if mtd.read(offset, mtd.erasesize) == target:
+        return False
+    if dry_run:
+        print(f"   0x{offset:06x}: differs (Dry run)")
+        return True
+
+    print(f"   0x{offset:06x}: erase + program ({progress})", end="", flush=True)
+    erase_start = time.perf_counter()
+    mtd.erase(offset)
+    program_start = time.perf_counter()
+    mtd.write(offset, target)
+    verify_start = time.perf_counter()
+    if mtd.read(offset, mtd.erasesize) != target:
+        print()
+        raise IOError(f"{mtd}: verify failed at offset 0x{offset:x}")
+    print(f" erase {program_start - erase_start:.2f}s, program {verify_start - program_start:.2f}s, "
+          f"verify {time.perf_counter() - verify_start:.2f}s")
+    return True
+
+
+def staging_buffer(size):
+    """
+        Allocate a 'size' bytes anonymous memory buffer and return it as a memoryview
+    """
+    import mmap
+    return memoryview(mmap.mmap(-1, size))
+
+
+# ext2/3/4 on-disk structures (only what is required by ext2_shrink, ext2_usage and
+# testing/backup_sda_used_blocks.py)
+EXT2_MAGIC = 0xEF53
+EXT2_GOOD_OLD_INODE_SIZE = 128
+EXT2_GOOD_OLD_FIRST_INO = 11
+EXT2_RESIZE_INO = 7
+EXT2_N_BLOCKS = 15
+EXT2_NDIR_BLOCKS = 12
+EXT2_VALID_FS = 1
+# features we know how to deal with
+# (not has_journal, 0x4: the journal of ext3/ext4 would have to be replayed and moved)
+EXT2_FEATURE_COMPAT_SUPP = 0x3b     # dir_prealloc imagic_inodes ext_attr resize_inode dir_index
+EXT2_FEATURE_COMPAT_RESIZE_INODE = 0x10
+EXT2_FEATURE_INCOMPAT_SUPP = 0x2    # filetype
+EXT2_FEATURE_RO_COMPAT_SUPP = 0x3   # sparse_super large_file
+EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER = 0x1
+EXT2_FEATURE_INCOMPAT_META_BG = 0x10
+EXT4_FEATURE_COMPAT_SPARSE_SUPER2 = 0x200
+EXT4_FEATURE_INCOMPAT_64BIT = 0x80
+EXT4_FEATURE_RO_COMPAT_BIGALLOC = 0x200
+EXT4_BG_BLOCK_UNINIT = 0x2
+S_IFMT = 0xf000
+S_IFLNK = 0xa000
+S_IFDIR = 0x4000
+S_IFREG = 0x8000
+
+
+class Ext2Superblock:
+    """
+        The fields of the ext2/3/4 superblock 'sb' (1024 bytes read at offset 1024)
+        used by this tool. 'blocks_count' and 'desc_size' (group descriptor size)
+        take the 64bit feature into account, 'reserved_gdt_blocks' the resize_inode one.
+        Raise a ValueError if 'sb' is not an ext2/3/4 superblock.
+    """
+    def __init__(self, sb):
+        (self.inodes_count, blocks_lo, self.r_blocks_count, self.free_blocks_count, self.free_inodes_count,
+            self.first_data_block, self.log_block_size, _, self.blocks_per_group, _,
+            self.inodes_per_group) = struct.unpack_from("<11I", sb)
+        magic, = struct.unpack_from("<H", sb, 56)
+        if magic != EXT2_MAGIC:
+            raise ValueError("no ext2/3/4 filesystem found")
+        self.rev_level, = struct.unpack_from("<I", sb, 76)
+        if self.rev_level == 0:
+            self.first_ino, self.inode_size = EXT2_GOOD_OLD_FIRST_INO, EXT2_GOOD_OLD_INODE_SIZE
+            self.compat = self.incompat = self.ro_compat = self.reserved_gdt_blocks = desc_size = 0
+        else:
+            self.first_ino, self.inode_size = struct.unpack_from("<IH", sb, 84)
+            self.compat, self.incompat, self.ro_compat = struct.unpack_from("<III", sb, 92)
+            self.reserved_gdt_blocks, = struct.unpack_from("<H", sb, 206)
+            desc_size, = struct.unpack_from("<H", sb, 254)
+            if not self.compat & EXT2_FEATURE_COMPAT_RESIZE_INODE:
+                self.reserved_gdt_blocks = 0
+        self.block_size = 1024 << self.log_block_size
+        self.wide = bool(self.incompat & EXT4_FEATURE_INCOMPAT_64BIT) and desc_size >= 64
+        self.blocks_count = blocks_lo | (struct.unpack_from("<I", sb, 336)[0] << 32 if self.wide else 0)
+        self.desc_size = desc_size if self.wide else 32
+
+
+def ext2_shrink(image, size):
+    """
+        Check and shrink in place the ext2 filesystem stored in the writable
+        buffer 'image' down to 'size' bytes (what 'e2fsck -f -p' + 'resize2fs'
+        used to do through a loop device).
+
+        Only single group filesystems without any 'ext4' feature are supported.
+        Every block referenced by an inode (data, indirect blocks, xattr block)
+        above the new limit is moved to a free block below it and its reference
+        is updated. Bitmaps and free counters are rebuilt from what is actually
+        referenced (like e2fsck would fix them), then the superblock and the group
+        descriptor are updated. The bitmaps and the inode table must already be
+        below the new limit.
+
+        Raise a ValueError if the filesystem is not valid or can't be shrunk.
+        Return the number of moved blocks.
+    """
+    image = memoryview(image)
+    sb = image[1024:2048]
+    ext = Ext2Superblock(sb)
+    if (ext.compat & ~EXT2_FEATURE_COMPAT_SUPP or ext.incompat & ~EXT2_FEATURE_INCOMPAT_SUPP
+            or ext.ro_compat & ~EXT2_FEATURE_RO_COMPAT_SUPP):
+        raise ValueError(f"unsupported filesystem features (compat 0x{ext.compat:x}, "
+                         f"incompat 0x{ext.incompat:x}, ro_compat 0x{ext.ro_compat:x})")
+    inodes_count, blocks_count, r_blocks_count = ext.inodes_count, ext.blocks_count, ext.r_blocks_count
+    first_data_block, blocks_per_group, inodes_per_group = ext.first_data_block, ext.blocks_per_group, ext.inodes_per_group
+    first_ino, inode_size, reserved_gdt_blocks = ext.first_ino, ext.inode_size, ext.reserved_gdt_blocks
+    block_size = ext.block_size
+    new_blocks_count = size // block_size
+    if blocks_count * block_size > len(image):
+        raise ValueError("filesystem larger than its partition")
+    if blocks_count - first_data_block > blocks_per_group or inodes_count != inodes_per_group:
+        raise ValueError("only single group filesystems are supported")
+    if new_blocks_count > blocks_count:
+        raise ValueError("filesystem already smaller than requested")
+
+    def block(n):
+        return image[n * block_size:(n + 1) * block_size]
+
+    gd = block(first_data_block + 1)
+    block_bitmap, inode_bitmap, inode_table = struct.unpack_from("<III", gd)
+    inode_table_blocks = (inodes_per_group * inode_size + block_size - 1) // block_size
+    # the group metadata (bitmaps, inode table) is never moved
+    for what, end in (("group descriptors", first_data_block + 2 + reserved_gdt_blocks),
+                      ("block bitmap", block_bitmap + 1), ("inode bitmap", inode_bitmap + 1),
+                      ("inode table", inode_table + inode_table_blocks)):
+        if end > new_blocks_count:
+            raise ValueError(f"{what} above the new limit of {new_blocks_count} blocks")
+
+    # owner[n] is set for every block in use. Metadata first.
+    owner = bytearray(blocks_count)
+
+    def use(n, what):
+        if not first_data_block <= n < blocks_count:
+            raise ValueError(f"{what}: invalid block {n}")
+        if owner[n]:
+            raise ValueError(f"{what}: block {n} used twice")
+        owner[n] = 1
+
+    for n in range(first_data_block, first_data_block + 2 + reserved_gdt_blocks):
+        use(n, "superblock/group descriptors")
+    use(block_bitmap, "block bitmap")
+    use(inode_bitmap, "inode bitmap")
+    for n in range(inode_table, inode_table + inode_table_blocks):
+        use(n, "inode table")
+
+    # every reference to a block as (container block, byte offset of the 32 bit pointer)
+    # container is None for pointers stored in the inode table (which never moves)
+    refs = []
+    xattr_blocks = set()
+    used_dirs = 0
+    free_inodes = 0
+    ibitmap = block(inode_bitmap)
+
+    def walk(container, offset, level, what):
+        n, = struct.unpack_from("<I", image, offset)
+        if n == 0:
+            return
+        use(n, what)
+        refs.append((container, offset))
+        if level:
+            for i in range(block_size // 4):
+                walk(n, n * block_size + 4 * i, level - 1, what)
+
+    for ino in range(1, inodes_count + 1):
+        if not ibitmap[(ino - 1) // 8] & (1 << ((ino - 1) % 8)):
+            free_inodes += 1
+            continue
+        offset = inode_table * block_size + (ino - 1) * inode_size
+        mode, = struct.unpack_from("<H", image, offset)
+        size_lo, = struct.unpack_from("<I", image, offset + 4)
+        links_count, = struct.unpack_from("<H", image, offset + 26)
+        i_blocks, = struct.unpack_from("<I", image, offset + 28)
+        file_acl, = struct.unpack_from("<I", image, offset + 104)
+        if ino >= first_ino and links_count == 0:
+            continue
+        what = f"inode {ino}"
+
+        if mode & S_IFMT == S_IFDIR:
+            used_dirs += 1
+        if file_acl:
+            # xattr blocks may be shared between inodes
+            if file_acl not in xattr_blocks:
+                use(file_acl, what)
+                xattr_blocks.add(file_acl)
+            refs.append((None, offset + 104))
+            i_blocks -= block_size // 512
+
+        if ino == EXT2_RESIZE_INO and reserved_gdt_blocks:
+            # only the double indirect block belongs to the resize inode,
+            # it points to the reserved GDT blocks already accounted above
+            walk(None, offset + 40 + 4 * (EXT2_NDIR_BLOCKS + 1), 0, what)
+            continue
+        if mode & S_IFMT not in (S_IFDIR, S_IFREG, S_IFLNK) and ino >= first_ino:
+            # devices, fifos and sockets don't have any block
+            continue
+        if mode & S_IFMT == S_IFLNK and i_blocks == 0 and size_lo < 4 * EXT2_N_BLOCKS:
+            # fast symlink: the target is stored in i_block
+            continue
+        for i in range(EXT2_N_BLOCKS):
+            walk(None, offset + 40 + 4 * i, max(0, i - EXT2_NDIR_BLOCKS + 1), what)
+
+    # relocate the blocks above the new limit
+    free = (n for n in range(first_data_block, new_blocks_count) if not owner[n])
+    moved = {}
+    for n in range(new_blocks_count, blocks_count):
+        if owner[n]:
+            moved[n] = next(free, None)
+            if moved[n] is None:
+                raise ValueError(f"not enough free space to shrink to {new_blocks_count} blocks")
+            owner[moved[n]] = 1
+            block(moved[n])[:] = block(n)
+
+    for container, offset in refs:
+        if container in moved:
+            offset += (moved[container] - container) * block_size
+        n, = struct.unpack_from("<I", image, offset)
+        if n in moved:
+            struct.pack_into("<I", image, offset, moved[n])
+
+    # rebuild the block bitmap. Bits beyond the end of the filesystem are set.
+    bbitmap = block(block_bitmap)
+    bbitmap[:] = b"\0" * block_size
+    for n in range(first_data_block, block_size * 8 + first_data_block):
+        if n >= new_blocks_count or owner[n]:
+            bbitmap[(n - first_data_block) // 8] |= 1 << ((n - first_data_block) % 8)
+    free_blocks = new_blocks_count - first_data_block - sum(owner[first_data_block:new_blocks_count])
+
+    struct.pack_into("<IIII", sb, 4, new_blocks_count, r_blocks_count * new_blocks_count // blocks_count,
+                     free_blocks, free_inodes)
+    struct.pack_into("<H", sb, 58, EXT2_VALID_FS)
+    struct.pack_into("<HHH", gd, 12, free_blocks, free_inodes, used_dirs)
+    return len(moved)
+
+
+def uboot_env_build(env):
     """
-        Search for 'search' pattern in 'text' and replace by 'replace'
-        Raise a KeyError if 'search' is not found.
+        Return the UBOOT_ENV_SIZE bytes U-Boot environment block (CRC32 + entries)
+        for the 'env' dict.
+        Raise a ValueError if the variables don't fit.
     """
-    result = re.sub(search, replace, text)
-    if result == text:
-        raise KeyError(f"'{search}' not found in '{text}'")
-    return result
+    body = b"".join(f"{key}={value}".encode("latin-1") + b"\0" for key, value in env.items()) + b"\0"
+    if len(body) > UBOOT_ENV_SIZE - 4:
+        raise ValueError(f"U-Boot environment too large ({len(body)} bytes)")
+    body += b"\0" * (UBOOT_ENV_SIZE - 4 - len(body))
+    return struct.pack("<I", zlib.crc32(body)) + body
 
 
-def try_shell_cmd(cmd, on_error=None):
+def uboot_env_apply_script(env, script):
+    """
+        Apply a fw_setenv script to the 'env' dict.
+        Each line is 'key value' (u-boot-tools syntax) or 'key=value' (libubootenv syntax).
+        A key without value deletes the variable. Lines starting with '#' are ignored.
     """
-        Execute 'cmd' just to see if it returns 0 (and everything is fine) 
-        or something else due to:
-        - missing executable
-        - wrong executable version
+    for line in script.split("\n"):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        m = re.match(r"([^=\s]+)[=\s]?(.*)", line)
+        key, value = m.group(1), m.group(2).strip()
+        if value:
+            env[key] = value
+        else:
+            env.pop(key, None)
 
-        if 'on_error' is not None, display the 'on_error' message and exit
 
-        Return True is success, False otherwise
+def ext2_usage(superblock):
+    """
+        Return the bytes used by the ext2 filesystem of the 'superblock' (1024 bytes
+        read at offset 1024), or None if not an ext2 filesystem
     """
     try:
-        subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-        return True
-    except:
-        if on_error:
-            print(on_error)
-            exit(1)
-        return False
+        ext = Ext2Superblock(superblock)
+    except ValueError:
+        return None
+    return (ext.blocks_count - ext.free_blocks_count) * ext.block_size
 
 
+def plan_layouts(kernel_size, initrd_size, kernel_move, nas_usage, headroom,
+                 flash_size=FLASH_SIZE, erasesize=LEGACY_ERASESIZE, drop_nas_config=False, keep_kernel=False):
+    """
+        Return the layouts able to hold a 'kernel_size' kernel and a 'initrd_size'
+        initrd plus 'headroom' (ratio of their size, and at least KERNEL_MARGIN for the
+        kernel), fewest erase blocks to write first, then largest kernel partition first.
+
+        'kernel_move' is the size of the current kernel (moved if the 'Kernel' partition
+        moves), 'nas_usage' the bytes used in 'NAS config' (None if not ext2): it
+        must fit in NAS_CONFIG_FS_SIZE to shrink 'NAS config', unless 'drop_nas_config'.
+        The layout keeping the legacy 2MB 'Kernel' is only considered with 'keep_kernel'.
+    """
+    layouts = []
+    for kernel_offset in range(NAS_CONFIG_OFFSET + NEW_NAS_CONFIG_SIZE, LEGACY_KERNEL_OFFSET + erasesize, erasesize):
+        layout = Layout(kernel_offset, kernel_move, flash_size, erasesize)
+        if not layout.moved and not keep_kernel:
+            continue
+        if layout.kernel_size < kernel_size + max(kernel_size * headroom, KERNEL_MARGIN) \
+                or layout.rootfs_size < initrd_size * (1 + headroom):
+            continue
+        if layout.moved and not drop_nas_config and (nas_usage is None or nas_usage > NAS_CONFIG_FS_SIZE):
+            continue
+        layouts.append(layout)
+    return sorted(layouts, key=lambda layout: (layout.erase_blocks(), -layout.kernel_size))
 
 
-parser = argparse.ArgumentParser(
-        description='Tool to resize QNAP mtd partitions in order to increase the kernel and rootfs size'
-        )
+def plan_inputs(mtds):
+    """
+        Read what the layout planning needs from the legacy partitions 'mtds' (see prepare):
+        return a tuple (kernel size, initrd size, 'NAS config' usage). The sizes are the
+        partition sizes when there is no uImage, the usage is None if not ext2.
+    """
+    kernel = mtds["Kernel"]
+    rootfs = mtds["RootFS1"]
+    kernel_size = uimage_size(kernel.read(0, UIMAGE_HEADER_SIZE)) or kernel.size
+    initrd_size = uimage_size(rootfs.read(0, UIMAGE_HEADER_SIZE)) or rootfs.size
+    return (min(kernel_size, kernel.size), min(initrd_size, rootfs.size),
+            ext2_usage(mtds["NAS Config"].read(1024, 1024)))
 
-parser.add_argument("--dry-run", action="store_true", help="Don't modify the flash content")
-parser.add_argument("--skip-bootargs", action="store_true", help="[WARNING] Don't patch bootargs. --setenv-script also required")
-parser.add_argument("--skip-bootcmd", action="store_true", help="[WARNING] Don't patch bootcmd. --setenv-script also required")
-parser.add_argument("--setenv-script-append", metavar="FILE", help="""
-    Additional setenv script to append in addition to the bootargs and bootcmd patching.
-    (see man fw_setenv)")
-    """)
-parser.add_argument("--drop-nas-config", action="store_true", help="""
-    Don't try to resize 'NAS config' partition and drop its content.
-    (Useful if e2fsck keeps failing and the partition is not recoverable)")
-    """)
 
-args = parser.parse_args()
+def plan_layout(mtds, args, flash_size=FLASH_SIZE):
+    """
+        Return the layouts for the legacy partitions 'mtds' (see prepare) and the layout
+        options of 'args' (--kernel-size, --initrd-size, --headroom, --keep-kernel), best first.
+        Raise a ResizeError if no layout fits.
+    """
+    kernel_size, initrd_size, nas_usage = plan_inputs(mtds)
+    print(f"   Kernel: {kernel_size} bytes, initrd: {initrd_size} bytes, 'NAS config' usage: "
+          + (f"{nas_usage} bytes" if nas_usage is not None else "not ext2"))
+    layouts = plan_layouts(max(kernel_size, args.kernel_size or 0), max(initrd_size, args.initrd_size or 0),
+                           kernel_size, nas_usage, args.headroom / 100, flash_size,
+                           mtds["Kernel"].erasesize, args.drop_nas_config, args.keep_kernel)
+    if not layouts:
+        raise ResizeError("No partition layout can hold the kernel and initrd with the requested headroom")
+    return layouts
+
+
+def new_mtdparts(mtd_master, layout=DEFAULT_LAYOUT):
+    """
+        Return the mtdparts definition of the new layout for the 'mtd_master' device
+    """
+    return layout.mtdparts(mtd_master)
 
 
-if (args.skip_bootargs or args.skip_bootcmd) and (not args.setenv_script_append):
-    print("--skip-bootargs and --skip-bootcmd require to also use --setenv-script-append option to provide the proper final settings for bootargs and bootcmd")
-    print("Use and empty file if you definitely don't want to modify bootargs or bootcmd")
-    exit(1)
+def run_tasks(tasks, workers=4):
+    """
+        Run the 'tasks' {name: (function, dependencies)} on a thread pool, each one as soon as
+        the tasks named in 'dependencies' are done, called with their results as arguments.
+        Return the {name: result} and {name: wall time} dicts once every task is done.
+        The exception of a failed task is raised again once the running tasks are finished
+        (the tasks not started yet are dropped).
+    """
+    import concurrent.futures
+    results = {}
+    times = {}
+    pending = dict(tasks)
+    running = {}
+    error = None
+
+    def timed(name, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            times[name] = round(time.perf_counter() - start, 6)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        while True:
+            if error is None:
+                for name, (function, dependencies) in list(pending.items()):
+                    if all(dependency in results for dependency in dependencies):
+                        del pending[name]
+                        future = pool.submit(timed, name, function, *(results[dependency] for dependency in dependencies))
+                        running[future] = name
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    error = error or e
+    if error:
+        raise error
+    return results, times
+
+
+def prepare(mtds, mtd_master, args, report, flash_size=FLASH_SIZE):
+    """
+        Prepare everything required to resize the partitions, without writing anything.
 
+        'mtds' maps the legacy partition names ("Kernel", "RootFS1", "NAS Config", "U-Boot Config")
+        to MtdDevice-like objects. 'args' gives the resize options (see the argument parser):
+        the new layout is DEFAULT_LAYOUT, or planned for a 'flash_size' chip with --auto-layout.
+        The phases are recorded in 'report' (see Report).
 
+        Return a tuple (steps, uboot_env_new, manifest) where 'steps' is the list of
+        (name, title, mtd, flash offset, image) flash operations to perform in this order and
+        'manifest' the block manifest of the resulting regions (see manifest_build).
+        Raise a ResizeError if the resize can't be done.
+    """
+    kernel = mtds["Kernel"]
+    nas_config = mtds["NAS Config"]
+    uboot_config = mtds["U-Boot Config"]
+
+    # check if the MTD kernel and rootfs1 are not already resized
+    if kernel.size != LEGACY_KERNEL_SIZE:
+        raise ResizeError("Kernel has already been resized. Can't process further safely.")
+    if mtds["RootFS1"].size != LEGACY_ROOTFS1_SIZE:
+        raise ResizeError("RootFS1 has already been resized. Can't process further safely.")
+    if nas_config.size != LEGACY_NAS_CONFIG_SIZE:
+        raise ResizeError("'NAS config' has already been resized. Can't process further safely.")
+
+    setenv_script_append_content = None
+    if args.setenv_script_append:
+        try:
+            setenv_script_append_content = open(args.setenv_script_append).read()
+        except OSError:
+            raise ResizeError(f"Failed to read {args.setenv_script_append}")
+
+    layout = DEFAULT_LAYOUT
+    if args.auto_layout:
+        print("\n[Plan the partition layout writing the fewest erase blocks]")
+        with report.phase("layout plan"):
+            layout = plan_layout(mtds, args, flash_size)[0]
+        print(f"   Kernel at 0x{layout.kernel_offset:x} ({layout.kernel_size // 1024}KB), "
+              f"{layout.erase_blocks()} erase block(s) to write")
+
+    ###################################################################
+    print("\n[Dump current U-boot config', 'NAS config' and 'Kernel' images]")
+    # The independent reads and the 'NAS config' check + shrink run concurrently (see
+    # run_tasks), so the CPU work overlaps the SPI reads. Nothing is printed nor used
+    # before all of them are done.
+    #
+    # 'NAS config' and 'Kernel' are read into a single staging buffer, holding the flash
+    # content from 0xc0000 (legacy 'NAS config') to 0x400000 (end of legacy 'Kernel'):
+    #
+    #   0x0c0000      0x100000      0x200000                    0x400000
+    #   | NAS config  :             | Kernel                    |
+    #   | NAS |       | Kernel (moved)             |            |
+    #
+    # The NAS config is resized in place, the kernel is moved down to the new 'Kernel'
+    # partition, and the flashed images are only memoryview slices of this buffer.
+    def nas_config_resize(_):
+        try:
+            return ext2_shrink(nas_config_dump, NAS_CONFIG_FS_SIZE)
+        except ValueError as e:
+            raise ResizeError(f"'NAS config' ext2 check failed: {e}\n"
+                              "'NAS config' resize not possible automatically")
+
+    # keep the whole erase block: the env is written back with a single erase + program
+    tasks = {"env dump": (lambda: bytearray(uboot_config.read(0, uboot_config.erasesize)), ())}
+    if args.exact_copy and not args.skip_bootcmd:
+        tasks["initrd header"] = (lambda: mtds["RootFS1"].read(0, UIMAGE_HEADER_SIZE), ())
+    if layout.moved:
+        staging = staging_buffer(LEGACY_NAS_CONFIG_SIZE + LEGACY_KERNEL_SIZE)
+        nas_config_dump = staging[:LEGACY_NAS_CONFIG_SIZE]
+        kernel_dump = staging[LEGACY_NAS_CONFIG_SIZE:]
+        tasks["NAS config dump"] = (lambda: nas_config.readinto(0, nas_config_dump), ())
+        tasks["kernel dump"] = (lambda: kernel.readinto(0, kernel_dump), ())
+        if not args.drop_nas_config:
+            tasks["NAS config resize"] = (nas_config_resize, ("NAS config dump",))
+    elif args.exact_copy and not args.skip_bootcmd:
+        tasks["kernel header"] = (lambda: kernel.read(0, UIMAGE_HEADER_SIZE), ())
+
+    with report.phase("image dump"):
+        results, task_times = run_tasks(tasks)
+    report.info.setdefault("prepare_tasks", {}).update(task_times)
+
+    uboot_config_block = results["env dump"]
+    try:
+        uboot_env = uboot_env_parse(uboot_config_block)
+    except ValueError as e:
+        raise ResizeError(str(e))
+    try:
+        bootcmd = uboot_env["bootcmd"]
+        bootargs = uboot_env["bootargs"]
+    except KeyError:
+        raise ResizeError("Missing 'bootcmd' or 'bootargs' in U-Boot Config")
+
+    print("Current U-boot bootcmd:\n   ", bootcmd)
+    print("Current U-boot bootargs:\n   ", bootargs)
+
+    mtdparts = new_mtdparts(mtd_master, layout)
+
+    ###################################################################
+    if args.skip_bootcmd:
+        print("\n[Skipping 'bootcmd patching']")
+        print("You should manual modify the uboot env variable to let uboot load:")
+        print("  - load the 3MB kernel image from flash (bus address 0xf8100000) to memory at address 0x800000")
+        print("  - load the 12MB initrf image from flash (bus address 0xf8400000) to memory at address 0xb00000")
+    else:
+        print("\n[Prepare new 'bootcmd']")
+        if args.exact_copy:
+            kernel_size = uimage_size(kernel_dump[:UIMAGE_HEADER_SIZE] if layout.moved else results["kernel header"])
+            initrd_size = uimage_size(results["initrd header"])
+            if kernel_size is None or initrd_size is None:
+                raise ResizeError("--exact-copy: no valid uImage header in 'Kernel' or 'RootFS1'")
+            bootcmd_new = patch_bootcmd(bootcmd, layout, kernel_size, initrd_size)
+        else:
+            bootcmd_new = patch_bootcmd(bootcmd, layout)
+        print("   Old:", bootcmd)
+        print("   New:", bootcmd_new)
+
+    ###################################################################
+    if args.skip_bootargs:
+        print("\n[Skipping 'bootargs patching']")
+        print("You should manual modify the uboot env variable to add the following lines to your kernel cmdline/bootagrgs:")
+        print(f' cmdlinepart.mtdparts={mtdparts} mtdparts={mtdparts}')
+    else:
+        print("\n[Prepare new 'bootargs']")
+        bootargs_new = patch_bootargs(bootargs, mtdparts, layout)
+        print("   Old:", bootargs)
+        print("   New:", bootargs_new)
+
+    ###################################################################
+    print("\n[Prepare new U-boot environment]")
+
+    uboot_env_new = dict(uboot_env)
+
+    if not args.skip_bootargs:
+        uboot_env_new["bootargs_backup"] = bootargs
+        uboot_env_new["bootargs"] = bootargs_new
+
+    if not args.skip_bootcmd:
+        uboot_env_new["bootcmd_backup"] = bootcmd
+        uboot_env_new["bootcmd"] = bootcmd_new
+
+    if setenv_script_append_content is not None:
+        print(f"Append {args.setenv_script_append}")
+        uboot_env_apply_script(uboot_env_new, setenv_script_append_content)
 
-if args.setenv_script_append:
     try:
-        setenv_script_append_content = open(args.setenv_script_append).read()
-    except:
-        print(f"Failed to read {args.setenv_script_append}")
-        exit(1)
+        uboot_config_block[:UBOOT_ENV_SIZE] = uboot_env_build(uboot_env_new)
+    except ValueError as e:
+        raise ResizeError(str(e))
+
+    offsets = {name: offset for name, offset, _ in LEGACY_LAYOUT}
+    steps = []
+    regions = [("U-Boot_Config", offsets["U-Boot Config"], uboot_config_block)]
+    if not layout.moved:
+        print("\n[Kernel stays at 0x200000: 'NAS config' and 'Kernel' are not modified]")
+        steps.append(("env write", "Change U-boot config with new values)",
+                      uboot_config, offsets["U-Boot Config"], uboot_config_block))
+        return steps, uboot_env_new, manifest_build(regions, kernel.erasesize)
+
+    ###################################################################
+    if args.drop_nas_config:
+        print("[--drop-nas-config => don't try to resize 'NAS config']")
+    else:
+        print(f"[Resize 'NAS config' dump from 1280KB to {layout.nas_config_size // 1024}KB.]")
+        print(f"   ext2 filesystem shrunk to {NAS_CONFIG_FS_SIZE // 1024}KB ({results['NAS config resize']} blocks moved)")
+
+    ###################################################################
+    print(f"\n[Move the first {layout.kernel_move // 1024}KB of Kernel to 0x{layout.kernel_offset:x}]")
+    erasesize = kernel.erasesize
+    kernel_start = layout.kernel_offset - NAS_CONFIG_OFFSET
+    kernel_end = kernel_start + layout.kernel_move
+    with report.phase("image prep"):
+        # forward copy, one erase block at a time: the destination is at least
+        # one erase block before the source
+        for offset in range(0, layout.kernel_move, erasesize):
+            staging[kernel_start + offset:kernel_start + offset + erasesize] = \
+                staging[LEGACY_NAS_CONFIG_SIZE + offset:LEGACY_NAS_CONFIG_SIZE + offset + erasesize]
+        nas_config_new = staging[:LEGACY_NAS_CONFIG_SIZE]
+        kernel_tail = staging[LEGACY_NAS_CONFIG_SIZE:max(kernel_end, LEGACY_NAS_CONFIG_SIZE)]
+
+    steps.append(("flash NAS config", "Flash 'NAS config' partition content (ie 'NAS config' + head of Kernel) (still a 'safe' op)",
+                  nas_config, offsets["NAS Config"], nas_config_new))
+    steps.append(("env write", "Change U-boot config with new values)", uboot_config, offsets["U-Boot Config"], uboot_config_block))
+    if len(kernel_tail):
+        steps.append(("flash kernel tail", "Flash tail of the kernel in old 'Kernel' Partition",
+                      kernel, offsets["Kernel"], kernel_tail))
+
+    # what the new partitions must contain once flashed
+    regions.append(("NAS_Config", NAS_CONFIG_OFFSET, staging[:NEW_NAS_CONFIG_SIZE]))
+    regions.append(("Kernel", layout.kernel_offset, staging[kernel_start:min(kernel_end, LEGACY_NAS_CONFIG_SIZE)]))
+    if len(kernel_tail):
+        regions.append(("Kernel_legacy", LEGACY_KERNEL_OFFSET, kernel_tail))
+    manifest = manifest_build(regions, erasesize)
+    return steps, uboot_env_new, manifest
+
+
+def manifest_build(regions, erasesize):
+    """
+        Return the block manifest of 'regions', a list of (name, flash offset, image)
+        where 'name' is the partition of the new layout holding 'image' at its
+        beginning: the CRC32 of every 'erasesize' block of each image.
+    """
+    manifest = {
+        "version": 1,
+        "hash": "crc32",
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "regions": [],
+        }
+    for name, offset, image in regions:
+        image = memoryview(image)
+        manifest["regions"].append({
+            "name": name,
+            "offset": offset,
+            "erasesize": erasesize,
+            "crc32": [zlib.crc32(image[i:i+erasesize]) for i in range(0, len(image), erasesize)],
+            })
+    return manifest
+
+
+def manifest_save(manifest, path):
+    with open(path, "w") as F:
+        json.dump(manifest, F)
+        F.write("\n")
+    print(f"Block manifest: {path}")
+
+
+def manifest_verify(manifest, partitions):
+    """
+        Rehash the erase blocks listed in 'manifest' (see manifest_build) and
+        report the ones that don't match.
+
+        'partitions' is a list of (name, flash offset, mtd) with MtdDevice-like
+        'mtd' objects. A region is read from the partition holding its flash
+        offset range, or from the partition of the same name when offsets are
+        unknown (None).
+        Return the number of mismatching erase blocks.
+    """
+    mismatches = 0
+    buffer = None
+    for region in manifest["regions"]:
+        erasesize = region["erasesize"]
+        length = erasesize * len(region["crc32"])
+        for name, offset, mtd in partitions:
+            if offset is not None and offset <= region["offset"] and region["offset"] + length <= offset + mtd.size:
+                start = region["offset"] - offset
+                break
+        else:
+            for name, offset, mtd in partitions:
+                if MtdTopology.key(name) == MtdTopology.key(region["name"]) and length <= mtd.size:
+                    start = 0
+                    break
+            else:
+                raise ResizeError(f"No partition holding '{region['name']}' (flash offset 0x{region['offset']:x})")
+
+        if buffer is None or len(buffer) != erasesize:
+            buffer = bytearray(erasesize)
+        failed = 0
+        for i, crc in enumerate(region["crc32"]):
+            mtd.readinto(start + i * erasesize, buffer)
+            if zlib.crc32(buffer) != crc:
+                print(f"   {region['name']} 0x{i * erasesize:06x} ({mtd} 0x{start + i * erasesize:06x}): CRC mismatch")
+                failed += 1
+        print(f"   {region['name']}: {len(region['crc32']) - failed}/{len(region['crc32'])} erase block(s) OK")
+        mismatches += failed
+    return mismatches
+
+
+def verify(args, report):
+    """
+        Check the flash content (running device or --image flash file) against the
+        block manifest saved by the resize.
+        Raise a ResizeError on mismatches.
+    """
+    path = args.manifest or MANIFEST_PATH
+    try:
+        with open(path) as F:
+            manifest = json.load(F)
+    except (OSError, ValueError) as e:
+        raise ResizeError(f"Can't load the block manifest: {e}")
 
+    partitions = (FileDevice(args.image) if args.image else LiveDevice()).partitions()
+    report.mtds = [mtd for _, _, mtd in partitions]
 
-###################################################################
-print("\n[Check of the QNAP model and see if supported]")  
-try:
-    dtb_file = subprocess.check_output(["/usr/share/flash-kernel/dtb-probe/kirkwood-qnap"]).strip().decode()
-except FileNotFoundError:
-    print("'flash-kernel' package is not installed. Are you really running this script from a QNAP ?")
-    exit(1)
-except subprocess.CalledProcessError:
-    print("You are not running this script from a supported QNAP device.")
-    exit(1)
-    
-# check if dtb_file is none
-print("DTB file:", dtb_file)
-
-if dtb_file not in TESTED_QNAP_DTB:
-    print("Partition resize was not tested on this device yet. Do you want to continue ? (y/N)")
-    resp = sys.stdin.readline()
-    if resp.strip().upper() != 'Y':
-        print("Abort.")
-        exit(1)
+    print(f"[Verify flash content against {path}]")
+    with report.phase("verify"):
+        mismatches = manifest_verify(manifest, partitions)
+    if mismatches:
+        raise ResizeError(f"{mismatches} erase block(s) don't match the manifest")
+    print("OK")
 
-    print("In case of success, please report the DTB file indication.")
-    print("\n"*3)
 
+def gzip_open(path, mode):
+    import gzip
+    return gzip.open(path, mode, compresslevel=6)
 
-    
-# check if the MTD kernel and rootfs1 are not already resized
-mtd_kernel, size, _ = mtd_lookup("Kernel")
-if size != 0x200000:
-    print("Kernel has already been resized. Can't process further safely.")
-    exit(1)
-    
-mtd_rootfs1, size, _ = mtd_lookup("RootFS1")
-if size != 0x900000:
-    print("RootFS1 has already been resized. Can't process further safely.")
-    exit(1)
- 
- 
-mtd_nas_config, size, _ = mtd_lookup("NAS Config", "NAS_Config")
-if size != 0x00140000:
-    print("'NAS config' has already been resized. Can't process further safely.")
-    exit(1)
-    
-mtd_uboot_config, _, _ = mtd_lookup("U-Boot Config", "U-Boot_Config")
 
+def xz_open(path, mode):
+    import lzma
+    return lzma.open(path, mode)
 
 
-# add /sbin and /usr/sbin in the PATH to be sure tools like flashcp can be found
-os.environ["PATH"] += ":/sbin:/usr/sbin"
-    
-# early check of required tools to see if we have all of them
-for tool_cmd in [
-        "flashcp -V", 
-        "flash_erase --version", 
-        ]:
-    print("Checking:", tool_cmd)
-    try_shell_cmd(tool_cmd, on_error=f"'{tool_cmd}' Failed. Please see manually if correctly installed")
+# backup compression: file extension and open() function
+BACKUP_COMPRESSION = {
+    "none": ("", open),
+    "gzip": (".gz", gzip_open),
+    "xz": (".xz", xz_open),
+    }
+# number of erase blocks the backup reader can be ahead of the compressor
+BACKUP_QUEUE_DEPTH = 4
 
-        
 
-# check if fw_setenv is coming from "libubootenv-tool" package (bullseye) or "u-boot-tools" package (buster)
-# There are some little differences to take in count
-if (    try_shell_cmd("fw_setenv -v") and 
-        try_shell_cmd("fw_setenv -h 2>&1 | grep 'Modify variables in U-Boot environment' -q") and 
-        try_shell_cmd("fw_setenv -h 2>&1 | grep -q -- --lock")
-        ):
-    print("Using 'u-boot-tools' package")
-    has_libubootenv = False
-    try_shell_cmd("fw_printenv -v", on_error="'fw_printenv -v' Failed. Please see manually if correctly installed")
-elif (try_shell_cmd("fw_setenv -V") and 
-        try_shell_cmd("fw_setenv -h 2>&1 | grep -q -- --defenv")
-        ):
-    print("Using 'libubootenv-tool' package")
-    has_libubootenv = True
-    try_shell_cmd("fw_printenv -V", on_error="'fw_printenv -V' Failed. Please see manually if correctly installed")
-else:
-    print("'fw_setenv' is missing or its version can't be defined. Please see manually if correctly installed")
-    exit(1)
+def backup_partition(mtd, path, compression):
+    """
+        Stream the 'mtd' partition into the 'path' file compressed with 'compression'
+        (see BACKUP_COMPRESSION). Erase blocks are read by a separate thread, at most
+        BACKUP_QUEUE_DEPTH blocks ahead of the compression, and the erased ones
+        (all 0xff) are not stored.
 
+        Return the list of CRC32 of the erase blocks, None for the erased ones.
+    """
+    import queue
+    import threading
+    blocks = queue.Queue(BACKUP_QUEUE_DEPTH)
+
+    def reader():
+        try:
+            for offset in range(0, mtd.size, mtd.erasesize):
+                block = bytearray(mtd.erasesize)
+                mtd.readinto(offset, block)
+                blocks.put(block)
+            blocks.put(None)
+        except Exception as e:
+            blocks.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    erased = b"\xff" * mtd.erasesize
+    crcs = []
+    with BACKUP_COMPRESSION[compression][1](path, "wb") as F:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            if block == erased:
+                crcs.append(None)
+            else:
+                crcs.append(zlib.crc32(block))
+                F.write(block)
+    thread.join()
+    return crcs
+
+
+def backup(partitions, target, compression, report):
+    """
+        Save every partition of 'partitions' (see LiveDevice.partitions) into the 'target'
+        directory, with a 'manifest.json' file describing the backup for 'restore'
+        and the U-Boot environment as text in 'uboot_env.txt'.
+        The I/O of each partition is accounted in its 'backup NAME' phase of 'report'.
+    """
+    print(f"\n[Backup MTD partitions into {target}]")
+    os.makedirs(target, exist_ok=True)
+    extension = BACKUP_COMPRESSION[compression][0]
+    manifest = {
+        "version": 1,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "compression": compression,
+        "partitions": [],
+        }
+    for i, (name, offset, mtd) in enumerate(partitions):
+        filename = f"mtd{i}.{MtdTopology.key(name)}.bin{extension}"
+        # account this partition only: report.mtds may hold other objects for the same
+        # devices (the resize ones)
+        mtds = report.mtds
+        report.mtds = [mtd]
+        try:
+            with report.phase(f"backup {name}"):
+                crcs = backup_partition(mtd, os.path.join(target, filename), compression)
+        finally:
+            report.mtds = mtds
+        stored = sum(1 for crc in crcs if crc is not None)
+        print(f"   {mtd} '{name}' -> {filename} ({stored}/{len(crcs)} erase block(s) stored)")
+        manifest["partitions"].append({
+            "name": name,
+            "offset": offset,
+            "size": mtd.size,
+            "erasesize": mtd.erasesize,
+            "file": filename,
+            "crc32": crcs,
+            })
+
+        if MtdTopology.key(name) == "U-Boot_Config":
+            try:
+                uboot_env = uboot_env_parse(mtd.read(0, UBOOT_ENV_SIZE))
+                with open(os.path.join(target, "uboot_env.txt"), "w") as F:
+                    for key, value in uboot_env.items():
+                        F.write(f"{key}={value}\n")
+            except ValueError as e:
+                print(f"   Warning: no U-Boot environment text copy ({e})")
+
+    with open(os.path.join(target, "manifest.json"), "w") as F:
+        json.dump(manifest, F)
+        F.write("\n")
+    os.sync()
+    print(f"   Backup manifest: {os.path.join(target, 'manifest.json')}")
+
+
+def backup_blocks(backup_dir, entry, compression):
+    """
+        Yield the erase blocks of the partition 'entry' of a backup manifest (see backup)
+        in order, decompressed one at a time and checked against their CRC32.
+        The erased blocks, not stored, are yielded as 0xff blocks.
+        Raise a ResizeError if the backup is damaged.
+    """
+    import lzma
+    erasesize = entry["erasesize"]
+    erased = b"\xff" * erasesize
+    path = os.path.join(backup_dir, entry["file"])
+    try:
+        with BACKUP_COMPRESSION[compression][1](path, "rb") as F:
+            for i, crc in enumerate(entry["crc32"]):
+                if crc is None:
+                    yield erased
+                    continue
+                block = F.read(erasesize)
+                if len(block) != erasesize or zlib.crc32(block) != crc:
+                    raise ResizeError(f"{path}: erase block {i} is damaged")
+                yield block
+    except (OSError, EOFError, zlib.error, lzma.LZMAError) as e:
+        raise ResizeError(f"{path}: {e}")
+
+
+def backup_load(backup_dir, entry, compression):
+    """
+        Return the content of the partition 'entry' of a backup manifest (see backup_blocks)
+    """
+    return bytearray(b"".join(backup_blocks(backup_dir, entry, compression)))
 
-    
-# root ?
-if os.getuid() != 0:
-    print("You must be root.")
-    exit(1)
-    
-    
-    
-###################################################################
-print("\n[find on which MTD device partitions are currently mounted]")  
-mtd_master = None
-for line in subprocess.check_output(["dmesg"]).split(b"\n"):
-    line = line.decode(errors="ignore")
-    m = re.search(r'Creating [0-9]+ MTD partitions on "([^"]+)"', line)
-    if m:
-        mtd_master = m.group(1)
-    
-if not mtd_master:
-    print("Failed: no information found with dmesg")
-    exit(1)
-else:
-    print("  ", mtd_master)
-    
-    
-    
-###################################################################
-print("\n[Dump current U-boot config']")
-
-with open("/tmp/fw_env.config", "w") as F:
-    F.write(f"""# MTD device name       Device offset   Env. size       Flash sector size       Number of sectors
-/dev/{mtd_uboot_config}                 0x0000          0x1000           0x40000                 1
-""")
-
-uboot_env = {}
-for line in subprocess.check_output(["fw_printenv", "-c", "/tmp/fw_env.config"]).decode().split("\n"):
-    line = line.strip()
-    m = re.match(r"([a-zA-Z_0-9]+)=(.*)", line)
-    if m:
-        uboot_env[m.group(1)] = m.group(2)
-try:
-    bootcmd = uboot_env["bootcmd"]
-    bootargs = uboot_env["bootargs"]
-except KeyError:
-    print("Missing 'bootcmd' or 'bootargs' in U-Boot Config")
-    exit(1)
-    
-print("Current U-boot bootcmd:\n   ", bootcmd)
-print("Current U-boot bootargs:\n   ", bootargs)
 
-# detect the MTD device name
-# Creating 6 MTD partitions on "spi0.0"
+def flash_region(partitions, offset, image, dry_run=False, done=None, completed=()):
+    """
+        Write 'image' at the flash 'offset' through the partitions of 'partitions'
+        (see LiveDevice.partitions) holding this range. With overlapping partitions,
+        every flash range is written only once.
+        'done' and 'completed' use offsets in 'image' (see flash_image).
 
+        Return the tuple (written, skipped) of erase blocks counts.
+        Raise a ResizeError if a part of the range is not in any partition.
+    """
+    image = memoryview(image)
+    written = skipped = 0
+    position = offset
+    while position < offset + len(image):
+        for name, part_offset, mtd in partitions:
+            if part_offset is not None and part_offset <= position < part_offset + mtd.size:
+                break
+        else:
+            raise ResizeError(f"No partition holding flash offset 0x{position:x}")
+        length = min(offset + len(image), part_offset + mtd.size) - position
+        base = position - offset
+        print(f"+ {mtd} '{name}'")
+        w, s = flash_image(mtd, image[base:base + length], dry_run, position - part_offset,
+                           done=done and (lambda o, base=base: done(base + o)),
+                           completed={o - base for o in completed if base <= o < base + length})
+        written += w
+        skipped += s
+        position += length
+    return written, skipped
+
+
+def restore(args, device, report):
+    """
+        Write back the partitions saved by 'backup' in 'args.source' on 'device'
+        (see LiveDevice / FileDevice), by flash offset, so a backup of the legacy
+        layout can be restored on a resized device. Only the erase blocks that differ
+        are written. U-Boot is skipped unless --include-uboot.
 
-NEW_MTDPARTS=f"{mtd_master}:512k@0(uboot)ro,3M@0x100000(Kernel),12M@0x400000(RootFS1),2M@0x200000(Kernel_legacy),256k@0x80000(U-Boot_Config),256k@0xc0000(NAS_Config)"
+        The backup is checked completely before flashing, and then decompressed
+        again while flashing, one erase block at a time, to keep the memory use low.
+    """
+    try:
+        with open(os.path.join(args.source, "manifest.json")) as F:
+            manifest = json.load(F)
+    except (OSError, ValueError) as e:
+        raise ResizeError(f"Can't load the backup manifest: {e}")
+
+    partitions = device.partitions()
+    report.mtds = [mtd for _, _, mtd in partitions]
+    offsets_known = all(offset is not None for _, offset, _ in partitions)
+
+    entries = []
+    for entry in manifest["partitions"]:
+        if entry["offset"] is not None:
+            uboot = entry["offset"] == 0
+        else:
+            uboot = MtdTopology.key(entry["name"]).lower() in ("u-boot", "uboot")
+        if uboot and not args.include_uboot:
+            print(f"Skipping '{entry['name']}' (see --include-uboot)")
+            continue
+        entries.append(entry)
+
+    print("\n[Check the backup]")
+    with report.phase("backup check"):
+        for entry in entries:
+            for _ in backup_blocks(args.source, entry, manifest["compression"]):
+                pass
+    print(f"   {', '.join(entry['name'] for entry in entries)}: OK")
+
+    if isinstance(device, LiveDevice) and not args.yes:
+        print(f"\nRestore these partitions from the {manifest['created']} backup ? (y/N)")
+        if args.dry_run:
+            print("Note: You are using --dry-run option. No flash operations will be performed if you answer 'y'.")
+        resp = sys.stdin.readline()
+        if resp.strip().upper() != 'Y':
+            raise ResizeError("Abort.")
+
+    for entry in entries:
+        ###################################################################
+        print(f"\n[Restore '{entry['name']}']")
+        erasesize = entry["erasesize"]
+        if entry["offset"] is None or not offsets_known:
+            # no flash offsets: same partition name and size required
+            for name, _, target in partitions:
+                if MtdTopology.key(name) == MtdTopology.key(entry["name"]) and target.size == entry["size"]:
+                    break
+            else:
+                raise ResizeError(f"No '{entry['name']}' partition of {entry['size']} bytes to restore")
+        written = skipped = 0
+        current = None
+        with report.phase(f"restore {entry['name']}"):
+            for i, block in enumerate(backup_blocks(args.source, entry, manifest["compression"])):
+                if entry["offset"] is not None and offsets_known:
+                    mtd, offset = flash_locate(partitions, entry["offset"] + i * erasesize, erasesize)
+                else:
+                    mtd, offset = target, i * erasesize
+                if mtd.erasesize != erasesize:
+                    raise ResizeError(f"{mtd}: erase size 0x{mtd.erasesize:x}, the backup has 0x{erasesize:x}")
+                if mtd is not current:
+                    print(f"+ {mtd} '{next(name for name, _, m in partitions if m is mtd)}'")
+                    current = mtd
+                if flash_block(mtd, offset, block, args.dry_run, f"{i + 1}/{len(entry['crc32'])}"):
+                    written += 1
+                else:
+                    skipped += 1
+        print(f"   {written} erase block(s) {'to write' if args.dry_run else 'written'}, {skipped} skipped (already up to date)")
+
+    print("\nRestore done. Reboot to use the restored partitions.")
+
+
+def rollback(args, device, report):
+    """
+        Go back to the legacy layout with the backup made before the resize ('args.source',
+        the backup directory or its manifest.json, see 'backup'). Only the erase blocks
+        of the 0xc0000-0x400000 range ('NAS Config' and legacy 'Kernel') whose CRC32
+        differ from the backup manifest are written, and the legacy bootargs / bootcmd
+        are restored from their *_backup variables with a single U-Boot environment write.
+    """
+    if os.path.isdir(args.source):
+        backup_dir, manifest_path = args.source, os.path.join(args.source, "manifest.json")
+    else:
+        backup_dir, manifest_path = os.path.dirname(args.source), args.source
+    try:
+        with open(manifest_path) as F:
+            manifest = json.load(F)
+    except (OSError, ValueError) as e:
+        raise ResizeError(f"Can't load the backup manifest: {e}")
+    backup_env = None
+    if os.path.exists(os.path.join(backup_dir, "uboot_env.txt")):
+        with open(os.path.join(backup_dir, "uboot_env.txt")) as F:
+            backup_env = dict(line.rstrip("\n").partition("=")[::2] for line in F if "=" in line)
+    if resized_partitions(entry["name"] for entry in manifest["partitions"]) \
+            or (backup_env and layout_from_bootargs(backup_env.get("bootargs", "")) is not None):
+        raise ResizeError(f"{manifest_path}: this backup was made after the resize, not of the legacy layout")
+
+    if isinstance(device, LiveDevice):
+        with report.phase("tool checks"):
+            device.check()
+    partitions = device.partitions()
+    report.mtds = [mtd for _, _, mtd in partitions]
+    if any(offset is None for _, offset, _ in partitions):
+        raise ResizeError("The flash offsets of the partitions are unknown (no sysfs). Can't roll back safely.")
+
+    # CRC32 of the legacy erase blocks of the range, from the backup manifest
+    legacy_offsets = {MtdTopology.key(name): (offset, size) for name, offset, size in LEGACY_LAYOUT}
+    legacy = {}
+    for entry in manifest["partitions"]:
+        offset = entry["offset"]
+        if offset is None and legacy_offsets.get(MtdTopology.key(entry["name"]), (None, None))[1] == entry["size"]:
+            offset = legacy_offsets[MtdTopology.key(entry["name"])][0]
+        if offset is None:
+            continue
+        for i, crc in enumerate(entry["crc32"]):
+            block_offset = offset + i * entry["erasesize"]
+            if NAS_CONFIG_OFFSET <= block_offset < ROOTFS1_OFFSET:
+                legacy[block_offset] = (entry, i, crc, entry["erasesize"])
+    position = NAS_CONFIG_OFFSET
+    while position < ROOTFS1_OFFSET:
+        if position not in legacy:
+            raise ResizeError(f"{manifest_path}: flash offset 0x{position:x} is not in the backup "
+                              "('NAS Config' and 'Kernel' of the legacy layout are needed)")
+        position += legacy[position][3]
+
+    ###################################################################
+    print(f"\n[Compare 0x{NAS_CONFIG_OFFSET:x}-0x{ROOTFS1_OFFSET:x} with the {manifest['created']} backup]")
+    differing = []
+    with report.phase("flash compare"):
+        for block_offset, (entry, i, crc, erasesize) in sorted(legacy.items()):
+            mtd, mtd_offset = flash_locate(partitions, block_offset, erasesize)
+            block = mtd.read(mtd_offset, erasesize)
+            if crc is None and block != b"\xff" * erasesize or crc is not None and zlib.crc32(block) != crc:
+                differing.append(block_offset)
+    print(f"   {len(differing)}/{len(legacy)} erase block(s) differ")
+
+    ###################################################################
+    print("\n[Compare the U-Boot environment with the legacy one]")
+    uboot_config = device.mtd("U-Boot Config", "U-Boot_Config")
+    with report.phase("env dump"):
+        uboot_config_block = bytearray(uboot_config.read(0, uboot_config.erasesize))
+    try:
+        uboot_env = uboot_env_parse(uboot_config_block)
+    except ValueError as e:
+        raise ResizeError(str(e))
+    uboot_env_new = dict(uboot_env)
+    for key in ("bootargs", "bootcmd"):
+        if f"{key}_backup" in uboot_env_new:
+            uboot_env_new[key] = uboot_env_new.pop(f"{key}_backup")
+        elif backup_env and key in backup_env:
+            # --skip-bootargs / --skip-bootcmd resize: the backup has the legacy value
+            uboot_env_new[key] = backup_env[key]
+    if layout_from_bootargs(uboot_env_new.get("bootargs", "")) is not None:
+        raise ResizeError("No legacy 'bootargs' to restore (no bootargs_backup, nor uboot_env.txt in the backup)")
+    keys = [key for key in dict.fromkeys([*uboot_env, *uboot_env_new]) if uboot_env.get(key) != uboot_env_new.get(key)]
+    for key in keys:
+        print(f"   {key}: {uboot_env.get(key)!r} -> {uboot_env_new.get(key)!r}")
+    print(f"   {len(keys)} variable(s) to restore")
+    if backup_env:
+        for key in sorted(set(backup_env) | set(uboot_env_new)):
+            if backup_env.get(key) != uboot_env_new.get(key):
+                print(f"   Note: '{key}' differs from the backup, not changed")
+
+    if not differing and not keys:
+        print("\nThe flash is already in the legacy state.")
+        return
+
+    if isinstance(device, LiveDevice) and not args.yes:
+        print(f"\nRoll back to the legacy layout ({len(differing)} erase block(s) and the U-Boot environment) ? (y/N)")
+        if args.dry_run:
+            print("Note: You are using --dry-run option. No flash operations will be performed if you answer 'y'.")
+        resp = sys.stdin.readline()
+        if resp.strip().upper() != 'Y':
+            raise ResizeError("Abort.")
+
+    with report.phase("backup load"):
+        images = {}
+        for block_offset in differing:
+            entry, i, _, erasesize = legacy[block_offset]
+            if entry["file"] not in images:
+                images[entry["file"]] = backup_load(backup_dir, entry, manifest["compression"])
+    runs = []
+    for block_offset in differing:
+        entry, i, _, erasesize = legacy[block_offset]
+        block = images[entry["file"]][i * erasesize:(i + 1) * erasesize]
+        if runs and runs[-1][0] + len(runs[-1][1]) == block_offset != LEGACY_KERNEL_OFFSET:
+            runs[-1][1].extend(block)
+        else:
+            runs.append((block_offset, bytearray(block)))
+
+    # The legacy kernel goes first: the resized bootcmd falls back to the kernel at
+    # 0x200000 once the moved one is overwritten. Then the legacy environment boots
+    # it, and the 'NAS Config' range (holding the moved kernel) is written last.
+    ###################################################################
+    print(f"\n[Flash the legacy 'Kernel' at 0x{LEGACY_KERNEL_OFFSET:x}]")
+    with report.phase("flash kernel"):
+        for offset, image in runs:
+            if offset >= LEGACY_KERNEL_OFFSET:
+                flash_region(partitions, offset, image, args.dry_run)
+
+    ###################################################################
+    print("\n[Restore the legacy U-Boot environment]")
+    try:
+        uboot_config_block[:UBOOT_ENV_SIZE] = uboot_env_build(uboot_env_new)
+    except ValueError as e:
+        raise ResizeError(str(e))
+    with report.phase("env write"):
+        flash_image(uboot_config, uboot_config_block, dry_run=args.dry_run)
 
-    
-    
-   
-   
-###################################################################
-if args.skip_bootcmd:
-    print("\n[Skipping 'bootcmd patching']")
-    print("You should manual modify the uboot env variable to let uboot load:")
-    print("  - load the 3MB kernel image from flash (bus address 0xf8100000) to memory at address 0x800000")
-    print("  - load the 12MB initrf image from flash (bus address 0xf8400000) to memory at address 0xb00000")
-else:
-    print("\n[Prepare new 'bootcmd']")
+    ###################################################################
+    print(f"\n[Flash the legacy 'NAS Config' at 0x{NAS_CONFIG_OFFSET:x}]")
+    with report.phase("flash NAS config"):
+        for offset, image in runs:
+            if offset < LEGACY_KERNEL_OFFSET:
+                flash_region(partitions, offset, image, args.dry_run)
+
+    journal_path = args.journal or JOURNAL_PATH
+    journal = Journal.load(journal_path)
+    if journal and not journal.complete and not args.dry_run:
+        print(f"\nThe interrupted resize of {journal_path} is abandoned")
+        journal.finish()
+
+    print("\nRollback done. REBOOT to use the legacy partitions.")
+
+
+def fw_env_config_text(uboot_config):
+    """
+        Return the /etc/fw_env.config content for the 'uboot_config' MtdDevice
+    """
+    return f"""# MTD device name       Device offset   Env. size       Flash sector size       Number of sectors
+{uboot_config}                 0x0000          0x1000           0x40000                 1
+"""
+
+
+def bootcmd_hook_update(args, exact_copy):
+    """
+        Install the initramfs hook (BOOTCMD_HOOK_PATH) running 'update-bootcmd' after
+        every kernel or initramfs update when 'bootcmd' copies the exact uImage sizes:
+        a larger image would be truncated at boot. Remove it otherwise, so it doesn't
+        bring the exact copies back.
+        Nothing is written with --dry-run.
+    """
+    import shlex
+    hook = f"#!/bin/sh\nexec {shlex.quote(os.path.abspath(sys.argv[0]))} update-bootcmd\n"
     try:
-        if bootcmd.find("cp.l") >= 0:
-            # most common configuration
-            bootcmd_new = str_replace("cp.l 0xf8200000 0x800000 0x0*80000",
-                                      "cp.l 0xf8100000 0x800000 0xc0000", bootcmd)
-            bootcmd_new = str_replace("cp.l 0xf8400000 0xa00000 0x240000",
-                                      "cp.l 0xf8400000 0xb00000 0x300000", bootcmd_new)
-        elif bootcmd.find("cp.b") >= 0:
-            # some old configurations are using cp.b
-            bootcmd_new = str_replace("cp.b 0xf8200000 0x800000 0x200000",
-                                      "cp.b 0xf8100000 0x800000 0x300000", bootcmd)
-            bootcmd_new = str_replace("cp.b 0xf8400000 0xa00000 0x900000",
-                                      "cp.b 0xf8400000 0xb00000 0xc00000", bootcmd_new)
+        with open(BOOTCMD_HOOK_PATH) as F:
+            current = F.read()
+    except OSError:
+        current = None
+    if current == (hook if exact_copy else None):
+        return
+
+    ###################################################################
+    if exact_copy:
+        print(f"\n[Install {BOOTCMD_HOOK_PATH}: update the bootcmd copy lengths after each kernel or initramfs update]")
+    else:
+        print(f"\n[Remove {BOOTCMD_HOOK_PATH}: bootcmd copies the whole partitions]")
+    if args.dry_run:
+        return
+    try:
+        if exact_copy:
+            os.makedirs(os.path.dirname(BOOTCMD_HOOK_PATH), exist_ok=True)
+            with open(BOOTCMD_HOOK_PATH, "w") as F:
+                F.write(hook)
+            os.chmod(BOOTCMD_HOOK_PATH, 0o755)
         else:
-            raise KeyError("bootcmd not using 'cp.l' nor 'cp.b'")
-                                  
-        # in case of QNAP TFTPBOOT recovery (ie. pressing reset button during boot + running live-cd-20130730.iso from VM)
-        # uboot will:
-        # - flash the legacy kernel at flash offset 0x200000
-        # - flash the legacy rootfs at flash offset 0x400000
-        # - DOESN'T restore the original uboot env
-        # If we want to be able to boot after a QNAP TFTPBOOT recovery, our "bootcmd" must be able to fallback
-        # to a kernel at flash 0x200000 (which is loaded in memory at 0x900000 when we load ou 3MB kernel from flash 0x100000)
-        bootcmd_new += ";echo Kernel_legacy layout fallback;bootm 0x900000"
-    except KeyError as e:
-        print(str(e))
-        print("Don't know how to patch 'bootcmd' for this model. Please report this log.")
-        exit(1)
-        
-    print("   Old:", bootcmd)
-    print("   New:", bootcmd_new)
+            os.remove(BOOTCMD_HOOK_PATH)
+    except OSError as e:
+        raise ResizeError(f"Can't update {BOOTCMD_HOOK_PATH}: {e}")
 
 
-###################################################################
-if args.skip_bootargs:
-    print("\n[Skipping 'bootargs patching']")
-    print("You should manual modify the uboot env variable to add the following lines to your kernel cmdline/bootagrgs:")
-    print(f' cmdlinepart.mtdparts={NEW_MTDPARTS} mtdparts={NEW_MTDPARTS}')
-else:
-    print("\n[Prepare new 'bootargs']")
+def resize_finish(fw_env_config, manifest, args, install=True, exact_copy=False):
+    """
+        Last steps of a resize, once the new partitions are flashed:
+        install /etc/fw_env.config (if not already existing), the block manifest and,
+        for the 'exact_copy' bootcmd, the initramfs hook (see bootcmd_hook_update).
+        Without 'install' (a flash image file is resized, not this host), only what
+        would be installed is printed, and the manifest is only saved to --manifest.
+    """
+    ###################################################################
+    print("\n[Make a copy of /tmp/fw_env.config into /etc/fw_env.config (if not already existing)]")
+    if not install:
+        print("   Not the running device: /etc/fw_env.config of this host left untouched. It would be:")
+        print(fw_env_config)
+    elif not args.dry_run:
+        if not os.path.exists("/etc/fw_env.config"):
+            with open("/etc/fw_env.config", "w") as F:
+                F.write(fw_env_config)
+
+    ###################################################################
+    print("\n[Save the block manifest of the new partitions (see 'verify' command)]")
+    if not install and not args.manifest:
+        print(f"   Not the running device: not saved to {MANIFEST_PATH} (see --manifest)")
+    elif not args.dry_run:
+        manifest_save(manifest, args.manifest or MANIFEST_PATH)
+
+    if install:
+        bootcmd_hook_update(args, exact_copy)
+    elif exact_copy:
+        print(f"\n   Not the running device: install {BOOTCMD_HOOK_PATH} on the device (see 'update-bootcmd')")
+
+
+def resume(args, device, report):
+    """
+        Finish the resize interrupted while flashing, recorded in the journal
+        (see Journal): only the erase blocks not logged as completed are checked
+        against the flash content and written if needed.
+    """
+    path = args.journal or JOURNAL_PATH
+    journal = Journal.load(path)
+    if journal is None or journal.complete:
+        raise ResizeError(f"No interrupted resize to resume in {path}")
+    print(f"Resize journal: {path} ({journal.plan['created']})")
+
+    with report.phase("tool checks"):
+        device.check()
+
+    partitions = device.partitions()
+    report.mtds = [mtd for _, _, mtd in partitions]
+    if any(offset is None for _, offset, _ in partitions):
+        raise ResizeError("The flash offsets of the partitions are unknown (no sysfs). Can't resume safely.")
+
+    with report.phase("journal load"):
+        images = [journal.image(step) for step in journal.plan["steps"]]
+
+    for step, image in zip(journal.plan["steps"], images):
+        ###################################################################
+        completed = journal.completed.get(step["name"], set())
+        print(f"\n[{step['title']}]")
+        print(f"   {len(completed)} erase block(s) already written according to the journal")
+        with report.phase(step["name"]):
+            flash_region(partitions, step["offset"], image, args.dry_run,
+                         done=lambda offset, name=step["name"]: journal.done(name, offset), completed=completed)
+
+    resize_finish(journal.plan["fw_env_config"], journal.plan["manifest"], args, install=isinstance(device, LiveDevice),
+                  exact_copy=journal.plan.get("exact_copy", False))
+    if not args.dry_run:
+        journal.finish()
+
+    ###################################################################
+    print("-"*60)
+    print("""
+    SUCCESS. 
+
+    Now, REBOOT !
+    """)
+
+
+def layout(args, device, report):
+    """
+        Print the layouts able to hold the images of the legacy partitions of 'device'
+        (see LiveDevice / FileDevice), with the mtdparts, bootcmd and bootargs of
+        the best one (what --auto-layout does).
+    """
+    mtds = {
+        "Kernel": device.mtd("Kernel"),
+        "RootFS1": device.mtd("RootFS1"),
+        "NAS Config": device.mtd("NAS Config", "NAS_Config"),
+        "U-Boot Config": device.mtd("U-Boot Config", "U-Boot_Config"),
+        }
+    report.mtds = list(mtds.values())
+    if mtds["Kernel"].size != LEGACY_KERNEL_SIZE or mtds["NAS Config"].size != LEGACY_NAS_CONFIG_SIZE:
+        raise ResizeError("The partitions have already been resized.")
+    flash_size = chip_size(device.partitions())
+
+    print(f"[Plan the partition layout for a {flash_size // 0x100000}MB flash]")
+    with report.phase("layout plan"):
+        layouts = plan_layout(mtds, args, flash_size)
+        uboot_env = uboot_env_parse(mtds["U-Boot Config"].read(0, UBOOT_ENV_SIZE))
+
+    print(f"\n   {'Kernel@':>8} {'NAS Config':>10} {'Kernel':>8} {'RootFS1':>8} {'moved':>8} {'erase blocks':>12}")
+    for i, candidate in enumerate(layouts):
+        print(f" {'*' if i == 0 else ' '} 0x{candidate.kernel_offset:06x} {candidate.nas_config_size // 1024:>8}KB "
+              f"{candidate.kernel_size // 1024:>6}KB {candidate.rootfs_size // 1024:>6}KB "
+              f"{(candidate.kernel_move if candidate.moved else 0) // 1024:>6}KB {candidate.erase_blocks():>12}")
+
+    best = layouts[0]
+    mtdparts = new_mtdparts(device.mtd_master(), best)
+    print(f"\nmtdparts={mtdparts}")
+    print(f"bootcmd={patch_bootcmd(uboot_env.get('bootcmd', ''), best)}")
+    print(f"bootargs={patch_bootargs(uboot_env.get('bootargs', ''), mtdparts, best)}")
+
+
+# initramfs-tools compressors: (COMPRESS= value, compress command, decompress command,
+# magic of the compressed data, kernel config option to decompress the initrd)
+INITRAMFS_COMPRESSORS = [
+    ("gzip", ["gzip", "-n", "-9"], ["gzip", "-dc"], b"\x1f\x8b", "CONFIG_RD_GZIP"),
+    ("lzma", ["lzma", "-9"], ["lzma", "-dc"], b"\x5d\x00\x00", "CONFIG_RD_LZMA"),
+    ("xz", ["xz", "--check=crc32"], ["xz", "-dc"], b"\xfd7zXZ", "CONFIG_RD_XZ"),
+    ("lzop", ["lzop", "-9"], ["lzop", "-dc"], b"\x89LZO", "CONFIG_RD_LZO"),
+    ("lz4", ["lz4", "-9", "-l"], ["lz4", "-dc"], b"\x02\x21\x4c\x18", "CONFIG_RD_LZ4"),
+    ("zstd", ["zstd", "-q", "-19", "-T0"], ["zstd", "-dcq"], b"\x28\xb5\x2f\xfd", "CONFIG_RD_ZSTD"),
+    ]
+
+
+def initramfs_load(path):
+    """
+        Return the uncompressed cpio archive of the initramfs 'path' (a uImage header,
+        as in /boot/uInitrd, is skipped).
+        Raise a ResizeError if it can't be decompressed.
+    """
+    import subprocess
+    with open(path, "rb") as F:
+        data = F.read()
+    if uimage_size(data):
+        data = data[UIMAGE_HEADER_SIZE:uimage_size(data)]
+    if data.startswith(b"070701"):
+        return data
+    for name, _, decompress, magic, _ in INITRAMFS_COMPRESSORS:
+        if data.startswith(magic):
+            try:
+                return subprocess.run(decompress, input=data, stdout=subprocess.PIPE, check=True).stdout
+            except (OSError, subprocess.CalledProcessError) as e:
+                raise ResizeError(f"{path}: {name} decompression failed: {e}")
+    raise ResizeError(f"{path}: unknown initramfs compression")
+
+
+def compress_bench(args, report):
+    """
+        Compress the initramfs with every compressor of initramfs-tools available here
+        (and supported by the kernel), measure the compressed size, compression and
+        decompression times, and recommend the fastest to decompress fitting in RootFS1.
+        A compressor failing is reported and skipped. The decompression is timed with
+        the userspace tools, standing in for the kernel decompressor.
+    """
+    import shutil
+    import subprocess
+    release = os.uname().release
+    initramfs = args.initramfs or f"/boot/initrd.img-{release}"
+    rootfs_size = args.rootfs_size
+    if rootfs_size is None:
+        try:
+            rootfs_size = mtd_lookup("RootFS1")[1]
+        except (OSError, KeyError):
+            raise ResizeError("No RootFS1 MTD partition found: use --rootfs-size")
+
+    kernel_config = None
+    if os.path.exists(f"/boot/config-{release}"):
+        kernel_config = open(f"/boot/config-{release}").read()
+
+    print(f"[Load {initramfs}]")
+    with report.phase("initramfs load"):
+        cpio = initramfs_load(initramfs)
+    print(f"   {len(cpio)} bytes uncompressed, RootFS1: {rootfs_size} bytes")
+
+    results = []
+    failed = []
+    print(f"\n   {'COMPRESS':8} {'size':>9} {'fits':>4} {'compress(s)':>11} {'decompress(s)':>13}")
+    for name, compress, decompress, _, config in INITRAMFS_COMPRESSORS:
+        if kernel_config is not None and f"{config}=y" not in kernel_config:
+            print(f"   {name:8} not supported by the kernel ({config})")
+            continue
+        if not shutil.which(compress[0]):
+            print(f"   {name:8} '{compress[0]}' not installed")
+            continue
+        try:
+            with report.phase(f"compress {name}"):
+                start = time.perf_counter()
+                compressed = subprocess.run(compress, input=cpio, stdout=subprocess.PIPE, check=True).stdout
+                compress_time = time.perf_counter() - start
+            with report.phase(f"decompress {name}"):
+                start = time.perf_counter()
+                subprocess.run(decompress, input=compressed, stdout=subprocess.DEVNULL, check=True)
+                decompress_time = time.perf_counter() - start
+        except (OSError, subprocess.CalledProcessError) as e:
+            # a broken compressor only loses its row
+            print(f"   {name:8} failed: {e}")
+            failed.append({"compress": name, "failed": str(e)})
+            continue
+        fits = UIMAGE_HEADER_SIZE + len(compressed) <= rootfs_size
+        results.append((name, len(compressed), fits, compress_time, decompress_time))
+        print(f"   {name:8} {len(compressed):9} {'yes' if fits else 'no':>4} {compress_time:11.2f} {decompress_time:13.2f}")
+    report.info["compressors"] = [dict(zip(("compress", "size", "fits", "compress_time", "decompress_time"), r))
+                                  for r in results] + failed
+    print("\n   The decompression times are measured with the userspace tools, as an estimate of")
+    print("   the kernel decompressor at boot.")
+
+    fitting = [r for r in results if r[2]]
+    if not fitting:
+        raise ResizeError("No compressor makes the initramfs fit in RootFS1")
+    best = min(fitting, key=lambda r: r[4])
+    print(f"\nFastest to decompress and fitting in RootFS1: {best[0]}")
+    print(f"\n    echo \"COMPRESS={best[0]}\" > /etc/initramfs-tools/conf.d/compress")
+
+
+def resized_env(uboot_config):
+    """
+        Read the U-Boot environment of a resized device from the 'uboot_config' partition.
+        Return a tuple (erase block, env dict, Layout of its mtdparts).
+        Raise a ResizeError if the environment has no mtdparts from this tool.
+    """
+    uboot_config_block = bytearray(uboot_config.read(0, uboot_config.erasesize))
     try:
-        bootargs_new = str_replace("initrd=0xa00000,0x900000", 
-                                  "initrd=0xb00000,0xc00000", bootargs)
-                                  
-        # setup cmdlinepart.mtdparts=... to set the partitions for cases where 'cmdlinepart' is build as external module 
-        # (which is the current Debian behavior)
-        bootargs_new = bootargs_new + f' cmdlinepart.mtdparts={NEW_MTDPARTS}'
-        
-        # also add mtdparts=... if for some reasons in future, Debian will switch to internal module or if users are
-        # building their own kernel with such configuration
-        bootargs_new = bootargs_new + f' mtdparts={NEW_MTDPARTS}'
+        uboot_env = uboot_env_parse(uboot_config_block)
+    except ValueError as e:
+        raise ResizeError(str(e))
+    layout = layout_from_bootargs(uboot_env.get("bootargs", ""), uboot_config.erasesize)
+    if layout is None:
+        raise ResizeError("The partitions were not resized by this tool (no mtdparts= in bootargs)")
+    return uboot_config_block, uboot_env, layout
 
-    except KeyError as e:
-        print(str(e))
-        print("Don't know how to patch 'bootargs' for this model. Please report this log.")
-        exit(1)
-    
-    print("   Old:", bootargs)
-    print("   New:", bootargs_new)
 
+def manifest_update(regions, device, args):
+    """
+        Replace the regions of the block manifest (--manifest, or MANIFEST_PATH on the
+        running device) overlapping the rewritten 'regions' (see manifest_build) by the
+        CRC32 of their new content, so 'verify' still matches after an update.
+        Nothing is done with --dry-run or when there is no manifest.
+    """
+    path = args.manifest or (MANIFEST_PATH if isinstance(device, LiveDevice) else None)
+    if args.dry_run or path is None or not os.path.exists(path):
+        return
+    try:
+        with open(path) as F:
+            manifest = json.load(F)
+    except (OSError, ValueError) as e:
+        raise ResizeError(f"Can't load the block manifest: {e}")
 
+    # partial last blocks are padded with 0xff on the flash (see flash_image)
+    erasesize = manifest["regions"][0]["erasesize"] if manifest["regions"] else LEGACY_ERASESIZE
+    regions = [(name, offset, bytes(image) + b"\xff" * (-len(image) % erasesize)) for name, offset, image in regions]
+    new = manifest_build(regions, erasesize)["regions"]
 
+    def overlaps(region, other):
+        end = region["offset"] + len(region["crc32"]) * region["erasesize"]
+        return region["offset"] < other["offset"] + len(other["crc32"]) * other["erasesize"] and other["offset"] < end
 
-###################################################################
-print("\n[Prepare fw_setenv script (/tmp/fw_setenv.script)]")
+    manifest["regions"] = [region for region in manifest["regions"]
+                           if not any(overlaps(region, other) for other in new)] + new
+    manifest_save(manifest, path)
 
-script=""
 
+def uimage_check(image, name, limit):
+    """
+        Check that 'image' is a valid uImage (header and data CRC) of at most 'limit' bytes.
+        Raise a ResizeError otherwise ('name' is for the message).
+    """
+    size = uimage_size(image)
+    if size is None:
+        raise ResizeError(f"{name}: not a uImage (bad magic or header CRC)")
+    if size != len(image) or zlib.crc32(image[UIMAGE_HEADER_SIZE:]) != struct.unpack_from(">I", image, 24)[0]:
+        raise ResizeError(f"{name}: truncated or corrupted uImage (data CRC)")
+    if size > limit:
+        raise ResizeError(f"{name}: {size} bytes, larger than the {limit} bytes partition")
 
-# fw_set env differs in script syntax if the tool is coming from libubootenv or not
-if has_libubootenv:
-    equal="="
-else:
-    equal=" "
 
+def update_bootcmd(args, device, report):
+    """
+        Regenerate the copy lengths of the resized 'bootcmd' from the uImage headers
+        of the Kernel and RootFS1 partitions (ie. after a kernel or initramfs update),
+        and write the U-Boot environment (and its block manifest, see manifest_update)
+        if they changed. On the running device, the initramfs hook doing it after each
+        update is installed, or removed with --full-copy (see bootcmd_hook_update).
+    """
+    uboot_config = device.mtd("U-Boot Config", "U-Boot_Config")
+    partitions = device.partitions()
+    report.mtds = [mtd for _, _, mtd in partitions]
+
+    with report.phase("env dump"):
+        uboot_config_block, uboot_env, layout = resized_env(uboot_config)
+    if "bootcmd_backup" not in uboot_env:
+        raise ResizeError("The 'bootcmd' was not patched by this tool (no bootcmd_backup)")
+
+    with report.phase("uImage headers"):
+        kernel_size = uimage_size(flash_read(partitions, layout.kernel_offset, UIMAGE_HEADER_SIZE))
+        initrd_size = uimage_size(flash_read(partitions, ROOTFS1_OFFSET, UIMAGE_HEADER_SIZE))
+    if args.full_copy:
+        kernel_size = initrd_size = None
+    elif kernel_size is None or initrd_size is None:
+        raise ResizeError("No valid uImage header in 'Kernel' or 'RootFS1' (use --full-copy)")
+    else:
+        print(f"Kernel uImage: {kernel_size} bytes, initrd uImage: {initrd_size} bytes")
 
-if not args.skip_bootargs:
-    script += f"""
-bootargs_backup{equal}{bootargs}
-bootargs{equal}{bootargs_new}
-"""
+    bootcmd = uboot_env["bootcmd"]
+    bootcmd_new = patch_bootcmd(uboot_env["bootcmd_backup"], layout, kernel_size, initrd_size)
+    print("   Old:", bootcmd)
+    print("   New:", bootcmd_new)
+    if isinstance(device, LiveDevice):
+        bootcmd_hook_update(args, not args.full_copy)
+    if bootcmd_new == bootcmd:
+        print("bootcmd already up to date")
+        return
 
-if not args.skip_bootcmd:
-    script += f"""
-bootcmd_backup{equal}{bootcmd}
-bootcmd{equal}{bootcmd_new}
-"""
+    uboot_env["bootcmd"] = bootcmd_new
+    try:
+        uboot_config_block[:UBOOT_ENV_SIZE] = uboot_env_build(uboot_env)
+    except ValueError as e:
+        raise ResizeError(str(e))
+    print("\n[Change U-boot config with new values]")
+    with report.phase("env write"):
+        flash_image(uboot_config, uboot_config_block, dry_run=args.dry_run)
+    manifest_update([("U-Boot_Config", UBOOT_CONFIG_OFFSET, uboot_config_block)], device, args)
 
-if args.setenv_script_append:
-    print(f"Append {args.setenv_script_append}")
-    script += setenv_script_append_content
 
+def flash_update(args, device, report):
+    """
+        Write new kernel and/or initrd uImages (ie. built by flash-kernel into /boot)
+        into the Kernel and RootFS1 partitions of a resized device, only rewriting the
+        erase blocks that changed, and update the block manifest.
+
+        The Kernel_legacy range is always inside Kernel (when there is one): it is only
+        written through Kernel, and the fallback of bootcmd (booting what is at 0x200000, ie. after a
+        QNAP recovery) is regenerated with the copy lengths by update_bootcmd.
+        When exact copies are used, bootcmd copies the whole partitions while
+        flashing, so an interruption never leaves a truncated copy of a larger
+        image, and the exact lengths of the new images are set once they are verified.
+    """
+    if isinstance(device, LiveDevice):
+        try:
+            for name in ("Kernel", "RootFS1"):
+                device.mtd(name)
+        except KeyError:
+            raise ResizeError("No Kernel and RootFS1 MTD partitions found.")
+        if not resized_partitions(name for name, _, _ in device.partitions()):
+            raise ResizeError("The new partitions are not in use: resize first, and reboot.")
+    uboot_config = device.mtd("U-Boot Config", "U-Boot_Config")
+    partitions = device.partitions()
+    report.mtds = [mtd for _, _, mtd in partitions]
+    with report.phase("env dump"):
+        uboot_config_block, uboot_env, layout = resized_env(uboot_config)
+
+    updates = []
+    for path, name, offset, size in ((args.kernel, "Kernel", layout.kernel_offset, layout.kernel_size),
+                                     (args.initrd, "RootFS1", ROOTFS1_OFFSET, layout.rootfs_size)):
+        if not path:
+            continue
+        with open(path, "rb") as F:
+            image = F.read()
+        uimage_check(image, path, size)
+        updates.append((path, name, offset, image))
+    if not updates:
+        raise ResizeError("Nothing to flash (see --kernel and --initrd)")
+
+    exact_copy = False
+    if "bootcmd_backup" in uboot_env:
+        bootcmd_full = patch_bootcmd(uboot_env["bootcmd_backup"], layout)
+        exact_copy = uboot_env["bootcmd"] != bootcmd_full
+    if exact_copy:
+        ###################################################################
+        print("\n[Exact size copies in bootcmd: copy the whole partitions while flashing]")
+        print("   Old:", uboot_env["bootcmd"])
+        print("   New:", bootcmd_full)
+        uboot_env["bootcmd"] = bootcmd_full
+        try:
+            uboot_config_block[:UBOOT_ENV_SIZE] = uboot_env_build(uboot_env)
+        except ValueError as e:
+            raise ResizeError(str(e))
+        with report.phase("env write"):
+            flash_image(uboot_config, uboot_config_block, dry_run=args.dry_run)
+
+    for path, name, offset, image in updates:
+        ###################################################################
+        print(f"\n[Flash {path} into '{name}' ({len(image)} bytes)]")
+        with report.phase(f"flash {name}"):
+            flash_region(partitions, offset, image, args.dry_run)
+    # the manifest regions don't cross the Kernel_legacy start (see prepare)
+    regions = []
+    for _, name, offset, image in updates:
+        cut = min(max(LEGACY_KERNEL_OFFSET - offset, 0), len(image))
+        regions += [(name, offset, image[:cut]), ("Kernel_legacy", LEGACY_KERNEL_OFFSET, image[cut:])] \
+            if 0 < cut < len(image) else [(name, offset, image)]
+    manifest_update(regions, device, args)
+
+    if exact_copy:
+        ###################################################################
+        print("\n[Exact size copies in bootcmd: set the lengths of the new uImages]")
+        update_bootcmd(args, device, report)
+
+
+def bench_read(mtd, size, length):
+    """
+        Return the read throughput (bytes/s) of 'mtd' reading 'length' bytes by 'size' bytes
+    """
+    length = min(length, mtd.size) // size * size
+    start = time.perf_counter()
+    for offset in range(0, length, size):
+        mtd.read(offset, size)
+    return length / max(time.perf_counter() - start, 1e-9)
 
-with open("/tmp/fw_setenv.script", "w") as F:
-    F.write(script)
-    
 
-print("\n[Dump current 'NAS config' and 'Kernel' images]")
-cmd = f"""
-    set -e
-    set -x
-    cat /dev/{mtd_nas_config} > /tmp/mtd_nas_config.dump
+def bench_flash(args, device, report):
     """
-    
-subprocess.check_call(cmd, shell=True)
-    
+        Measure the read throughput of the resized partitions for several read sizes and,
+        unless --read-only, the erase and program times of a scratch erase block (its
+        content is written back). Save the results as the profile of the chip (see flash_eta).
+    """
+    device.check()
+    partitions = device.partitions()
+    report.mtds = [mtd for _, _, mtd in partitions]
+    mtds = [device.mtd("Kernel"), device.mtd("RootFS1"), device.mtd("NAS Config", "NAS_Config"),
+            device.mtd("U-Boot Config", "U-Boot_Config")]
+    erasesize = mtds[0].erasesize
+    chip = device.chip_id()
+    profile = {"chip": chip, "erasesize": erasesize,
+               "created": datetime.datetime.now().isoformat(timespec="seconds"), "read": {}}
+
+    ###################################################################
+    print(f"\n[Read throughput of {chip} (KB/s)]")
+    print(f"   {'partition':24}" + "".join(f"{size:>10}" for size in BENCH_READ_SIZES))
+    totals = dict.fromkeys(BENCH_READ_SIZES, 0.0)
+    with report.phase("read bench"):
+        for mtd in mtds:
+            rates = [bench_read(mtd, size, BENCH_READ_BYTES) for size in BENCH_READ_SIZES]
+            print(f"   {str(mtd):24}" + "".join(f"{rate / 1024:10.0f}" for rate in rates))
+            for size, rate in zip(BENCH_READ_SIZES, rates):
+                totals[size] += rate / len(mtds)
+    profile["read"] = {str(size): round(rate) for size, rate in totals.items()}
+
+    if not args.read_only:
+        ###################################################################
+        # default scratch block: the last one of the chip, at the end of RootFS1 (or of
+        # RootFS2, merged into RootFS1 by the resize), unless the initrd reaches it
+        offset = args.scratch
+        if offset is None:
+            offset = chip_size(partitions) - erasesize
+            initrd_size = uimage_size(flash_read(partitions, ROOTFS1_OFFSET, UIMAGE_HEADER_SIZE))
+            if initrd_size is None or ROOTFS1_OFFSET + initrd_size > offset:
+                raise ResizeError(f"The initrd may use the last erase block 0x{offset:x}: choose an unused one with --scratch")
+        if offset % erasesize:
+            raise ResizeError(f"--scratch 0x{offset:x} is not erase block aligned")
+        print(f"\n[Erase and program time of the erase block at 0x{offset:x} (its content is written back)]")
+        mtd, mtd_offset = flash_locate(partitions, offset, erasesize)
+        original = mtd.read(mtd_offset, erasesize)
+        pattern = os.urandom(erasesize)
+        erase_times = []
+        program_times = []
+        with report.phase("erase/program bench"):
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                mtd.erase(mtd_offset)
+                erase_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                mtd.write(mtd_offset, pattern)
+                program_times.append(time.perf_counter() - start)
+            mtd.erase(mtd_offset)
+            mtd.write(mtd_offset, original)
+        if mtd.read(mtd_offset, erasesize) != original:
+            raise ResizeError(f"The erase block at 0x{offset:x} could not be written back: restore it from your backup!")
+        profile["erase_time"] = round(sum(erase_times) / len(erase_times), 6)
+        profile["program_time"] = round(sum(program_times) / len(program_times), 6)
+        print(f"   erase {profile['erase_time']:.3f}s, program {profile['program_time']:.3f}s per erase block")
+
+    path = args.flash_profile or FLASH_PROFILE_PATH
+    profiles = flash_profiles_load(path)
+    profiles[chip] = profile
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as F:
+        json.dump(profiles, F, indent=2)
+    print(f"\nProfile of {chip} saved to {path}")
+    report.info["flash_profile"] = profile
+
+
+def flash_profiles_load(path):
+    """
+        Return the {chip id: profile} dict saved by 'bench-flash' in 'path' (empty if there is none)
+    """
+    try:
+        with open(path) as F:
+            return json.load(F)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        raise ResizeError(f"Can't read the flash profile {path}: {e}")
 
-    
-###################################################################
-if args.drop_nas_config:
-    print("[--drop-nas-config => don't try to resize 'NAS config']")
-else:
-    print("[Resize 'NAS config' dump from 1280KB to 256KB.]")
-
-    cmd = f"""
-    set -e
-    set -x
-    modprobe loop
-    
-    loopdev=$(losetup --show -f /tmp/mtd_nas_config.dump)
-    
-    # run e2fsck twice. the First may return an error status even if FS is corrected
-    e2fsck -f -p -v $loopdev || true
-    if ! e2fsck -f -p -v $loopdev; then
-        echo "e2fsck failed. 'NAS config' resize not possible automatically"
-        losetup -d $loopdev
-        exit 1
-    fi
-    
-    if ! resize2fs $loopdev 128; then
-        echo "resize2fs failed. 'NAS config' resize not possible automatically"
-        losetup -d $loopdev
-        exit 1
-    fi
-    losetup -d $loopdev
+
+def flash_eta(steps, profile):
     """
-        
-    subprocess.check_call(cmd, shell=True)
+        Return the worst case time (seconds) of the flash 'steps' (see prepare) with the chip
+        'profile' (see bench_flash): every erase block read, erased, programmed and read back.
+    """
+    erasesize = profile["erasesize"]
+    read_rate = profile["read"].get(str(erasesize)) or max(profile["read"].values())
+    block_time = 2 * erasesize / read_rate + profile["erase_time"] + profile["program_time"]
+    return sum(-(-len(image) // erasesize) for _, _, _, _, image in steps) * block_time
 
 
-###################################################################
-print("\n[Concatenate first 256K of 'NAS config' with first 1MB of Kernel > /tmp/mtd_nas_config.new]")
-with open("/tmp/mtd_nas_config.new", "wb") as new_F:
-    with open("/tmp/mtd_nas_config.dump", "rb") as F:
-        new_F.write(F.read(256*1024))
-    with open(f"/dev/{mtd_kernel}", "rb") as F:
-        new_F.write(F.read(1024*1024))
-    
+def plan_build(args, report):
+    """
+        Resize the legacy layout flash dump 'args.source' (see load_flash_dump) like
+        'offline', and save into 'args.output' a self-contained plan for 'apply':
+        - the preconditions: DTB, legacy partitions (as in /proc/mtd)
+        - the U-Boot environment edits (for review only, the env block is in 'blocks')
+        - the erase blocks to write in this order, with their content and the sha256
+          of their content before and after
+        - the block manifest to install
+        Raise a ResizeError if the resize can't be done.
+    """
+    import base64
+    import hashlib
+    print("DTB file:", args.dtb)
+    if args.dtb not in TESTED_QNAP_DTB and not args.untested_dtb:
+        raise ResizeError("Partition resize was not tested on this device yet (use --untested-dtb to continue anyway)")
+
+    with report.phase("dump load"):
+        flash = load_flash_dump(args.source)
+    original = bytes(flash)
+    mtds = {name: ImageMtd(flash, name, offset, size, LEGACY_ERASESIZE) for name, offset, size in LEGACY_LAYOUT}
+    report.mtds = list(mtds.values())
+    steps, uboot_env_new, manifest = prepare(mtds, args.mtd_master, args, report)
+    uboot_env = uboot_env_parse(mtds["U-Boot Config"].read(0, UBOOT_ENV_SIZE))
+
+    blocks = []
+    for name, title, mtd, offset, image in steps:
+        print(f"\n[{title}]")
+        with report.phase(name):
+            flash_image(mtd, image)
+        for block in range(offset, offset + len(image), LEGACY_ERASESIZE):
+            before = original[block:block + LEGACY_ERASESIZE]
+            after = bytes(flash[block:block + LEGACY_ERASESIZE])
+            if after != before:
+                blocks.append({"step": name, "offset": block,
+                               "before": hashlib.sha256(before).hexdigest(),
+                               "after": hashlib.sha256(after).hexdigest(),
+                               "data": base64.b64encode(after).decode()})
+
+    plan = {
+        "version": 1,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "source": os.path.abspath(args.source),
+        "dtb": args.dtb,
+        "partitions": [{"name": name, "offset": offset, "size": size, "erasesize": LEGACY_ERASESIZE}
+                       for name, offset, size in LEGACY_LAYOUT],
+        "env": {"set": {key: value for key, value in uboot_env_new.items() if uboot_env.get(key) != value},
+                "unset": [key for key in uboot_env if key not in uboot_env_new]},
+        "blocks": blocks,
+        "manifest": manifest,
+        "exact_copy": args.exact_copy and not args.skip_bootcmd,
+        }
+    with open(args.output, "w") as F:
+        json.dump(plan, F, indent=1)
+    print(f"\nPlan: {args.output} ({len(blocks)} erase blocks to write)")
+    for key, value in plan["env"]["set"].items():
+        print(f"   setenv {key} {value}")
+
+
+def block_step_name(block):
+    """
+        Return the journal step name of the erase block 'block' of a plan (see plan_apply)
+    """
+    return f"block 0x{block['offset']:x}"
 
-print("\n[Prepare second 1MB of kernel tail > /tmp/mtd_kernel.tail]")
-with open("/tmp/mtd_kernel.tail", "wb") as new_F:
-    with open(f"/dev/{mtd_kernel}", "rb") as F:
-        F.seek(1024*1024)
-        new_F.write(F.read(1024*1024))
 
+def plan_apply(args, device, report):
+    """
+        Execute the plan saved by 'plan' on 'device': check its preconditions and the
+        current content of every erase block (the one the plan was built from, or
+        already written), then write the blocks that are not written yet.
 
+        The writes are journaled like a resize (see Journal): running it again (or
+        'resume') after an interruption finishes the job, the erase block that was
+        being written being the only one allowed to hold another content.
+    """
+    import base64
+    import hashlib
+    try:
+        with open(args.plan, "rb") as F:
+            plan_sha256 = hashlib.sha256(F.read()).hexdigest()
+            F.seek(0)
+            plan = json.load(F)
+    except (OSError, ValueError) as e:
+        raise ResizeError(f"Can't read the plan {args.plan}: {e}")
+    if plan.get("version") != 1:
+        raise ResizeError(f"{args.plan}: unknown plan version {plan.get('version')}")
+    print(f"Plan: {args.plan} ({plan['created']}, from {plan['source']})")
+
+    journal_path = args.journal or JOURNAL_PATH
+    journal = Journal.load(journal_path)
+    if journal and journal.complete:
+        journal = None
+    if journal and journal.plan.get("plan_sha256") != plan_sha256:
+        raise ResizeError(f"An interrupted resize was found in {journal_path}.\n"
+                          "Finish it first with the 'resume' command.")
+    # with the journal of an interrupted apply, the first erase block not logged as
+    # written may have been erased or partially programmed
+    in_flight = None
+    if journal:
+        print(f"Interrupted apply found in {journal_path} ({journal.plan['created']})")
+        in_flight = next((step["offset"] for step in journal.plan["steps"]
+                          if not journal.completed.get(step["name"])), None)
+
+    ###################################################################
+    print("\n[Check the preconditions]")
+    with report.phase("preconditions"):
+        dtb_file = device.dtb()
+        if dtb_file != plan["dtb"]:
+            raise ResizeError(f"DTB file is {dtb_file}, the plan is for {plan['dtb']}")
+        device.check()
+        partitions = device.partitions()
+        report.mtds = [mtd for _, _, mtd in partitions]
+        current = {MtdTopology.key(name): (offset, mtd) for name, offset, mtd in partitions}
+        for part in plan["partitions"]:
+            offset, mtd = current.get(MtdTopology.key(part["name"]), (None, None))
+            if mtd is None or (offset, mtd.size, mtd.erasesize) != (part["offset"], part["size"], part["erasesize"]):
+                raise ResizeError(f"Partition '{part['name']}' is not the one of the plan "
+                                  f"(0x{part['size']:x} bytes at 0x{part['offset']:x}): already resized ?")
+
+        pending = []
+        unexpected = []
+        for block in plan["blocks"]:
+            data = base64.b64decode(block["data"])
+            if hashlib.sha256(data).hexdigest() != block["after"]:
+                raise ResizeError(f"{args.plan}: damaged content for the erase block 0x{block['offset']:x}")
+            content = hashlib.sha256(flash_read(partitions, block["offset"], len(data))).hexdigest()
+            if content == block["before"] or (block["offset"] == in_flight and content != block["after"]):
+                pending.append((block, data))
+            elif content != block["after"]:
+                unexpected.append(f"0x{block['offset']:x}")
+        if unexpected:
+            raise ResizeError(f"The erase blocks {', '.join(unexpected)} differ from the dump of the plan. Nothing written.")
+    print(f"   {len(pending)} of {len(plan['blocks'])} erase blocks to write")
+    for key, value in plan["env"]["set"].items():
+        print(f"   setenv {key} {value}")
+
+    if pending and not args.yes:
+        print("\nContinue and flash the new partitions ? (y/N)")
+        if args.dry_run:
+            print("Note: You are using --dry-run option. No flash operations will be performed if you answer 'y'.")
+        if sys.stdin.readline().strip().upper() != 'Y':
+            raise ResizeError("Abort.")
+
+    fw_env_config = fw_env_config_text(device.mtd("U-Boot Config", "U-Boot_Config"))
+    if pending and not journal and not args.dry_run:
+        print(f"\n[Write the apply journal into {journal_path} (see 'resume' command)]")
+        steps = [(block_step_name(block), block["step"], None, block["offset"], data) for block, data in pending]
+        journal = Journal.create(journal_path, steps, fw_env_config=fw_env_config, manifest=plan["manifest"],
+                                 plan_sha256=plan_sha256, exact_copy=plan.get("exact_copy", False))
+
+    for block, data in pending:
+        ###################################################################
+        print(f"\n[{block['step']}: erase block 0x{block['offset']:x}]")
+        with report.phase(block["step"]):
+            flash_region(partitions, block["offset"], data, args.dry_run,
+                         done=None if args.dry_run else lambda offset, name=block_step_name(block): journal.done(name, offset))
+
+    resize_finish(fw_env_config, plan["manifest"], args, install=isinstance(device, LiveDevice),
+                  exact_copy=plan.get("exact_copy", False))
+    if journal and not args.dry_run:
+        journal.finish()
+    print("-"*60)
+    print("""
+    SUCCESS. 
 
-print("-"*60)
-print("""    !!!! Warning !!!!
+    Now, REBOOT !
+    """)
+
+
+def load_flash_dump(path):
+    """
+        Load a legacy layout flash dump and return it as a FLASH_SIZE bytearray.
+
+        'path' is either a full flash dump file, or a directory of partition dumps
+        (mtdX or dev/mtdX files, with an optional proc.mtd copy of /proc/mtd giving
+        the partition names. Otherwise the legacy mtd numbering is assumed).
+        Missing partitions are filled with 0xff.
+        Raise a ResizeError if the dump is not usable.
+    """
+    if os.path.isfile(path):
+        with open(path, "rb") as F:
+            flash = bytearray(F.read())
+        if len(flash) != FLASH_SIZE:
+            raise ResizeError(f"{path}: {len(flash)} bytes, a full flash dump is {FLASH_SIZE} bytes")
+        return flash
+
+    names = {f"mtd{i}": name for i, (name, _, _) in enumerate(LEGACY_LAYOUT)}
+    if os.path.exists(os.path.join(path, "proc.mtd")):
+        names = {}
+        for line in open(os.path.join(path, "proc.mtd")).readlines():
+            m = re.match(r'(mtd[0-9]+): ([0-9a-f]+) ([0-9a-f]+) "(.+)"', line.strip())
+            if m:
+                names[m.group(1)] = m.group(4)
+
+    layout = {name: (offset, size) for name, offset, size in LEGACY_LAYOUT}
+    flash = bytearray(b"\xff" * FLASH_SIZE)
+    found = set()
+    for mtd_dev, name in names.items():
+        for filename in (os.path.join(path, mtd_dev), os.path.join(path, "dev", mtd_dev)):
+            if os.path.isfile(filename):
+                break
+        else:
+            continue
+        if name not in layout:
+            raise ResizeError(f"{path}: '{name}' is not a legacy partition")
+        offset, size = layout[name]
+        with open(filename, "rb") as F:
+            data = F.read()
+        if len(data) != size:
+            raise ResizeError(f"{filename}: {len(data)} bytes, '{name}' is {size} bytes")
+        flash[offset:offset+size] = data
+        found.add(name)
+
+    missing = {"Kernel", "RootFS1", "U-Boot Config", "NAS Config"} - found
+    if missing:
+        raise ResizeError(f"{path}: missing partition dumps for {', '.join(sorted(missing))}")
+    return flash
+
+
+def resize_offline(source, output, dtb_file, mtd_master, args, report):
+    """
+        Resize the legacy layout flash dump 'source' (see load_flash_dump) and
+        write the resized full flash image to 'output' and the new U-Boot
+        environment (one 'key=value' per line) to 'output'.env and the block
+        manifest to 'output'.manifest (or --manifest)
+        The phases are recorded in 'report' (see Report).
+
+        Return the tuple (written, skipped) of erase blocks counts.
+        Raise a ResizeError if the resize can't be done.
+    """
+    print("DTB file:", dtb_file)
+    if dtb_file not in TESTED_QNAP_DTB and not args.untested_dtb:
+        raise ResizeError("Partition resize was not tested on this device yet (use --untested-dtb to continue anyway)")
+
+    report.info["dtb"] = dtb_file
+    with report.phase("dump load"):
+        flash = load_flash_dump(source)
+    mtds = {name: ImageMtd(flash, name, offset, size, LEGACY_ERASESIZE) for name, offset, size in LEGACY_LAYOUT}
+    report.mtds = list(mtds.values())
+    steps, uboot_env_new, manifest = prepare(mtds, mtd_master, args, report)
+
+    written = skipped = 0
+    for name, title, mtd, _, image in steps:
+        print(f"\n[{title}]")
+        with report.phase(name):
+            w, s = flash_image(mtd, image)
+        written += w
+        skipped += s
+
+    with open(output, "wb") as F:
+        F.write(flash)
+    with open(output + ".env", "w") as F:
+        for key, value in uboot_env_new.items():
+            F.write(f"{key}={value}\n")
+    print(f"\nResized flash image: {output}")
+    print(f"New U-boot environment: {output}.env")
+    manifest_save(manifest, args.manifest or output + ".manifest")
+    return written, skipped
+
+
+def resize_batch_unit(source, output_dir, dtb_file, mtd_master, args):
+    """
+        Process pool worker for resize_batch(): resize one dump, logging into
+        'output_dir'/<name>.log with the JSON report in 'output_dir'/<name>.json
+        Return a (name, status, written, skipped) tuple
+    """
+    import argparse
+    name = os.path.basename(source.rstrip("/"))
+    if os.path.exists(os.path.join(source, "dtb")):
+        dtb_file = open(os.path.join(source, "dtb")).read().strip()
+    output = os.path.join(output_dir, os.path.splitext(name)[0])
+    # one manifest per dump, next to its image
+    args = argparse.Namespace(**dict(vars(args), manifest=None))
+    report = Report("batch")
+    written = skipped = 0
+    status = "OK"
+    with open(output + ".log", "w") as log:
+        with contextlib.redirect_stdout(log):
+            try:
+                written, skipped = resize_offline(source, output + ".bin", dtb_file, mtd_master, args, report)
+            except ResizeError as e:
+                print(str(e))
+                status = f"FAILED: {str(e).splitlines()[0]}"
+            except Exception as e:
+                print(repr(e))
+                status = f"ERROR: {e!r}"
+    with open(output + ".json", "w") as F:
+        F.write(report.to_json(status))
+    return name, status, written, skipped
+
+
+def resize_batch(source_dir, output_dir, dtb_file, mtd_master, args):
+    """
+        Resize every dump (full flash file or directory of partition dumps)
+        found in 'source_dir' in parallel, with the result of each one in 'output_dir'.
+        A 'dtb' file in a dump directory overrides 'dtb_file' for this dump.
+        Return the number of failed dumps.
+    """
+    import concurrent.futures
+    os.makedirs(output_dir, exist_ok=True)
+    sources = [os.path.join(source_dir, name) for name in sorted(os.listdir(source_dir))]
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        results = list(pool.map(resize_batch_unit, sources, itertools.repeat(output_dir),
+                                itertools.repeat(dtb_file), itertools.repeat(mtd_master), itertools.repeat(args)))
+
+    width = max([len(name) for name, _, _, _ in results] + [4])
+    print(f"{'dump':{width}}  written  skipped  status")
+    for name, status, written, skipped in results:
+        print(f"{name:{width}}  {written:7}  {skipped:7}  {status}")
+    failures = sum(1 for _, status, _, _ in results if status != "OK")
+    print(f"\n{len(results)} dump(s), {failures} failure(s)")
+    return failures
+
+
+def resize_live(args, device, report):
+    """
+        Resize the partitions of the QNAP 'device' we are running on (see LiveDevice)
+        The phases are recorded in 'report' (see Report).
+    """
+    if not (args.backup or args.no_backup or args.dry_run):
+        raise ResizeError("A MTD backup is required before the resize: use --backup DIR with DIR on an USB\n"
+                          "or SATA disk (see 'backup' command), or --no-backup if you already have one.")
+
+    journal_path = args.journal or JOURNAL_PATH
+    journal = Journal.load(journal_path)
+    if journal and not journal.complete:
+        raise ResizeError(f"An interrupted resize was found in {journal_path}.\n"
+                          "Use 'resume' to finish it, or remove this directory if you know what you are doing.")
+
+    ###################################################################
+    print("\n[Check of the QNAP model and see if supported]")
+    with report.phase("model probe"):
+        dtb_file = device.dtb()
+    report.info["dtb"] = dtb_file
+
+    # check if dtb_file is none
+    print("DTB file:", dtb_file)
+
+    if dtb_file not in TESTED_QNAP_DTB and not args.untested_dtb:
+        if args.yes:
+            raise ResizeError("Partition resize was not tested on this device yet (use --untested-dtb to continue anyway)")
+        print("Partition resize was not tested on this device yet. Do you want to continue ? (y/N)")
+        resp = sys.stdin.readline()
+        if resp.strip().upper() != 'Y':
+            raise ResizeError("Abort.")
+
+    if dtb_file not in TESTED_QNAP_DTB:
+
+        print("In case of success, please report the DTB file indication.")
+        print("\n"*3)
+
+    mtds = {
+        "Kernel": device.mtd("Kernel"),
+        "RootFS1": device.mtd("RootFS1"),
+        "NAS Config": device.mtd("NAS Config", "NAS_Config"),
+        "U-Boot Config": device.mtd("U-Boot Config", "U-Boot_Config"),
+        }
+    report.mtds = list(mtds.values())
+
+    with report.phase("tool checks"):
+        device.check()
+        for name, mtd in mtds.items():
+            if not mtd.writeable():
+                raise ResizeError(f"{mtd} '{name}' is read-only (MTD_WRITEABLE flag not set, see mtdparts)")
+
+    ###################################################################
+    print("\n[find on which MTD device partitions are currently mounted]")
+    with report.phase("mtd master"):
+        mtd_master = device.mtd_master()
+    if not mtd_master:
+        raise ResizeError("Failed: no information found in sysfs nor with dmesg")
+    print("  ", mtd_master)
+
+    fw_env_config = fw_env_config_text(mtds["U-Boot Config"])
+    with open("/tmp/fw_env.config", "w") as F:
+        F.write(fw_env_config)
+
+    steps, _, manifest = prepare(mtds, mtd_master, args, report, chip_size(device.partitions()))
+    exact_copy = args.exact_copy and not args.skip_bootcmd
+
+    if args.backup:
+        backup(device.partitions(), args.backup, args.compression, report)
+        backup_note = f"""The MTD partitions are saved in {args.backup}. Copy this directory
+    somewhere else (USB device, PC) if it is not already on one. In case of
+    trouble, restore them with:
+
+        ./qnap_mtd_resize.py restore {args.backup}"""
+    else:
+        backup_note = "No MTD backup was made."
+
+    profile = flash_profiles_load(args.flash_profile or FLASH_PROFILE_PATH).get(device.chip_id())
+    blocks = sum(-(-len(image) // mtd.erasesize) for _, _, mtd, _, image in steps)
+    if profile and "erase_time" in profile:
+        print(f"\nEstimated flash time: up to {flash_eta(steps, profile):.0f}s ({blocks} erase blocks, "
+              f"profile of {profile['chip']} from {profile['created']})")
+    else:
+        print(f"\n{blocks} erase blocks to flash (run 'bench-flash' first for a time estimate)")
+
+    print("-"*60)
+    print("""    !!!! Warning !!!!
 
     Everything is fine up to now.
     Next steps will write the flash and may be subject to failures.
     
-    It is highly recommended to perform a MTD backup and save the files
-    somewhere (USB device, PC)
-    
-        cat /dev/mtd0 > /tmp/mtd0.uboot.backup
-        cat /dev/mtd1 > /tmp/mtd1.kernel.backup
-        cat /dev/mtd2 > /tmp/mtd2.rootfs1.backup
-        cat /dev/mtd3 > /tmp/mtd3.rootfs2.backup
-        cat /dev/mtd4 > /tmp/mtd4.uboot-config.backup
-        cat /dev/mtd5 > /tmp/mtd5.nas-config.backup
-        fw_printenv -c /tmp/fw_env.config  > /tmp/uboot_config.backup.txt
-        cd /tmp
-        tar cvzf mtd_backup.tgz mtd?.*.backup uboot_config.backup.txt
-        
-        # now use scp / sftp to push/pull mtd_backup.tgz on another PC.
+    {backup_note}
     
     Be sure you will not cut the power until the end of operations.
     In case of failure, you way need to recover with a Serial Console 
@@ -497,62 +2287,36 @@ print("""    !!!! Warning !!!!
     
         https://www.cyrius.com/debian/kirkwood/qnap/ts-219/serial/
     
-Continue and flash the new partitions ? (y/N)""")
-if args.dry_run:
-    print("Note: You are using --dry-run option. No flash operations will be performed if you answer 'y'.")
-
-resp = sys.stdin.readline()
-if resp.strip().upper() != 'Y':
-    print("Abort.")
-    exit(1)
-
-
-###################################################################
-print("\n[Flash 'NAS config' partition content (ie 'NAS config' + head of Kernel) (still a 'safe' op)]")
-cmd = f"""flashcp -v /tmp/mtd_nas_config.new /dev/{mtd_nas_config}"""
-if not args.dry_run:
-    print("+", cmd)
-    subprocess.check_call(cmd, shell=True)
-else:
-    print("(Dry run)")
-    print("+", cmd)
-    
-   
-    
-###################################################################
-print("\n[Change U-boot config with new values)]")
-cmd = f"""fw_setenv -c /tmp/fw_env.config -s /tmp/fw_setenv.script"""
-if not args.dry_run:
-    print("+", cmd)
-    subprocess.check_call(cmd, shell=True)
-else:
-    print("(Dry run)")
-    print("+", cmd)
-
-
-
-###################################################################
-print("\n[Flash tail of the kernel in old 'Kernel' Partition]")
-cmd = f"""flashcp -v /tmp/mtd_kernel.tail /dev/{mtd_kernel}"""
-if not args.dry_run:
-    print("+", cmd)
-    subprocess.check_call(cmd, shell=True)
-else:
-    print("(Dry run)")
-    print("+", cmd)
-
-
-###################################################################
-print("\n[Make a copy of /tmp/fw_env.config into /etc/fw_env.config (if not already existing)]")
-if not args.dry_run:
-    if not os.path.exists("/etc/fw_env.config"):
-        shutil.copy("/tmp/fw_env.config", "/etc/fw_env.config")
-
-
-
-###################################################################
-print("-"*60)
-print("""
+Continue and flash the new partitions ? (y/N)""".format(backup_note=backup_note))
+    if args.dry_run:
+        print("Note: You are using --dry-run option. No flash operations will be performed if you answer 'y'.")
+
+    if args.yes:
+        print("y (--yes)")
+    elif sys.stdin.readline().strip().upper() != 'Y':
+        raise ResizeError("Abort.")
+
+    if not args.dry_run:
+        print(f"\n[Write the resize journal into {journal_path} (see 'resume' command)]")
+        journal = Journal.create(journal_path, steps, fw_env_config=fw_env_config, manifest=manifest,
+                                 exact_copy=exact_copy)
+
+    for name, title, mtd, _, image in steps:
+        ###################################################################
+        print(f"\n[{title}]")
+        with report.phase(name):
+            flash_image(mtd, image, dry_run=args.dry_run,
+                        done=None if args.dry_run else lambda offset, name=name: journal.done(name, offset))
+
+    resize_finish(fw_env_config, manifest, args, exact_copy=exact_copy)
+    if not args.dry_run:
+        journal.finish()
+
+    print(f"\nPeak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss} KiB")
+
+    ###################################################################
+    print("-"*60)
+    print("""
     SUCCESS. 
 
     Now, REBOOT !
@@ -560,11 +2324,261 @@ print("""
     Notes: 
     - DO NOT PERFORM A KERNEL OR SYSTEM UPDATE before the next reboot !... 
       so don't wait too long.
-    - Consider compressing initrd with 'xz' to optimize the size with:
+    - Once rebooted, see which initrd compression boots the fastest while
+      fitting in the new RootFS1 with:
     
-        echo "COMPRESS=xz" > /etc/initramfs-tools/conf.d/compress
+        ./qnap_mtd_resize.py compress-bench
 
     """)
 
 
+def option_parsers():
+    """
+        Return the parent parsers of the options shared by the main parser and the
+        commands (common, layout planning, resize, backup) and the dict of their defaults.
+        The options are declared with argparse.SUPPRESS as default: an option is only
+        set when given, before or after the command, and main sets the defaults of the
+        others once parsed.
+    """
+    import argparse
+    defaults = {}
+
+    def option(parser, *flags, default=None, **kwargs):
+        action = parser.add_argument(*flags, default=argparse.SUPPRESS, **kwargs)
+        defaults[action.dest] = False if kwargs.get("action") == "store_true" else default
+
+    # options of the main parser and of every command
+    common_options = argparse.ArgumentParser(add_help=False)
+    option(common_options, "--dry-run", action="store_true", help="Don't modify the flash content")
+    option(common_options, "--yes", action="store_true", help="Don't ask for a confirmation before flashing (non-interactive use)")
+    option(common_options, "--manifest", metavar="FILE", help=f"""
+        CRC32 manifest of the flashed erase blocks, saved by the resize and checked by 'verify'
+        (default: {MANIFEST_PATH}, OUTPUT.manifest for 'offline')
+        """)
+    option(common_options, "--journal", metavar="DIR", help=f"""
+        Where to keep the journal of the flash operations, off-flash (default: {JOURNAL_PATH})
+        """)
+    option(common_options, "--flash-profile", metavar="FILE", help=f"""
+        Flash chip timings saved by 'bench-flash', for the flash time estimate (default: {FLASH_PROFILE_PATH})
+        """)
+    option(common_options, "--report", metavar="FILE", help="Save the timing and I/O accounting of each phase as JSON")
+    option(common_options, "--profile", metavar="FILE", help="Run under cProfile and save the stats (see pstats)")
+
+    # options of the layout planning
+    layout_options = argparse.ArgumentParser(add_help=False)
+    option(layout_options, "--kernel-size", type=lambda n: int(n, 0), metavar="BYTES",
+            help="Plan for a kernel uImage of this size (default: the current one)")
+    option(layout_options, "--initrd-size", type=lambda n: int(n, 0), metavar="BYTES",
+            help="Plan for an initrd uImage of this size (default: the current one)")
+    option(layout_options, "--headroom", type=int, default=10, metavar="PERCENT",
+            help=f"Free space to keep in the kernel and rootfs partitions (default: 10%%, "
+                 f"at least {KERNEL_MARGIN // 1024}KB for the kernel)")
+    option(layout_options, "--keep-kernel", action="store_true", help="""
+        Also plan the layout keeping the legacy 2MB Kernel partition in place (only the
+        U-Boot environment is written, but there is little room left for kernel updates)
+        """)
+    option(layout_options, "--drop-nas-config", action="store_true", help="""
+        Don't try to resize 'NAS config' partition and drop its content.
+        (Useful if the ext2 check keeps failing and the partition is not recoverable)")
+        """)
+
+    # options common to every resize mode
+    resize_options = argparse.ArgumentParser(add_help=False, parents=[layout_options])
+    option(resize_options, "--auto-layout", action="store_true", help="""
+        Instead of the 3MB Kernel / 12MB RootFS1 layout, use the layout writing the fewest
+        erase blocks that fits the kernel and initrd (see 'layout' command)
+        """)
+    option(resize_options, "--skip-bootargs", action="store_true", help="[WARNING] Don't patch bootargs. --setenv-script also required")
+    option(resize_options, "--skip-bootcmd", action="store_true", help="[WARNING] Don't patch bootcmd. --setenv-script also required")
+    option(resize_options, "--setenv-script-append", metavar="FILE", help="""
+        Additional setenv script to append in addition to the bootargs and bootcmd patching.
+        ('key value' or 'key=value' lines, see man fw_setenv)")
+        """)
+    option(resize_options, "--exact-copy", action="store_true", help="""
+        Let U-Boot copy only the used part of Kernel and RootFS1 (from the uImage headers)
+        instead of the whole partitions. 'update-bootcmd' must then run after every kernel
+        or initramfs update.
+        """)
+    option(resize_options, "--untested-dtb", action="store_true", help="Also process devices not tested yet")
+
+    # options of the backups
+    backup_options = argparse.ArgumentParser(add_help=False)
+    option(backup_options, "--compression", choices=BACKUP_COMPRESSION, default="gzip",
+            help="Compression of the MTD backup files (default: gzip)")
+
+    return common_options, layout_options, resize_options, backup_options, defaults
+
+
+def main():
+    import argparse
+
+    # 'status' without building the parser of every command (qnap_mtd_status.py alone is
+    # faster, for monitoring)
+    if sys.argv[1:2] == ["status"]:
+        status_main(sys.argv[2:], prog=f"{os.path.basename(sys.argv[0])} status")
+        return
+
+    common_options, layout_options, resize_options, backup_options, option_defaults = option_parsers()
+
+    # options of the offline modes
+    offline_options = argparse.ArgumentParser(add_help=False, parents=[resize_options])
+    offline_options.add_argument("--dtb", required=True, help="DTB file name of the device (see /usr/share/flash-kernel/dtb-probe/kirkwood-qnap)")
+    offline_options.add_argument("--mtd-master", default="spi0.0", help="MTD device holding the partitions (default: %(default)s)")
+
+    parser = argparse.ArgumentParser(
+            description='Tool to resize QNAP mtd partitions in order to increase the kernel and rootfs size',
+            parents=[common_options, resize_options, backup_options],
+            )
+    parser.add_argument("--backup", metavar="DIR", help="Save the MTD partitions into DIR before the resize (see 'backup')")
+    parser.add_argument("--no-backup", action="store_true", help="[WARNING] Resize without a MTD backup")
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND",
+            help="Without command, resize the partitions of the running device")
+
+    p = subparsers.add_parser("offline", parents=[common_options, offline_options],
+            help="Resize a flash dump instead of the running device")
+    p.add_argument("source", help="Full flash dump file, or directory of partition dumps (mtdX or dev/mtdX files and proc.mtd)")
+    p.add_argument("output", help="Resized full flash image (the new U-Boot environment is written to OUTPUT.env)")
+
+    p = subparsers.add_parser("batch", parents=[common_options, offline_options],
+            help="Resize every flash dump of a directory, in parallel")
+    p.add_argument("source_dir", help="Directory of dumps (see 'offline'). A 'dtb' file in a dump directory overrides --dtb")
+    p.add_argument("output_dir", help="Directory receiving the resized images, environments and logs")
+    p.add_argument("-j", "--jobs", type=int, default=None, help="Number of parallel jobs (default: number of CPUs)")
+
+    p = subparsers.add_parser("plan", parents=[common_options, offline_options],
+            help="Resize a flash dump into a plan file for 'apply' (on a workstation)")
+    p.add_argument("source", help="Full flash dump file, or directory of partition dumps (mtdX or dev/mtdX files and proc.mtd)")
+    p.add_argument("output", help="Plan file (JSON)")
+
+    p = subparsers.add_parser("apply", parents=[common_options],
+            help="Check the preconditions of a 'plan' file and write its erase blocks")
+    p.add_argument("plan", help="Plan file made by 'plan'")
+    p.add_argument("--image", metavar="FILE", help="Apply to a full flash image file instead of the running device")
+
+    p = subparsers.add_parser("resume", parents=[common_options],
+            help="Finish a resize interrupted while flashing (see --journal)")
+    p.add_argument("--image", metavar="FILE", help="Resume on a full flash image file instead of the running device")
+
+    p = subparsers.add_parser("layout", parents=[common_options, layout_options],
+            help="Show the layouts fitting the current images and the best one (read only)")
+    p.add_argument("--image", metavar="FILE", help="Plan for a full flash image file instead of the running device")
+
+    p = subparsers.add_parser("compress-bench", parents=[common_options],
+            help="Compare the initramfs-tools compressors (size, compression and decompression times)")
+    p.add_argument("initramfs", nargs="?", help="Initramfs to recompress (default: /boot/initrd.img-$(uname -r))")
+    p.add_argument("--rootfs-size", type=lambda n: int(n, 0), metavar="BYTES",
+            help="Size available for the initrd uImage (default: size of the RootFS1 MTD partition)")
+
+    p = subparsers.add_parser("update-bootcmd", parents=[common_options],
+            help="Adjust the bootcmd copy lengths to the current kernel and initrd uImages")
+    p.add_argument("--full-copy", action="store_true", help="Copy the whole partitions again")
+    p.add_argument("--image", metavar="FILE", help="Update a full flash image file instead of the running device")
+
+    p = subparsers.add_parser("flash-update", parents=[common_options],
+            help="Write kernel / initrd uImages into the resized partitions, only rewriting the changed erase blocks")
+    p.add_argument("--kernel", metavar="UIMAGE", help="Kernel uImage (ie. /boot/uImage)")
+    p.add_argument("--initrd", metavar="UIMAGE", help="Initrd uImage (ie. /boot/uInitrd)")
+    p.add_argument("--image", metavar="FILE", help="Update a full flash image file instead of the running device")
+    p.set_defaults(full_copy=False)
+
+    p = subparsers.add_parser("status", parents=[common_options],
+            help="Print the resize status as JSON: legacy, resized or partial (fast, read only)")
+    p.add_argument("--image", metavar="FILE", help="Check a full flash image file instead of the running device")
+
+    p = subparsers.add_parser("bench-flash", parents=[common_options],
+            help="Measure the read, erase and program speed of the flash chip and save its profile")
+    p.add_argument("--read-only", action="store_true", help="Only measure the read throughput")
+    p.add_argument("--scratch", type=lambda n: int(n, 0), metavar="OFFSET",
+            help="Flash offset of the erase block to erase and program, its content is written back "
+                 "(default: the last erase block of the chip, when the initrd doesn't use it)")
+    p.add_argument("--rounds", type=int, default=3, help="Erase + program measures (default: %(default)s)")
+    p.add_argument("--image", metavar="FILE", help="Measure a full flash image file instead of the running device")
+
+    p = subparsers.add_parser("verify", parents=[common_options],
+            help="Check the flashed erase blocks against the manifest saved by the resize (fast, read only)")
+    p.add_argument("--image", metavar="FILE", help="Check a full flash image file instead of the running device")
+
+    p = subparsers.add_parser("backup", parents=[common_options, backup_options],
+            help="Save every MTD partition (erased blocks are not stored) with a manifest for 'restore'")
+    p.add_argument("target", help="Backup directory (on an USB or SATA disk rather than in /tmp)")
+    p.add_argument("--image", metavar="FILE", help="Save the partitions of a full flash image file instead of the running device")
+
+    p = subparsers.add_parser("restore", parents=[common_options],
+            help="Write back a 'backup' (only the erase blocks that differ)")
+    p.add_argument("source", help="Backup directory")
+    p.add_argument("--include-uboot", action="store_true", help="[WARNING] Also restore the U-Boot partition")
+    p.add_argument("--image", metavar="FILE", help="Restore into a full flash image file instead of the running device")
+
+    p = subparsers.add_parser("rollback", parents=[common_options],
+            help="Go back to the legacy layout from the pre-resize 'backup' (only the differing erase blocks and variables)")
+    p.add_argument("source", help="Backup directory made before the resize, or its manifest.json")
+    p.add_argument("--image", metavar="FILE", help="Roll back a full flash image file instead of the running device")
+
+    args = parser.parse_args()
+    for dest, default in option_defaults.items():
+        if not hasattr(args, dest):
+            setattr(args, dest, default)
+
+    if (args.skip_bootargs or args.skip_bootcmd) and (not args.setenv_script_append):
+        print("--skip-bootargs and --skip-bootcmd require to also use --setenv-script-append option to provide the proper final settings for bootargs and bootcmd")
+        print("Use and empty file if you definitely don't want to modify bootargs or bootcmd")
+        exit(1)
+
+    report = Report(args.command or "resize")
+    result = "error"
+    profile = None
+    if args.profile:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        if args.command == "offline":
+            resize_offline(args.source, args.output, args.dtb, args.mtd_master, args, report)
+        elif args.command == "backup":
+            device = FileDevice(args.image) if args.image else LiveDevice()
+            backup(device.partitions(), args.target, args.compression, report)
+        elif args.command == "restore":
+            restore(args, FileDevice(args.image) if args.image else LiveDevice(), report)
+        elif args.command == "rollback":
+            rollback(args, FileDevice(args.image) if args.image else LiveDevice(), report)
+        elif args.command == "plan":
+            plan_build(args, report)
+        elif args.command == "apply":
+            plan_apply(args, FileDevice(args.image) if args.image else LiveDevice(), report)
+        elif args.command == "resume":
+            resume(args, FileDevice(args.image) if args.image else LiveDevice(), report)
+        elif args.command == "layout":
+            layout(args, FileDevice(args.image) if args.image else LiveDevice(), report)
+        elif args.command == "compress-bench":
+            compress_bench(args, report)
+        elif args.command == "update-bootcmd":
+            update_bootcmd(args, FileDevice(args.image) if args.image else LiveDevice(), report)
+        elif args.command == "flash-update":
+            flash_update(args, FileDevice(args.image) if args.image else LiveDevice(), report)
+        elif args.command == "bench-flash":
+            bench_flash(args, FileDevice(args.image) if args.image else LiveDevice(), report)
+        elif args.command == "status":
+            status_command(args)
+        elif args.command == "verify":
+            verify(args, report)
+        elif args.command == "batch":
+            if resize_batch(args.source_dir, args.output_dir, args.dtb, args.mtd_master, args):
+                raise ResizeError("Some dumps failed")
+        else:
+            resize_live(args, LiveDevice(), report)
+        result = "success"
+    except ResizeError as e:
+        result = f"failed: {str(e).splitlines()[0]}"
+        print(str(e))
+        exit(1)
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        if args.report:
+            with open(args.report, "w") as F:
+                F.write(report.to_json(result))
+
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,938 @@
+#!/usr/bin/env python3
+
+"""
+    SPDX-License-Identifier: GPL-2.0
+
+    Resize status of the QNAP MTD partitions (see qnap_mtd_resize.py), printed as JSON:
+
+        ./qnap_mtd_status.py [--image FILE] [--journal DIR]
+
+    This module also holds what 'status' needs from qnap_mtd_resize.py (flash layout,
+    MTD access, U-Boot environment, bootargs / bootcmd patching, resize journal),
+    which imports it. It is kept small and only imports fast modules: monitoring
+    polls it.
+"""
+
+
+import os
+import re
+import struct
+import zlib
+import time
+import json
+import fcntl
+
+
+# legacy flash layout: (name, offset, size) in mtd numbering order
+LEGACY_LAYOUT = [
+    ("U-Boot",        0x000000, 0x080000),
+    ("Kernel",        0x200000, 0x200000),
+    ("RootFS1",       0x400000, 0x900000),
+    ("RootFS2",       0xd00000, 0x300000),
+    ("U-Boot Config", 0x080000, 0x040000),
+    ("NAS Config",    0x0c0000, 0x140000),
+    ]
+LEGACY_ERASESIZE = 0x40000
+FLASH_SIZE = 0x1000000
+
+# legacy and new sizes of the partitions we are moving
+LEGACY_NAS_CONFIG_SIZE = 0x140000
+LEGACY_KERNEL_SIZE = 0x200000
+LEGACY_ROOTFS1_SIZE = 0x900000
+# flash offsets that never change: 'U-Boot Config', 'NAS Config' start, legacy 'Kernel'
+# (the Kernel_legacy fallback of a QNAP recovery) and 'RootFS1' (the initrd stays in place)
+UBOOT_CONFIG_OFFSET = 0x080000
+NAS_CONFIG_OFFSET = 0x0c0000
+LEGACY_KERNEL_OFFSET = 0x200000
+ROOTFS1_OFFSET = 0x400000
+# where U-Boot sees the flash, and loads the kernel
+FLASH_BUS_ADDR = 0xf8000000
+KERNEL_LOAD_ADDR = 0x800000
+
+# MTD ioctls (see linux include/uapi/mtd/mtd-abi.h)
+MEMGETINFO = 0x80204d01     # _IOR('M', 1, struct mtd_info_user)
+MEMERASE = 0x40084d02       # _IOW('M', 2, struct erase_info_user)
+MTD_INFO_FORMAT = "<B3xIIIII8x"     # type, flags, size, erasesize, writesize, oobsize
+MTD_WRITEABLE = 0x400
+
+# uImage header (see U-Boot include/image.h)
+UIMAGE_MAGIC = 0x27051956
+UIMAGE_HEADER_SIZE = 64
+# copied beyond the uImage size with exact size bootcmd copies
+BOOTCMD_COPY_MARGIN = 0x10000
+
+# U-Boot environment size at the beginning of 'U-Boot Config'
+# (same value as in the fw_env.config file generated by qnap_mtd_resize.py)
+UBOOT_ENV_SIZE = 0x1000
+
+# default location of the resize journal (off-flash, on the root filesystem disk)
+JOURNAL_PATH = "/var/lib/qnap_mtd_resize/journal"
+class MtdPartition:
+    """
+        A MTD partition description. 'offset' and 'master' are None when unknown.
+    """
+    def __init__(self, dev, name, size, erasesize, offset=None, master=None):
+        self.dev = dev
+        self.name = name
+        self.size = size
+        self.erasesize = erasesize
+        self.offset = offset
+        self.master = master
+
+
+class MtdTopology:
+    """
+        Index of the MTD partitions, built once from /sys/class/mtd/* (name, size,
+        erasesize, offset and parent device), or from /proc/mtd when sysfs is missing.
+        Lookups by name are done with spaces and underscores considered equal
+        (ie. "NAS Config" and "NAS_Config").
+    """
+    def __init__(self, sysfs="/sys/class/mtd", proc_mtd="/proc/mtd"):
+        self.partitions = []
+        if os.path.isdir(sysfs):
+            self._load_sysfs(sysfs)
+        else:
+            self._load_proc_mtd(proc_mtd)
+        self.index = {}
+        for part in self.partitions:
+            self.index.setdefault(self.key(part.name), part)
+
+    @staticmethod
+    def key(name):
+        return name.replace(" ", "_")
+
+    def _load_sysfs(self, sysfs):
+        def attr(dev, name):
+            try:
+                with open(os.path.join(sysfs, dev, name)) as F:
+                    return F.read().strip()
+            except OSError:
+                return None
+
+        devs = [dev for dev in os.listdir(sysfs) if re.fullmatch(r"mtd[0-9]+", dev)]
+        names = {dev: attr(dev, "name") for dev in devs}
+        for dev in sorted(devs, key=lambda dev: int(dev[3:])):
+            offset = attr(dev, "offset")
+            master = None
+            try:
+                # partitions are children of the master MTD device if registered,
+                # else of the flash device itself (ie. spi0.0)
+                master = os.path.basename(os.readlink(os.path.join(sysfs, dev, "device")))
+                master = names.get(master, master)
+            except OSError:
+                pass
+            self.partitions.append(MtdPartition(dev, names[dev], int(attr(dev, "size")), int(attr(dev, "erasesize")),
+                                                int(offset) if offset is not None else None, master))
+
+    def _load_proc_mtd(self, proc_mtd):
+        for line in open(proc_mtd).readlines():
+            m = re.match(r'(mtd[0-9]+): ([0-9a-f]+) ([0-9a-f]+) "(.+)"', line.strip())
+            if m:
+                self.partitions.append(MtdPartition(m.group(1), m.group(4), int(m.group(2), 16), int(m.group(3), 16)))
+
+    def get(self, *names):
+        """
+            Return the MtdPartition of the first of 'names' found.
+            Raise a KeyError exception if not found.
+        """
+        for name in names:
+            part = self.index.get(self.key(name))
+            if part:
+                return part
+        raise KeyError(f"No mtd {names} device found.")
+
+    @property
+    def master(self):
+        """
+            Name of the MTD device holding the partitions, or None if unknown
+        """
+        masters = {part.master for part in self.partitions}
+        return masters.pop() if len(masters) == 1 else None
+
+
+_mtd_topology = None
+
+def mtd_topology():
+    """
+        Return the MtdTopology of the running device (built on first call)
+    """
+    global _mtd_topology
+    if _mtd_topology is None:
+        _mtd_topology = MtdTopology()
+    return _mtd_topology
+
+
+def mtd_lookup(*names):
+    """
+        For a list of MTD partition names, return a tuple
+        ("mtdX", size, erasesize) of the first match
+        Raise a KeyError exception if not found.
+    """
+    part = mtd_topology().get(*names)
+    return (part.dev, part.size, part.erasesize)
+    
+
+def str_replace(search, replace, text):
+    """
+        Search for 'search' pattern in 'text' and replace by 'replace'
+        Raise a KeyError if 'search' is not found.
+    """
+    result = re.sub(search, replace, text)
+    if result == text:
+        raise KeyError(f"'{search}' not found in '{text}'")
+    return result
+
+
+class ResizeError(Exception):
+    """
+        Error preventing the resize. The message is for the user.
+    """
+
+
+class MtdDevice:
+    """
+        A MTD partition of the running device (/dev/mtdX), accessed with read / write
+        and the MTD ioctls (no mtd-utils needed)
+    """
+    def __init__(self, dev, size, erasesize):
+        self.dev = dev
+        self.size = size
+        self.erasesize = erasesize
+        self.stats = dict.fromkeys(("read", "erased", "programmed", "erase_count"), 0)
+        self._writeable = None
+
+    def __str__(self):
+        return f"/dev/{self.dev}"
+
+    def read(self, offset, length):
+        with open(f"/dev/{self.dev}", "rb", buffering=0) as F:
+            F.seek(offset)
+            data = F.read(length)
+        self.stats["read"] += len(data)
+        return data
+
+    def readinto(self, offset, buffer):
+        with open(f"/dev/{self.dev}", "rb", buffering=0) as F:
+            F.seek(offset)
+            if F.readinto(buffer) != len(buffer):
+                raise IOError(f"{self}: short read at offset 0x{offset:x}")
+        self.stats["read"] += len(buffer)
+
+    def info(self):
+        """
+            Return the MEMGETINFO ioctl result as a dict (type, flags, size, erasesize, writesize, oobsize)
+        """
+        with open(f"/dev/{self.dev}", "rb", buffering=0) as F:
+            info = fcntl.ioctl(F, MEMGETINFO, bytes(struct.calcsize(MTD_INFO_FORMAT)))
+        return dict(zip(("type", "flags", "size", "erasesize", "writesize", "oobsize"),
+                        struct.unpack(MTD_INFO_FORMAT, info)))
+
+    def writeable(self):
+        """
+            Return False for a read-only partition (MTD_WRITEABLE flag not set,
+            ie. 'ro' in mtdparts). MEMGETINFO is only called once.
+        """
+        if self._writeable is None:
+            self._writeable = bool(self.info()["flags"] & MTD_WRITEABLE)
+        return self._writeable
+
+    def erase(self, offset):
+        if offset % self.erasesize:
+            raise IOError(f"{self}: unaligned erase at offset 0x{offset:x}")
+        if not self.writeable():
+            raise IOError(f"{self}: read-only partition, not erased")
+        with open(f"/dev/{self.dev}", "r+b", buffering=0) as F:
+            fcntl.ioctl(F, MEMERASE, struct.pack("<II", offset, self.erasesize))
+        self.stats["erased"] += self.erasesize
+        self.stats["erase_count"] += 1
+
+    def write(self, offset, data):
+        with open(f"/dev/{self.dev}", "r+b", buffering=0) as F:
+            F.seek(offset)
+            if F.write(data) != len(data):
+                raise IOError(f"{self}: short write at offset 0x{offset:x}")
+        self.stats["programmed"] += len(data)
+
+
+class ImageMtd:
+    """
+        A MTD partition inside a full flash image ('flash' bytearray or mmap) for
+        offline operations, tests and benchmarks.
+
+        NOR flash behavior is emulated: an erase sets the whole erase block to 0xff
+        and programming can only clear bits. 'erase_latency' (seconds per erase block)
+        and 'program_latency' (seconds per erase block size of programmed data) make
+        operations as slow as a real chip.
+        'stats' counts the bytes read, erased and programmed and the erase operations.
+    """
+    def __init__(self, flash, name, offset, size, erasesize, erase_latency=0.0, program_latency=0.0):
+        self.flash = flash
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.erasesize = erasesize
+        self.erase_latency = erase_latency
+        self.program_latency = program_latency
+        self.stats = dict.fromkeys(("read", "erased", "programmed", "erase_count"), 0)
+
+    def __str__(self):
+        return f"'{self.name}'@0x{self.offset:x}"
+
+    def read(self, offset, length):
+        length = max(0, min(length, self.size - offset))
+        self.stats["read"] += length
+        return bytes(self.flash[self.offset + offset:self.offset + offset + length])
+
+    def readinto(self, offset, buffer):
+        self.stats["read"] += len(buffer)
+        buffer[:] = self.flash[self.offset + offset:self.offset + offset + len(buffer)]
+
+    def erase(self, offset):
+        if offset % self.erasesize:
+            raise IOError(f"{self}: unaligned erase at offset 0x{offset:x}")
+        self.flash[self.offset + offset:self.offset + offset + self.erasesize] = b"\xff" * self.erasesize
+        self.stats["erased"] += self.erasesize
+        self.stats["erase_count"] += 1
+        time.sleep(self.erase_latency)
+
+    def write(self, offset, data):
+        start = self.offset + offset
+        current = int.from_bytes(self.flash[start:start + len(data)], "little")
+        self.flash[start:start + len(data)] = (current & int.from_bytes(data, "little")).to_bytes(len(data), "little")
+        self.stats["programmed"] += len(data)
+        time.sleep(self.program_latency * len(data) / self.erasesize)
+
+    def writeable(self):
+        return True
+
+
+def mtd_master_from_dmesg(lines):
+    """
+        Return the MTD device name holding the partitions from the kernel log
+        'lines' (last 'Creating N MTD partitions on "spi0.0":' line), or None
+    """
+    mtd_master = None
+    for line in lines:
+        m = re.search(r'Creating [0-9]+ MTD partitions on "([^"]+)"', line)
+        if m:
+            mtd_master = m.group(1)
+    return mtd_master
+
+
+class LiveDevice:
+    """
+        The QNAP device we are running on: DTB probe, MTD topology (sysfs) and /dev/mtdX
+    """
+    def dtb(self):
+        import subprocess
+        try:
+            return subprocess.check_output(["/usr/share/flash-kernel/dtb-probe/kirkwood-qnap"]).strip().decode()
+        except FileNotFoundError:
+            raise ResizeError("'flash-kernel' package is not installed. Are you really running this script from a QNAP ?")
+        except subprocess.CalledProcessError:
+            raise ResizeError("You are not running this script from a supported QNAP device.")
+
+    def check(self):
+        # root ?
+        if os.getuid() != 0:
+            raise ResizeError("You must be root.")
+
+        # the MTD ioctls must agree with the topology (no mtd-utils are used)
+        for part in mtd_topology().partitions:
+            mtd = MtdDevice(part.dev, part.size, part.erasesize)
+            print("Checking:", mtd)
+            try:
+                info = mtd.info()
+            except OSError as e:
+                raise ResizeError(f"MEMGETINFO failed on {mtd}: {e}")
+            if (info["size"], info["erasesize"]) != (part.size, part.erasesize):
+                raise ResizeError(f"{mtd}: MEMGETINFO size/erasesize 0x{info['size']:x}/0x{info['erasesize']:x} "
+                                  f"don't match 0x{part.size:x}/0x{part.erasesize:x}")
+
+    def mtd(self, *names):
+        return MtdDevice(*mtd_lookup(*names))
+
+    def partitions(self):
+        """
+            Return the list of (name, flash offset, MtdDevice) of every partition
+            (offset is None when unknown)
+        """
+        return [(part.name, part.offset, MtdDevice(part.dev, part.size, part.erasesize))
+                for part in mtd_topology().partitions]
+
+    def chip_id(self):
+        """
+            Return an identifier of the flash chip (JEDEC id or part name from sysfs when known)
+        """
+        master = mtd_topology().master or "unknown"
+        for attr in ("jedec_id", "partname"):
+            try:
+                with open(f"/sys/bus/spi/devices/{master}/spi-nor/{attr}") as F:
+                    return f"{master}:{F.read().strip()}"
+            except OSError:
+                pass
+        return f"{master}:0x{chip_size(self.partitions()):x}"
+
+    def mtd_master(self):
+        import subprocess
+        mtd_master = mtd_topology().master
+        if mtd_master is None:
+            # no sysfs: the kernel log may still have it
+            mtd_master = mtd_master_from_dmesg(subprocess.check_output(["dmesg"]).decode(errors="ignore").split("\n"))
+        return mtd_master
+
+
+class FileDevice:
+    """
+        A QNAP device emulated with a full flash image file (see ImageMtd),
+        using the legacy layout. Used for tests and benchmarks.
+    """
+    def __init__(self, path, dtb="kirkwood-ts219-6281.dtb", mtd_master="spi0.0",
+                 erase_latency=0.0, program_latency=0.0):
+        import mmap
+        self._dtb = dtb
+        self._mtd_master = mtd_master
+        with open(path, "r+b") as F:
+            self.flash = mmap.mmap(F.fileno(), 0)
+        self.mtds = [ImageMtd(self.flash, name, offset, size, LEGACY_ERASESIZE, erase_latency, program_latency)
+                     for name, offset, size in LEGACY_LAYOUT]
+
+    def dtb(self):
+        return self._dtb
+
+    def check(self):
+        pass
+
+    def mtd(self, *names):
+        for mtd in self.mtds:
+            if MtdTopology.key(mtd.name) in map(MtdTopology.key, names):
+                return mtd
+        raise KeyError(f"No mtd {names} device found.")
+
+    def partitions(self):
+        return [(mtd.name, mtd.offset, mtd) for mtd in self.mtds]
+
+    def chip_id(self):
+        return "image"
+
+    def mtd_master(self):
+        return self._mtd_master
+
+
+def uboot_env_parse(data):
+    """
+        Parse a U-Boot environment block ('data' starting with the
+        little endian CRC32 followed by 'key=value\\0' entries)
+        and return the variables as a dict.
+        Raise a ValueError if the CRC doesn't match.
+    """
+    crc, = struct.unpack_from("<I", data)
+    body = bytes(data[4:UBOOT_ENV_SIZE])
+    if zlib.crc32(body) != crc:
+        raise ValueError("Bad CRC in U-Boot environment")
+
+    env = {}
+    for entry in body.split(b"\0\0", 1)[0].split(b"\0"):
+        key, sep, value = entry.decode("latin-1").partition("=")
+        if sep:
+            env[key] = value
+    return env
+
+
+class Layout:
+    """
+        A layout of the flash partitions: 'NAS Config' from 0xc0000 up to the 'Kernel'
+        partition at 'kernel_offset', which ends where 'RootFS1' starts (0x400000),
+        'RootFS1' using the rest of the flash.
+
+        'kernel_move' is the length of the legacy kernel (at 0x200000) copied to
+        'kernel_offset', when different. The Kernel_legacy partition covers the
+        legacy kernel range inside a moved 'Kernel' (needed by the fallback after a
+        QNAP recovery). It is left out when 'Kernel' stays at 0x200000: it would be
+        the same range.
+    """
+    def __init__(self, kernel_offset, kernel_move=LEGACY_KERNEL_SIZE, flash_size=FLASH_SIZE, erasesize=LEGACY_ERASESIZE):
+        self.kernel_offset = kernel_offset
+        self.kernel_move = -(-min(kernel_move, LEGACY_KERNEL_SIZE) // erasesize) * erasesize
+        self.flash_size = flash_size
+        self.erasesize = erasesize
+
+    @property
+    def moved(self):
+        return self.kernel_offset != LEGACY_KERNEL_OFFSET
+
+    @property
+    def nas_config_size(self):
+        return self.kernel_offset - NAS_CONFIG_OFFSET
+
+    @property
+    def kernel_size(self):
+        return ROOTFS1_OFFSET - self.kernel_offset
+
+    @property
+    def rootfs_size(self):
+        return self.flash_size - ROOTFS1_OFFSET
+
+    @property
+    def initrd_addr(self):
+        # the initrd is loaded right after the largest possible kernel
+        return KERNEL_LOAD_ADDR + self.kernel_size
+
+    def erase_blocks(self):
+        """
+            Number of erase blocks to write: U-Boot env, shrunk 'NAS Config' and moved kernel
+        """
+        if not self.moved:
+            return 1
+        return 2 + self.kernel_move // self.erasesize
+
+    def mtdparts(self, mtd_master):
+        def size(n):
+            return f"{n >> 20}M" if n % 0x100000 == 0 else f"{n >> 10}k"
+        kernel_legacy = f"2M@0x{LEGACY_KERNEL_OFFSET:x}(Kernel_legacy)," if self.moved else ""
+        return (f"{mtd_master}:512k@0(uboot)ro,{size(self.kernel_size)}@0x{self.kernel_offset:x}(Kernel),"
+                f"{size(self.rootfs_size)}@0x{ROOTFS1_OFFSET:x}(RootFS1),{kernel_legacy}"
+                f"256k@0x80000(U-Boot_Config),{size(self.nas_config_size)}@0x{NAS_CONFIG_OFFSET:x}(NAS_Config)")
+
+
+def resized_partitions(names):
+    """
+        Tell if the partition 'names' are the ones of a resized device: RootFS2 is
+        merged into RootFS1 (Kernel_legacy only exists when the kernel moved)
+    """
+    return "RootFS2" not in map(MtdTopology.key, names)
+
+
+# the layout of the README: 256KB 'NAS Config', 3MB 'Kernel', 12MB 'RootFS1'
+DEFAULT_LAYOUT = Layout(0x100000)
+
+
+def uimage_size(data):
+    """
+        Return the size (header included) of the uImage at the beginning of 'data',
+        or None if there is no valid uImage header
+    """
+    if len(data) < UIMAGE_HEADER_SIZE:
+        return None
+    magic, header_crc, _, size = struct.unpack_from(">IIII", data)
+    header = bytearray(data[:UIMAGE_HEADER_SIZE])
+    header[4:8] = bytes(4)
+    if magic != UIMAGE_MAGIC or zlib.crc32(header) != header_crc:
+        return None
+    return UIMAGE_HEADER_SIZE + size
+
+
+def chip_size(partitions):
+    """
+        Return the flash size: end of the last partition of 'partitions' (see
+        LiveDevice.partitions), FLASH_SIZE if the offsets are unknown
+    """
+    return max((offset + mtd.size for _, offset, mtd in partitions if offset is not None), default=FLASH_SIZE)
+
+
+def copy_length(size, width, limit):
+    """
+        Return the bytes to copy for a 'size' bytes uImage: BOOTCMD_COPY_MARGIN
+        more, rounded up to the copy 'width', at most 'limit'
+    """
+    return min(limit, -(-(size + BOOTCMD_COPY_MARGIN) // width) * width)
+
+
+def patch_bootcmd(bootcmd, layout=DEFAULT_LAYOUT, kernel_size=None, initrd_size=None):
+    """
+        Return the new 'bootcmd' loading kernel and initrd from the partitions of 'layout'.
+        With 'kernel_size' / 'initrd_size' (uImage sizes), only what is used is copied
+        (see copy_length) instead of the whole partitions.
+        Raise a ResizeError if 'bootcmd' is not a known one.
+    """
+    try:
+        if bootcmd.find("cp.l") >= 0:
+            # most common configuration
+            cp, width = "cp.l", 4
+            kernel_legacy = "cp.l 0xf8200000 0x800000 0x0*80000"
+            initrd_legacy = "cp.l 0xf8400000 0xa00000 0x240000"
+        elif bootcmd.find("cp.b") >= 0:
+            # some old configurations are using cp.b
+            cp, width = "cp.b", 1
+            kernel_legacy = "cp.b 0xf8200000 0x800000 0x200000"
+            initrd_legacy = "cp.b 0xf8400000 0xa00000 0x900000"
+        else:
+            raise KeyError("bootcmd not using 'cp.l' nor 'cp.b'")
+        kernel_length = layout.kernel_size
+        if kernel_size is not None:
+            kernel_length = copy_length(kernel_size, width, layout.kernel_size)
+        initrd_length = layout.rootfs_size
+        if initrd_size is not None:
+            initrd_length = copy_length(initrd_size, width, layout.rootfs_size)
+
+        # the kernel copy doesn't change when the kernel stays in place
+        if not re.search(kernel_legacy, bootcmd):
+            raise KeyError(f"'{kernel_legacy}' not found in '{bootcmd}'")
+        bootcmd_new = re.sub(kernel_legacy,
+                             f"{cp} 0x{FLASH_BUS_ADDR + layout.kernel_offset:x} 0x{KERNEL_LOAD_ADDR:x} "
+                             f"0x{kernel_length // width:x}", bootcmd)
+        bootcmd_new = str_replace(initrd_legacy,
+                                  f"{cp} 0x{FLASH_BUS_ADDR + ROOTFS1_OFFSET:x} 0x{layout.initrd_addr:x} "
+                                  f"0x{initrd_length // width:x}", bootcmd_new)
+    except KeyError as e:
+        raise ResizeError(f"{e}\nDon't know how to patch 'bootcmd' for this model. Please report this log.")
+
+    if not layout.moved:
+        return bootcmd_new
+
+    # in case of QNAP TFTPBOOT recovery (ie. pressing reset button during boot + running live-cd-20130730.iso from VM)
+    # uboot will:
+    # - flash the legacy kernel at flash offset 0x200000
+    # - flash the legacy rootfs at flash offset 0x400000
+    # - DOESN'T restore the original uboot env
+    # If we want to be able to boot after a QNAP TFTPBOOT recovery, our "bootcmd" must be able to fallback
+    # to a kernel at flash 0x200000 (which is loaded in memory at 0x900000 when we load ou 3MB kernel from flash 0x100000)
+    # When only the used part of the kernel or initrd is copied, the fallback has to copy
+    # the whole legacy kernel and initrd itself.
+    fallback_addr = KERNEL_LOAD_ADDR + LEGACY_KERNEL_OFFSET - layout.kernel_offset
+    fallback = ";echo Kernel_legacy layout fallback"
+    if kernel_length < layout.kernel_size:
+        fallback += f";{cp} 0x{FLASH_BUS_ADDR + LEGACY_KERNEL_OFFSET:x} 0x{fallback_addr:x} 0x{LEGACY_KERNEL_SIZE // width:x}"
+    if initrd_length < layout.rootfs_size:
+        fallback += f";{cp} 0x{FLASH_BUS_ADDR + ROOTFS1_OFFSET:x} 0x{layout.initrd_addr:x} 0x{LEGACY_ROOTFS1_SIZE // width:x}"
+    return bootcmd_new + fallback + f";bootm 0x{fallback_addr:x}"
+
+
+def layout_from_bootargs(bootargs, erasesize=LEGACY_ERASESIZE):
+    """
+        Return the Layout of the 'mtdparts=' definition in 'bootargs' (see Layout.mtdparts),
+        or None if there is none
+    """
+    def size(text):
+        return int(text[:-1]) << (20 if text[-1] == "M" else 10)
+
+    kernel = re.search(r"mtdparts=\S*?([0-9]+[kM])@0x([0-9a-f]+)\(Kernel\)", bootargs)
+    rootfs = re.search(rf"mtdparts=\S*?([0-9]+[kM])@0x{ROOTFS1_OFFSET:x}\(RootFS1\)", bootargs)
+    if not kernel or not rootfs:
+        return None
+    return Layout(int(kernel.group(2), 16), flash_size=ROOTFS1_OFFSET + size(rootfs.group(1)), erasesize=erasesize)
+
+
+def patch_bootargs(bootargs, mtdparts, layout=DEFAULT_LAYOUT):
+    """
+        Return the new 'bootargs' with the initrd size of 'layout' and partitions.
+        Raise a ResizeError if 'bootargs' is not a known one.
+    """
+    try:
+        bootargs_new = str_replace("initrd=0xa00000,0x900000",
+                                   f"initrd=0x{layout.initrd_addr:x},0x{layout.rootfs_size:x}", bootargs)
+    except KeyError as e:
+        raise ResizeError(f"{e}\nDon't know how to patch 'bootargs' for this model. Please report this log.")
+
+    # setup cmdlinepart.mtdparts=... to set the partitions for cases where 'cmdlinepart' is build as external module
+    # (which is the current Debian behavior)
+    bootargs_new = bootargs_new + f' cmdlinepart.mtdparts={mtdparts}'
+
+    # also add mtdparts=... if for some reasons in future, Debian will switch to internal module or if users are
+    # building their own kernel with such configuration
+    return bootargs_new + f' mtdparts={mtdparts}'
+
+
+class Journal:
+    """
+        Write-ahead journal of the flash steps of a resize, stored off-flash in the
+        'path' directory, so an interrupted resize can be finished by 'resume':
+        - plan.json: the steps (name, title, flash offset, image file and its sha256)
+          and what to install once flashed (fw_env.config, block manifest)
+        - one image file per step
+        - log: the erase blocks completed so far ("<offset> <step>" lines, each one
+          fsync'ed) and a final "complete" line
+    """
+    def __init__(self, path):
+        self.path = path
+        self.plan = None
+        self.completed = {}
+        self.complete = False
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _append(self, line):
+        with open(self._file("log"), "a") as F:
+            F.write(line + "\n")
+            F.flush()
+            os.fsync(F.fileno())
+
+    @classmethod
+    def create(cls, path, steps, **info):
+        """
+            Write the journal of 'steps' (see prepare), with the 'info' fields in the plan
+        """
+        import datetime
+        import hashlib
+        journal = cls(path)
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(journal._file("log")):
+            os.unlink(journal._file("log"))
+
+        journal.plan = {"version": 1, "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                        "steps": [], **info}
+        for i, (name, title, mtd, offset, image) in enumerate(steps):
+            filename = f"step{i}.bin"
+            with open(journal._file(filename), "wb") as F:
+                F.write(image)
+                F.flush()
+                os.fsync(F.fileno())
+            journal.plan["steps"].append({"name": name, "title": title, "offset": offset, "file": filename,
+                                          "sha256": hashlib.sha256(image).hexdigest()})
+        with open(journal._file("plan.json.tmp"), "w") as F:
+            json.dump(journal.plan, F)
+            F.flush()
+            os.fsync(F.fileno())
+        os.rename(journal._file("plan.json.tmp"), journal._file("plan.json"))
+
+        # the journal only exists once its log exists
+        open(journal._file("log"), "w").close()
+        fd = os.open(path, os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        """
+            Return the Journal found in 'path', or None if there is none.
+            Raise a ResizeError if it can't be read.
+        """
+        journal = cls(path)
+        if not os.path.exists(journal._file("log")):
+            return None
+        try:
+            with open(journal._file("plan.json")) as F:
+                journal.plan = json.load(F)
+            with open(journal._file("log")) as F:
+                for line in F:
+                    # a line is only valid once completely written
+                    if not line.endswith("\n"):
+                        break
+                    if line == "complete\n":
+                        journal.complete = True
+                    offset, sep, name = line[:-1].partition(" ")
+                    if sep:
+                        journal.completed.setdefault(name, set()).add(int(offset, 16))
+        except (OSError, ValueError) as e:
+            raise ResizeError(f"Can't read the resize journal {path}: {e}")
+        return journal
+
+    def image(self, step):
+        """
+            Return the image of the plan 'step'.
+            Raise a ResizeError if it doesn't match its sha256.
+        """
+        import hashlib
+        with open(self._file(step["file"]), "rb") as F:
+            image = F.read()
+        if hashlib.sha256(image).hexdigest() != step["sha256"]:
+            raise ResizeError(f"{self._file(step['file'])}: damaged image in the resize journal")
+        return image
+
+    def done(self, name, offset):
+        """
+            Record the erase block at 'offset' in the image of the step 'name' as written
+        """
+        self._append(f"0x{offset:x} {name}")
+        self.completed.setdefault(name, set()).add(offset)
+
+    def finish(self):
+        self._append("complete")
+        self.complete = True
+
+
+def flash_locate(partitions, offset, length):
+    """
+        Return the (mtd, offset in mtd) of the partition of 'partitions' (see
+        LiveDevice.partitions) holding 'length' bytes at the flash 'offset'.
+        Raise a ResizeError if there is none.
+    """
+    for name, part_offset, mtd in partitions:
+        if part_offset is not None and part_offset <= offset and offset + length <= part_offset + mtd.size:
+            return mtd, offset - part_offset
+    raise ResizeError(f"No partition holding flash offset 0x{offset:x}")
+
+
+def flash_read(partitions, offset, length):
+    """
+        Read 'length' bytes at the flash 'offset' (see flash_locate)
+    """
+    mtd, mtd_offset = flash_locate(partitions, offset, length)
+    return mtd.read(mtd_offset, length)
+
+
+def status(device, proc_mtd="/proc/mtd", cmdline="/proc/cmdline", journal_path=JOURNAL_PATH):
+    """
+        Return the resize status of 'device' as a dict (read only, no subprocess):
+        'state' is "legacy", "resized" or "partial", from the running partition table
+        ('proc_mtd', 'cmdline', None for a flash image), the U-Boot environment and
+        the resize journal. Missing partitions or unreadable data are reported as
+        problems (state "partial"), never raised.
+    """
+    result = {"state": "partial", "problems": []}
+    problems = result["problems"]
+
+    # running partition table
+    result["running_layout"] = None
+    if proc_mtd and os.path.exists(proc_mtd):
+        with open(proc_mtd) as F:
+            names = re.findall(r'^mtd[0-9]+: [0-9a-f]+ [0-9a-f]+ "(.+)"$', F.read(), re.MULTILINE)
+        result["running_layout"] = "resized" if resized_partitions(names) else "legacy"
+    cmdline_mtdparts = None
+    if cmdline and os.path.exists(cmdline):
+        with open(cmdline) as F:
+            m = re.search(r"(?:^|\s)mtdparts=(\S+)", F.read())
+        cmdline_mtdparts = m and m.group(1)
+
+    # U-Boot environment
+    try:
+        uboot_config = device.mtd("U-Boot Config", "U-Boot_Config")
+        uboot_env = uboot_env_parse(uboot_config.read(0, UBOOT_ENV_SIZE))
+    except KeyError:
+        problems.append("No 'U-Boot Config' partition")
+        return result
+    except (OSError, ValueError) as e:
+        problems.append(f"Can't read the U-Boot environment: {e}")
+        return result
+    bootargs = uboot_env.get("bootargs", "")
+    bootcmd = uboot_env.get("bootcmd", "")
+    layout = layout_from_bootargs(bootargs, uboot_config.erasesize)
+    result["env"] = "resized" if layout else "legacy"
+
+    try:
+        journal = Journal.load(journal_path) if journal_path else None
+    except ResizeError as e:
+        problems.append(str(e))
+        journal = None
+    result["journal"] = None if journal is None else ("complete" if journal.complete else "incomplete")
+    if journal and not journal.complete:
+        problems.append("Interrupted resize (see 'resume')")
+
+    if layout is None:
+        if result["running_layout"] == "resized" or "bootargs_backup" in uboot_env or "bootcmd_backup" in uboot_env:
+            problems.append("Resized partitions or *_backup variables without mtdparts= in bootargs")
+        if not problems:
+            result["state"] = "legacy"
+        return result
+
+    result["layout"] = {"kernel_offset": layout.kernel_offset, "kernel_size": layout.kernel_size,
+                        "rootfs_size": layout.rootfs_size}
+    m = re.search(r"(?:^|\s)mtdparts=(\S+)", bootargs)
+    mtdparts = m and m.group(1)
+    if mtdparts is None:
+        problems.append("No mtdparts= in bootargs (only cmdlinepart.mtdparts=)")
+    elif "bootargs_backup" not in uboot_env:
+        problems.append("No bootargs_backup")
+    else:
+        try:
+            if bootargs != patch_bootargs(uboot_env["bootargs_backup"], mtdparts, layout):
+                problems.append("bootargs differs from the patched bootargs_backup")
+        except ResizeError as e:
+            problems.append(str(e).splitlines()[0])
+
+    # uImage headers in the new partitions
+    try:
+        partitions = device.partitions()
+    except OSError:
+        partitions = []
+    sizes = {}
+    for name, offset in (("kernel", layout.kernel_offset), ("initrd", ROOTFS1_OFFSET)):
+        try:
+            sizes[name] = uimage_size(flash_read(partitions, offset, UIMAGE_HEADER_SIZE))
+        except (ResizeError, OSError):
+            sizes[name] = None
+        if sizes[name] is None:
+            problems.append(f"No valid {name} uImage header at 0x{offset:x}")
+    result["uimage_sizes"] = sizes
+
+    result["bootcmd"] = None
+    if "bootcmd_backup" not in uboot_env:
+        problems.append("No bootcmd_backup")
+    else:
+        try:
+            if bootcmd == patch_bootcmd(uboot_env["bootcmd_backup"], layout):
+                result["bootcmd"] = "full-copy"
+            elif None not in sizes.values() and bootcmd == patch_bootcmd(uboot_env["bootcmd_backup"], layout,
+                                                                         sizes["kernel"], sizes["initrd"]):
+                result["bootcmd"] = "exact-copy"
+            else:
+                problems.append("bootcmd differs from the patched bootcmd_backup (see 'update-bootcmd')")
+        except ResizeError as e:
+            problems.append(str(e).splitlines()[0])
+    result["fallback"] = not layout.moved or "Kernel_legacy layout fallback" in bootcmd
+
+    result["reboot_required"] = False
+    if result["running_layout"] is not None:
+        result["reboot_required"] = result["running_layout"] != "resized" or cmdline_mtdparts != mtdparts
+    if not problems:
+        result["state"] = "resized"
+    return result
+
+
+def status_command(args):
+    """
+        Print the status (see status) of the running device or of the --image flash
+        file as JSON, and exit with 2 for a partial resize
+    """
+    if args.image:
+        device_status = status(FileDevice(args.image), None, None, args.journal)
+    else:
+        device_status = status(LiveDevice(), journal_path=args.journal or JOURNAL_PATH)
+    print(json.dumps(device_status, indent=2))
+    if device_status["state"] == "partial":
+        exit(2)
+
+
+STATUS_USAGE = """usage: {prog} [-h] [--image FILE] [--journal DIR]
+
+Print the resize status of the QNAP MTD partitions as JSON: legacy, resized or partial
+
+options:
+  -h, --help      show this help message and exit
+  --image FILE    Check a full flash image file instead of the running device
+  --journal DIR   Resize journal (default: {journal})"""
+
+
+def status_args(argv):
+    """
+        Return the --image and --journal options of the command line argv as a dict.
+        Parsed by hand: importing argparse takes as long as the status itself.
+        Raise a ValueError for an invalid command line, None for --help.
+    """
+    options = {"image": None, "journal": None}
+    argv = list(argv)
+    while argv:
+        option, equal, value = argv.pop(0).partition("=")
+        if option in ("-h", "--help") and not equal:
+            return None
+        if option not in ("--image", "--journal"):
+            raise ValueError(f"unrecognized argument: {option}")
+        if not equal:
+            if not argv:
+                raise ValueError(f"argument {option}: expected one argument")
+            value = argv.pop(0)
+        options[option[2:]] = value
+    return options
+
+
+def main(argv=None, prog=None):
+    import sys
+    from types import SimpleNamespace
+    prog = prog or os.path.basename(sys.argv[0])
+    usage = STATUS_USAGE.format(prog=prog, journal=JOURNAL_PATH)
+    try:
+        options = status_args(sys.argv[1:] if argv is None else argv)
+    except ValueError as e:
+        print(usage.split("\n")[0], file=sys.stderr)
+        print(f"{prog}: error: {e}", file=sys.stderr)
+        exit(2)
+    if options is None:
+        print(usage)
+        return
+    status_command(SimpleNamespace(**options))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+    Backup of the allocated blocks only of an ext2/3/4 partition (ie. /dev/sda1) to
+    the same offsets of a backup area of the disk (see testing.md), instead of a
+    raw 'dd' of the whole partition.
+
+    The block bitmaps of the filesystem give the allocated extents, which are saved
+    as a JSON extent map. 'gen_uboot_sda_copy_script.py --extents' then only restores
+    these extents from U-Boot, and the 'restore' command does the same from Linux.
+
+        ./testing/backup_sda_used_blocks.py backup /dev/sda1 /dev/sda 220000000 --map sda1.extents.json
+        ./testing/backup_sda_used_blocks.py restore sda1.extents.json /dev/sda /dev/sda1
+
+    The filesystem must not be mounted read-write during the backup.
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gen_uboot_sda_copy_script import BLOCK_SIZE, partition_geometry
+from qnap_mtd_resize import (Ext2Superblock, EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER, EXT2_FEATURE_INCOMPAT_META_BG,
+                             EXT4_FEATURE_COMPAT_SPARSE_SUPER2, EXT4_FEATURE_RO_COMPAT_BIGALLOC, EXT4_BG_BLOCK_UNINIT)
+
+
+COPY_SIZE = 1 << 20
+
+
+def bitmap_ranges(bitmap, count):
+    """
+        Return the (first, length) ranges of the set bits among the first 'count' of 'bitmap'
+    """
+    ranges = []
+    first = None
+    for i, byte in enumerate(bitmap[:(count + 7) // 8]):
+        if byte in (0x00, 0xff) and (first is None) == (byte == 0x00):
+            continue
+        for bit in range(8 * i, min(8 * i + 8, count)):
+            if byte >> (bit - 8 * i) & 1:
+                if first is None:
+                    first = bit
+            elif first is not None:
+                ranges.append((first, bit - first))
+                first = None
+    if first is not None:
+        ranges.append((first, count - first))
+    return ranges
+
+
+def merge_ranges(ranges, gap=0):
+    """
+        Sort and merge the (first, length) 'ranges' less than 'gap' apart
+    """
+    merged = []
+    for first, length in sorted(ranges):
+        if merged and first <= merged[-1][0] + merged[-1][1] + gap:
+            last_first, last_length = merged[-1]
+            merged[-1] = (last_first, max(last_length, first + length - last_first))
+        else:
+            merged.append((first, length))
+    return merged
+
+
+def has_super_backup(group, sparse_super):
+    """
+        Return True if the block group 'group' holds a superblock and group descriptors backup
+    """
+    if group <= 1 or not sparse_super:
+        return True
+    for base in (3, 5, 7):
+        power = base
+        while power < group:
+            power *= base
+        if power == group:
+            return True
+    return False
+
+
+def ext_used_blocks(F):
+    """
+        Return the allocated extents of the ext2/3/4 filesystem in the open device 'F',
+        as (first, length) ranges of BLOCK_SIZE blocks.
+        Raise a ValueError if the filesystem is not supported.
+    """
+    F.seek(1024)
+    ext = Ext2Superblock(F.read(1024))
+    if (ext.incompat & EXT2_FEATURE_INCOMPAT_META_BG or ext.ro_compat & EXT4_FEATURE_RO_COMPAT_BIGALLOC
+            or ext.compat & EXT4_FEATURE_COMPAT_SPARSE_SUPER2):
+        raise ValueError("Unsupported filesystem features (meta_bg, bigalloc or sparse_super2)")
+
+    block_size, blocks_count, first_data_block = ext.block_size, ext.blocks_count, ext.first_data_block
+    blocks_per_group, desc_size, reserved_gdt_blocks = ext.blocks_per_group, ext.desc_size, ext.reserved_gdt_blocks
+    wide = ext.wide
+    groups = -(-(blocks_count - first_data_block) // blocks_per_group)
+    gdt_blocks = -(-groups * desc_size // block_size)
+    inode_table_blocks = -(-ext.inodes_per_group * ext.inode_size // block_size)
+
+    F.seek((first_data_block + 1) * block_size)
+    gdt = F.read(gdt_blocks * block_size)
+    descs = []
+    for group in range(groups):
+        desc = gdt[group * desc_size:(group + 1) * desc_size]
+        block_bitmap, inode_bitmap, inode_table = struct.unpack_from("<III", desc)
+        flags, = struct.unpack_from("<H", desc, 0x12)
+        if wide:
+            hi = struct.unpack_from("<III", desc, 0x20)
+            block_bitmap, inode_bitmap, inode_table = (lo | h << 32 for lo, h in zip((block_bitmap, inode_bitmap, inode_table), hi))
+        descs.append((block_bitmap, inode_bitmap, inode_table, flags))
+
+    # the metadata of every group is kept, even where the block bitmap isn't initialized
+    used = [(0, first_data_block + 1 + gdt_blocks + reserved_gdt_blocks)]
+    for block_bitmap, inode_bitmap, inode_table, _ in descs:
+        used += [(block_bitmap, 1), (inode_bitmap, 1), (inode_table, inode_table_blocks)]
+    for group, (block_bitmap, _, _, flags) in enumerate(descs):
+        group_first = first_data_block + group * blocks_per_group
+        group_count = min(blocks_per_group, blocks_count - group_first)
+        if flags & EXT4_BG_BLOCK_UNINIT:
+            if has_super_backup(group, ext.ro_compat & EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER):
+                used.append((group_first, 1 + gdt_blocks + reserved_gdt_blocks))
+            continue
+        F.seek(block_bitmap * block_size)
+        bitmap = F.read(block_size)
+        used += [(group_first + first, length) for first, length in bitmap_ranges(bitmap, group_count)]
+
+    scale = block_size // BLOCK_SIZE
+    return [(first * scale, length * scale) for first, length in merge_ranges(used)]
+
+
+def copy_ranges(source, source_offset, target, target_offset, extents):
+    """
+        Copy the 'extents' (in blocks) from the 'source' device at block 'source_offset'
+        to the 'target' device at block 'target_offset'. Return the number of bytes copied.
+    """
+    copied = 0
+    with open(source, "rb", buffering=0) as S, open(target, "r+b", buffering=0) as T:
+        for first, length in extents:
+            offset = first * BLOCK_SIZE
+            end = offset + length * BLOCK_SIZE
+            while offset < end:
+                data = os.pread(S.fileno(), min(COPY_SIZE, end - offset), source_offset * BLOCK_SIZE + offset)
+                if not data:
+                    raise IOError(f"{source}: unexpected end of device at block {source_offset + offset // BLOCK_SIZE}")
+                os.pwrite(T.fileno(), data, target_offset * BLOCK_SIZE + offset)
+                offset += len(data)
+                copied += len(data)
+            print(f"\r   {copied >> 20} MB", end="", flush=True)
+        os.fsync(T.fileno())
+    print()
+    return copied
+
+
+def backup(args):
+    """
+        Copy the allocated extents of the 'args.partition' filesystem to 'args.disk'
+        and save the extent map
+    """
+    if os.path.isfile(args.partition):
+        start, size = 0, os.path.getsize(args.partition) // BLOCK_SIZE
+    else:
+        start, size = partition_geometry(args.partition)
+    with open(args.partition, "rb") as F:
+        extents = merge_ranges(ext_used_blocks(F), args.merge_gap)
+    used = sum(length for _, length in extents)
+    print(f"{args.partition}: {len(extents)} extents, {used} of {size} blocks ({100 * used // size}%)")
+
+    extent_map = {"partition": args.partition, "start": start, "size": size, "block_size": BLOCK_SIZE,
+                  "backup_offset": args.backup_offset, "extents": extents}
+    copy_ranges(args.partition, 0, args.disk, args.backup_offset, extents)
+    with open(args.map, "w") as F:
+        json.dump(extent_map, F, indent=1)
+    print(f"Extent map saved to {args.map}")
+
+
+def restore(args):
+    """
+        Copy back the extents of the 'args.map' extent map from 'args.disk' to 'args.partition'
+    """
+    with open(args.map) as F:
+        extent_map = json.load(F)
+    copy_ranges(args.disk, extent_map["backup_offset"], args.partition, 0, extent_map["extents"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backup / restore the allocated blocks of an ext2/3/4 partition")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("backup", help="Copy the allocated extents to the backup area of the disk")
+    p.add_argument("partition", help="Partition to backup (ie. /dev/sda1)")
+    p.add_argument("disk", help="Disk holding the backup area (ie. /dev/sda)")
+    p.add_argument("backup_offset", type=lambda x: int(x, 0), help="Block of the disk where the backup area starts")
+    p.add_argument("--map", required=True, help="Extent map to save (JSON)")
+    p.add_argument("--merge-gap", type=lambda x: int(x, 0), default=2048,
+                   help="Merge the extents less than this number of blocks apart, for fewer U-Boot commands (default: 2048)")
+
+    p = subparsers.add_parser("restore", help="Copy back the extents from the backup area")
+    p.add_argument("map", help="Extent map saved by 'backup'")
+    p.add_argument("disk", help="Disk holding the backup area (ie. /dev/sda)")
+    p.add_argument("partition", help="Partition to restore (ie. /dev/sda1)")
+
+    args = parser.parse_args()
+    try:
+        if args.command == "backup":
+            backup(args)
+        elif args.command == "restore":
+            restore(args)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
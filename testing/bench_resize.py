@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+    Benchmark of the resize process on emulated flash devices.
+
+    For every legacy U-Boot environment found in resources/*,uboot-env.legacy,
+    a legacy layout flash image is generated (random kernel and rootfs, a small
+    ext2 'NAS Config' if mke2fs is available) and resized through a FileDevice.
+
+    Wall time, bytes read / erased / programmed and erase counts are reported
+    for each phase, with the 'diff' strategy (flash_image) and with a 'full'
+    strategy erasing and programming every block, like flashcp.
+
+        ./testing/bench_resize.py --erase-latency 0.5 --program-latency 0.7
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import qnap_mtd_resize as q
+
+
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources")
+
+
+def make_nas_config(seed):
+    """
+        Return a 'NAS Config' ext2 image (1024 1KB blocks) with some files
+        spread above the 128th block, or None if mke2fs is not available
+    """
+    rnd = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, "root")
+        os.makedirs(os.path.join(root, "config"))
+        for i in range(8):
+            with open(os.path.join(root, "config", f"file{i}"), "wb") as F:
+                F.write(rnd.randbytes(rnd.randrange(100, 8000)))
+        image = os.path.join(tmp, "nas_config.img")
+        with open(image, "wb") as F:
+            F.truncate(q.LEGACY_NAS_CONFIG_SIZE)
+        try:
+            subprocess.check_call(["mke2fs", "-q", "-F", "-t", "ext2", "-b", "1024", "-N", "128", "-d", root, image, "1024"],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        with open(image, "rb") as F:
+            return F.read()
+
+
+def make_flash(path, env, seed):
+    """
+        Write a legacy layout flash image using the 'env' U-Boot environment.
+        Return False if the 'NAS Config' image can't be created (and must be dropped)
+    """
+    rnd = random.Random(seed)
+    flash = bytearray(rnd.randbytes(q.FLASH_SIZE))
+    layout = {name: (offset, size) for name, offset, size in q.LEGACY_LAYOUT}
+
+    offset, size = layout["U-Boot Config"]
+    flash[offset:offset+size] = q.uboot_env_build(env) + b"\xff" * (size - q.UBOOT_ENV_SIZE)
+
+    nas_config = make_nas_config(seed)
+    if nas_config:
+        offset, size = layout["NAS Config"]
+        flash[offset:offset+size] = nas_config
+
+    with open(path, "wb") as F:
+        F.write(flash)
+    return nas_config is not None
+
+
+def flash_full(mtd, image):
+    """
+        Erase and program every block of 'image', like flashcp
+    """
+    for offset in range(0, len(image), mtd.erasesize):
+        target = bytes(image[offset:offset+mtd.erasesize])
+        mtd.erase(offset)
+        mtd.write(offset, target)
+        if mtd.read(offset, len(target)) != target:
+            raise IOError(f"{mtd}: verify failed at offset 0x{offset:x}")
+
+
+def bench(env_file, strategy, args):
+    """
+        Run the whole resize of a generated device. Return the results of each phase
+        (wall time and bytes read / erased / programmed and erase counts of all the partitions)
+    """
+    env = {}
+    for line in open(env_file).read().split("\n"):
+        key, sep, value = line.partition("=")
+        if sep:
+            env[key] = value
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "flash.bin")
+        has_nas_config = make_flash(path, env, args.seed)
+        original = open(path, "rb").read()
+        device = q.FileDevice(path, erase_latency=args.erase_latency, program_latency=args.program_latency)
+        options = argparse.Namespace(skip_bootargs=False, skip_bootcmd=False, setenv_script_append=None,
+                                     drop_nas_config=not has_nas_config, auto_layout=False, exact_copy=False)
+        mtds = {name: device.mtd(name) for name in ("Kernel", "RootFS1", "NAS Config", "U-Boot Config")}
+
+        report = q.Report("bench")
+        report.mtds = device.mtds
+        with contextlib.redirect_stdout(io.StringIO()):
+            steps, _, _ = q.prepare(mtds, device.mtd_master(), options, report)
+            for name, title, mtd, _, image in steps:
+                with report.phase(name):
+                    if strategy == "diff":
+                        q.flash_image(mtd, image)
+                    else:
+                        flash_full(mtd, image)
+
+        # the kernel must have moved from 0x200000 to 0x100000, the rootfs must be untouched
+        flash = device.flash
+        if (flash[0x100000:0x300000] != original[0x200000:0x400000]
+                or flash[0x400000:] != original[0x400000:]):
+            raise AssertionError(f"{env_file}: unexpected flash content after resize")
+
+        results = []
+        for phase in report.phases:
+            result = {"phase": phase["name"], "time": phase["wall_time"]}
+            for key in ("read", "erased", "programmed", "erase_count"):
+                result[key] = sum(io[key] for io in phase["io"].values())
+            results.append(result)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the resize on emulated legacy layout devices")
+    parser.add_argument("--erase-latency", type=float, default=0.0, help="Seconds per erase block erase")
+    parser.add_argument("--program-latency", type=float, default=0.0, help="Seconds per erase block programmed")
+    parser.add_argument("--strategy", choices=["diff", "full", "all"], default="all")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="FILE", help="Also save the results as JSON")
+    args = parser.parse_args()
+
+    strategies = ["diff", "full"] if args.strategy == "all" else [args.strategy]
+    results = []
+    for env_file in sorted(glob.glob(os.path.join(RESOURCES, "*,uboot-env.legacy"))):
+        for strategy in strategies:
+            for result in bench(env_file, strategy, args):
+                result["layout"] = os.path.basename(env_file).split(",")[0]
+                result["strategy"] = strategy
+                results.append(result)
+
+    print(f"{'layout':24} {'strategy':8} {'phase':30} {'time(s)':>8} {'read':>9} {'erased':>9} {'programmed':>10} {'erases':>6}")
+    for r in results:
+        print(f"{r['layout']:24} {r['strategy']:8} {r['phase'][:30]:30} {r['time']:8.3f} "
+              f"{r['read']:9} {r['erased']:9} {r['programmed']:10} {r['erase_count']:6}")
+
+    if args.json:
+        with open(args.json, "w") as F:
+            json.dump(results, F, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,49 +1,327 @@
 #!/usr/bin/env python3
 
-sda1_size_blk = 9762816
-sda1_offset_blk = 2048
+"""
+    Generate the U-Boot commands restoring a partition (ie. /dev/sda1) from its raw
+    copy stored further on the same disk (see testing.md), through U-Boot's RAM.
 
+    The geometry comes from the partition device (sysfs) or from --start / --size,
+    the size defaulting to the one of --dump. The chunk size is the RAM window of
+    the target: from --ram-addr to the top of its RAM (--ram-size, or the memory
+    node of its --dtb) minus what U-Boot keeps there after its relocation (code,
+    heap and stack, --uboot-reserve), rounded down to a multiple of --granularity.
+    The commands are packed into the fewest console
+    lines shorter than --max-line.
 
-max_chunk_size_MB = 256
-ram_addr=0x800000
+    With --dump (the copy of the partition, a file or the disk itself with
+    --dump-offset), all-zero ranges are not read from the disk: they are written
+    from a zeroed RAM buffer, or skipped with --zero-ranges skip. --crc checks
+    every chunk read with 'crc32 -v' (needs CONFIG_CRC32_VERIFY).
 
-sda1_backup_offset_blk = 220000000
+    With --extents (see backup_sda_used_blocks.py), only the allocated extents of
+    the filesystem are restored, the geometry defaulting to the one of the map.
 
+    With --mkimage, a script image (like 'mkimage -T script') is saved instead,
+    to be copied on the disk and run with a single 'source' command:
 
+        ./testing/gen_uboot_sda_copy_script.py --partition /dev/sda1 --backup-offset 220000000 \\
+            --dump /dev/sda --dump-offset 220000000 --crc --ram-size 0x20000000 \\
+            --mkimage restore.scr --script-offset 219990000
+"""
 
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+import zlib
 
-max_chunk_size_blk = max_chunk_size_MB * 1024 * 1024 // 512
-max_uboot_cmd_size = 800
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import qnap_mtd_status
 
 
-echo="echo "
-echo=""
+BLOCK_SIZE = 512
+# RAM kept at the top of the RAM by U-Boot once relocated: code, malloc heap, stack
+UBOOT_RESERVE = 16 << 20
 
-cmds = []
-while sda1_size_blk:
-    chunk_blk = min(sda1_size_blk, max_chunk_size_blk)
-    
-    cmds.append(echo+f"ide read {ram_addr:x} {sda1_backup_offset_blk:x} {chunk_blk:x}")
-    cmds.append(echo+f"ide write {ram_addr:x} {sda1_offset_blk:x} {chunk_blk:x}")
-    
-    sda1_offset_blk += chunk_blk
-    sda1_backup_offset_blk += chunk_blk
-    sda1_size_blk += -chunk_blk
-    
+FDT_MAGIC = 0xd00dfeed
+FDT_BEGIN_NODE = 1
+FDT_END_NODE = 2
+FDT_PROP = 3
+FDT_NOP = 4
+FDT_END = 9
 
+IH_OS_LINUX = 5
+IH_ARCH_ARM = 2
+IH_TYPE_SCRIPT = 6
+IH_COMP_NONE = 0
 
-line=cmds[0]
-for cmd in cmds[1:]:
 
-    next_line = line + ";" + cmd
-    if len(next_line) >= max_uboot_cmd_size:
-        print(line)
+def partition_geometry(device):
+    """
+        Return the (start, size) in 512 bytes blocks of the 'device' partition (ie. /dev/sda1)
+    """
+    sysfs = os.path.join("/sys/class/block", os.path.basename(os.path.realpath(device)))
+    with open(os.path.join(sysfs, "start")) as F:
+        start = int(F.read())
+    with open(os.path.join(sysfs, "size")) as F:
+        size = int(F.read())
+    return start, size
+
+
+def dtb_memory(path):
+    """
+        Return the (base, size) of the RAM from the memory node of the 'path' DTB
+        (first bank, #address-cells and #size-cells of the root node).
+        Raise a ValueError if there is none.
+    """
+    with open(path, "rb") as F:
+        dtb = F.read()
+    magic, _, struct_offset, strings_offset = struct.unpack_from(">IIII", dtb)
+    if magic != FDT_MAGIC:
+        raise ValueError(f"{path}: not a DTB")
+    cells = {"#address-cells": 2, "#size-cells": 1}
+    path_nodes = []
+    position = struct_offset
+    while True:
+        token, = struct.unpack_from(">I", dtb, position)
+        position += 4
+        if token == FDT_BEGIN_NODE:
+            end = dtb.index(b"\0", position)
+            path_nodes.append(dtb[position:end].decode())
+            position = (end + 4) & ~3
+        elif token == FDT_END_NODE:
+            path_nodes.pop()
+        elif token == FDT_PROP:
+            length, name_offset = struct.unpack_from(">II", dtb, position)
+            value = dtb[position + 8:position + 8 + length]
+            position = (position + 8 + length + 3) & ~3
+            name = dtb[strings_offset + name_offset:dtb.index(b"\0", strings_offset + name_offset)].decode()
+            if len(path_nodes) == 1 and name in cells:
+                cells[name], = struct.unpack(">I", value)
+            elif len(path_nodes) == 2 and path_nodes[1].split("@")[0] == "memory" and name == "reg":
+                numbers = struct.unpack(f">{length // 4}I", value)
+                address_cells, size_cells = cells["#address-cells"], cells["#size-cells"]
+                base = size = 0
+                for number in numbers[:address_cells]:
+                    base = base << 32 | number
+                for number in numbers[address_cells:address_cells + size_cells]:
+                    size = size << 32 | number
+                return base, size
+        elif token == FDT_END:
+            raise ValueError(f"{path}: no memory node")
+        elif token != FDT_NOP:
+            raise ValueError(f"{path}: bad DTB token {token} at 0x{position - 4:x}")
+
+
+def ram_window_size(ram_base, ram_size, ram_addr, reserve, granularity_blk):
+    """
+        Return the size in bytes of the RAM window from 'ram_addr' up to 'reserve' bytes
+        below the top of the RAM ('ram_size' bytes from 'ram_base'), rounded down to
+        a multiple of 'granularity_blk' blocks.
+        Raise a ValueError if there is no room for a single granule.
+    """
+    granularity = granularity_blk * BLOCK_SIZE
+    window = (ram_base + ram_size - reserve - ram_addr) // granularity * granularity
+    if window <= 0:
+        raise ValueError(f"No RAM window at 0x{ram_addr:x}: RAM 0x{ram_base:x}-0x{ram_base + ram_size:x}, "
+                         f"0x{reserve:x} bytes kept by U-Boot at its top")
+    return window
+
+
+def dump_ranges(path, offset_blk, size_blk, granularity_blk):
+    """
+        Scan 'size_blk' blocks of the 'path' dump from 'offset_blk', by 'granularity_blk' blocks.
+        Return a list of (offset, count, zero) ranges (in blocks, relative to the partition),
+        adjacent ranges of the same kind being merged.
+    """
+    ranges = []
+    zero_chunk = bytes(granularity_blk * BLOCK_SIZE)
+    with open(path, "rb") as F:
+        F.seek(offset_blk * BLOCK_SIZE)
+        for offset in range(0, size_blk, granularity_blk):
+            count = min(granularity_blk, size_blk - offset)
+            data = F.read(count * BLOCK_SIZE)
+            if len(data) != count * BLOCK_SIZE:
+                raise ValueError(f"{path}: too short ({offset + len(data) // BLOCK_SIZE} blocks)")
+            zero = data == zero_chunk[:len(data)]
+            if ranges and ranges[-1][2] == zero:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + count, zero)
+            else:
+                ranges.append((offset, count, zero))
+    return ranges
+
+
+def dump_crc(F, offset_blk, count_blk):
+    """
+        Return the CRC32 of 'count_blk' blocks of the open dump 'F' from 'offset_blk'
+    """
+    F.seek(offset_blk * BLOCK_SIZE)
+    crc = 0
+    remaining = count_blk * BLOCK_SIZE
+    while remaining:
+        data = F.read(min(remaining, 1 << 20))
+        crc = zlib.crc32(data, crc)
+        remaining -= len(data)
+    return crc
+
+
+def restore_commands(ranges, start, backup_offset, chunk_blk, ram_addr, zero_ranges="write", dump=None, dump_offset=0):
+    """
+        Return the U-Boot commands copying the 'ranges' (see dump_ranges) of the partition
+        at block 'start' from its copy at block 'backup_offset', by chunks of 'chunk_blk'
+        blocks through RAM at 'ram_addr'.
+        With an open 'dump', every chunk read is checked with 'crc32 -v'.
+    """
+    cmds = []
+    zeroed = 0      # blocks of zeros at ram_addr
+    for offset, count, zero in ranges:
+        if zero and zero_ranges == "skip":
+            continue
+        for chunk in range(offset, offset + count, chunk_blk):
+            chunk_size = min(chunk_blk, offset + count - chunk)
+            if zero:
+                if zeroed < chunk_size:
+                    cmds.append(f"mw.l {ram_addr:x} 0 {chunk_size * BLOCK_SIZE // 4:x}")
+                    zeroed = chunk_size
+            else:
+                cmds.append(f"ide read {ram_addr:x} {backup_offset + chunk:x} {chunk_size:x}")
+                zeroed = 0
+                if dump:
+                    crc = dump_crc(dump, dump_offset + chunk, chunk_size)
+                    cmds.append(f"crc32 -v {ram_addr:x} {chunk_size * BLOCK_SIZE:x} {crc:08x}")
+            cmds.append(f"ide write {ram_addr:x} {start + chunk:x} {chunk_size:x}")
+    return cmds
+
+
+def pack_lines(cmds, max_line):
+    """
+        Join the 'cmds' with ';' into lines shorter than 'max_line' characters.
+        The order of the commands is kept, so filling every line before the next
+        one gives the fewest lines.
+    """
+    lines = []
+    line = ""
+    for cmd in cmds:
+        if len(cmd) >= max_line:
+            raise ValueError(f"Command longer than {max_line} characters: {cmd}")
+        if not line:
+            line = cmd
+        elif len(line) + 1 + len(cmd) < max_line:
+            line += ";" + cmd
+        else:
+            lines.append(line)
+            line = cmd
+    if line:
+        lines.append(line)
+    return lines
+
+
+def script_image(script, name="restore"):
+    """
+        Return a U-Boot script image of the 'script' text, like 'mkimage -A arm -O linux -T script -C none'
+    """
+    data = script.encode()
+    data = struct.pack(">II", len(data), 0) + data + b"\0" * (-len(data) % 4)
+    header = bytearray(struct.pack(">IIIIIIIBBBB32s", qnap_mtd_status.UIMAGE_MAGIC, 0, int(time.time()), len(data), 0, 0,
+                                   zlib.crc32(data), IH_OS_LINUX, IH_ARCH_ARM, IH_TYPE_SCRIPT, IH_COMP_NONE,
+                                   name.encode()[:32]))
+    struct.pack_into(">I", header, 4, zlib.crc32(header))
+    return bytes(header) + data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the U-Boot commands restoring a partition from its copy on the same disk")
+    parser.add_argument("--partition", metavar="DEVICE", help="Partition to restore (ie. /dev/sda1), for its start and size")
+    parser.add_argument("--start", type=lambda x: int(x, 0), help="Start block of the partition (instead of --partition)")
+    parser.add_argument("--size", type=lambda x: int(x, 0), help="Size of the partition in blocks (default: from --partition or --dump)")
+    parser.add_argument("--backup-offset", type=lambda x: int(x, 0), help="Block of the disk where the copy starts")
+    parser.add_argument("--extents", metavar="FILE", help="Only restore the extents of this map (see backup_sda_used_blocks.py)")
+    parser.add_argument("--dump", metavar="FILE", help="Copy of the partition (file, or the disk with --dump-offset) for the zero ranges and CRCs")
+    parser.add_argument("--dump-offset", type=lambda x: int(x, 0), default=0, help="Block of --dump where the copy starts")
+    parser.add_argument("--granularity", type=lambda x: int(x, 0), default=2048, help="Blocks per zero range check (default: 2048, 1MB)")
+    parser.add_argument("--zero-ranges", choices=["write", "skip"], default="write",
+                        help="Write the zero ranges from a zeroed buffer, or skip them when the partition is already zeroed (default: write)")
+    parser.add_argument("--crc", action="store_true", help="Check every chunk read with 'crc32 -v' (needs --dump)")
+    parser.add_argument("--ram-addr", type=lambda x: int(x, 0), default=0x800000, help="RAM window address (default: 0x800000)")
+    parser.add_argument("--ram-size", type=lambda x: int(x, 0), help="RAM size of the target in bytes (or --dtb)")
+    parser.add_argument("--dtb", metavar="FILE", help="DTB of the target, for its RAM size (memory node)")
+    parser.add_argument("--uboot-reserve", type=lambda x: int(x, 0), default=UBOOT_RESERVE,
+                        help=f"RAM used by U-Boot at the top of the RAM (default: {UBOOT_RESERVE >> 20}MB)")
+    parser.add_argument("--max-line", type=int, default=800, help="Maximum U-Boot command line length (default: 800)")
+    parser.add_argument("--echo", action="store_true", help="Only echo the commands (to check them on U-Boot)")
+    parser.add_argument("--mkimage", metavar="FILE", help="Save a script image for 'source' instead of printing the lines")
+    parser.add_argument("--script-addr", type=lambda x: int(x, 0), default=0x400000,
+                        help="RAM address to load the script image to, outside of the RAM window (default: 0x400000)")
+    parser.add_argument("--script-offset", type=lambda x: int(x, 0), help="Block of the disk where the script image is copied")
+    args = parser.parse_args()
+
+    start, size, backup_offset = args.start, args.size, args.backup_offset
+    extent_map = None
+    if args.extents:
+        with open(args.extents) as F:
+            extent_map = json.load(F)
+        start = extent_map["start"] if start is None else start
+        size = extent_map["size"] if size is None else size
+        backup_offset = extent_map["backup_offset"] if backup_offset is None else backup_offset
+    if args.partition:
+        part_start, part_size = partition_geometry(args.partition)
+        start = part_start if start is None else start
+        size = part_size if size is None else size
+    if size is None and args.dump:
+        size = os.path.getsize(args.dump) // BLOCK_SIZE - args.dump_offset
+    if start is None or size is None:
+        parser.error("the partition geometry is needed: --partition, --extents, or --start with --size or --dump")
+    if backup_offset is None:
+        parser.error("--backup-offset is needed")
+    if args.crc and not args.dump:
+        parser.error("--crc needs --dump")
+    if args.mkimage and args.script_offset is None:
+        parser.error("--mkimage needs --script-offset")
+    if args.ram_size is not None:
+        ram_base, ram_size = 0, args.ram_size
+    elif args.dtb:
+        try:
+            ram_base, ram_size = dtb_memory(args.dtb)
+        except (OSError, ValueError, struct.error) as e:
+            parser.error(f"can't read the RAM size from --dtb: {e}")
+    else:
+        parser.error("the RAM size of the target is needed: --ram-size or --dtb")
+    try:
+        chunk_blk = ram_window_size(ram_base, ram_size, args.ram_addr, args.uboot_reserve, args.granularity) // BLOCK_SIZE
+    except ValueError as e:
+        parser.error(str(e))
+    if args.mkimage and args.ram_addr <= args.script_addr < args.ram_addr + chunk_blk * BLOCK_SIZE:
+        parser.error("--script-addr is in the RAM window")
+
+    if extent_map:
+        ranges = [(first, length, False) for first, length in extent_map["extents"]]
+    elif args.dump:
+        ranges = dump_ranges(args.dump, args.dump_offset, size, args.granularity)
+    else:
+        ranges = [(0, size, False)]
+    dump = open(args.dump, "rb") if args.crc else None
+    cmds = restore_commands(ranges, start, backup_offset, chunk_blk, args.ram_addr,
+                            args.zero_ranges, dump, args.dump_offset)
+    if args.echo:
+        cmds = ["echo " + cmd for cmd in cmds]
+
+    copied = sum(count for _, count, zero in ranges if not zero)
+    zeros = sum(count for _, count, zero in ranges if zero)
+    print(f"# {size} blocks from block {backup_offset} to block {start}: {copied} read, "
+          f"{zeros} zero blocks ({args.zero_ranges}), {size - copied - zeros} unallocated, {len(cmds)} commands", file=sys.stderr)
+
+    if args.mkimage:
+        image = script_image("\n".join(cmds) + "\n")
+        with open(args.mkimage, "wb") as F:
+            F.write(image)
+        count = -(-len(image) // BLOCK_SIZE)
+        print(f"dd if={args.mkimage} of=/dev/sdX seek={args.script_offset}")
         print()
-        line = cmd
+        print(f"ide read {args.script_addr:x} {args.script_offset:x} {count:x};source {args.script_addr:x}")
     else:
-        line = next_line
+        print("\n\n".join(pack_lines(cmds, args.max_line)))
 
-        
-if line:
-    print(line)
 
+if __name__ == "__main__":
+    main()